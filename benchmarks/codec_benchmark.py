@@ -0,0 +1,63 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+
+
+Benchmark the payload size and encode/decode time of the management API codecs for the status of large workflows.
+
+Usage:
+    PYTHONPATH=src python benchmarks/codec_benchmark.py [<number of steps> ...]
+"""
+import sys
+
+from timeit import timeit
+
+from autotrail.core.api.management import APIResponse, CompactCodec, PickleCodec
+from autotrail.workflow.default_workflow.api import StatusField
+
+
+def make_status(number_of_steps):
+    """Make a status response similar to the one returned by the status API call with all the fields."""
+    return APIResponse({
+        step_id: {
+            StatusField.NAME: 'step_{}'.format(step_id % 20),
+            StatusField.TAGS: {'n': step_id, 'name': 'step_{}'.format(step_id % 20), 'group': step_id % 4},
+            StatusField.STATE: 'Successful',
+            StatusField.ACTIONS: ['Rerun'],
+            StatusField.IO: [],
+            StatusField.OUTPUT: ['Starting step {}'.format(step_id), 'Done.'],
+            StatusField.RETURN_VALUE: 'Finished step {}'.format(step_id),
+            StatusField.EXCEPTION: None,
+        } for step_id in range(number_of_steps)})
+
+
+def benchmark(codec, message, number=20):
+    data = codec.encode(message)
+    encode_time = timeit(lambda: codec.encode(message), number=number) / number
+    decode_time = timeit(lambda: codec.decode(data), number=number) / number
+    return len(data), encode_time, decode_time
+
+
+def main(sizes):
+    codecs = [('pickle', PickleCodec()), ('compact', CompactCodec()), ('compact+zlib', CompactCodec(compress=True))]
+    print('{:>8} {:>14} {:>12} {:>12} {:>12}'.format('Steps', 'Codec', 'Bytes', 'Encode (ms)', 'Decode (ms)'))
+    for size in sizes:
+        message = make_status(size)
+        for name, codec in codecs:
+            size_in_bytes, encode_time, decode_time = benchmark(codec, message)
+            print('{:>8} {:>14} {:>12} {:>12.2f} {:>12.2f}'.format(size, name, size_in_bytes, encode_time * 1000,
+                                                                    decode_time * 1000))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [100, 1000, 10000])
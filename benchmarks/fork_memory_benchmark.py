@@ -0,0 +1,76 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+
+
+Benchmark the total memory (PSS and USS) used by many concurrent steps forked from a process with a large heap, with
+and without freezing the garbage collector on fork (see workflow.helpers.execution.freeze_gc_on_fork).
+
+Each step runs a full garbage collection (like a long running step eventually does) and waits to be terminated. The
+memory is read from /proc/<pid>/smaps_rollup, hence this runs only on Linux.
+
+Usage:
+    PYTHONPATH=src python benchmarks/fork_memory_benchmark.py [<number of steps> [<heap size in objects>]]
+"""
+import gc
+import os
+import sys
+
+from time import sleep
+
+from autotrail.workflow.helpers.execution import ExceptionSafeSubProcessFunction, freeze_gc_on_fork
+
+
+def collect_and_wait():
+    """The step's function. Collect the garbage and wait to be terminated."""
+    gc.collect()
+    sleep(60)
+
+
+def read_memory(pid):
+    """Read the PSS and USS (in KiB) of the process with the given PID."""
+    memory = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as smaps:
+        for line in smaps:
+            key, _, value = line.partition(':')
+            if value.strip().endswith('kB'):
+                memory[key] = int(value.split()[0])
+    return memory['Pss'], memory['Private_Clean'] + memory['Private_Dirty']
+
+
+def benchmark(number_of_steps, settle_time=2):
+    """Run the steps concurrently and return the total PSS and USS (in MiB) of the steps and this process."""
+    steps = [ExceptionSafeSubProcessFunction(collect_and_wait) for _ in range(number_of_steps)]
+    for step in steps:
+        step.start()
+    try:
+        sleep(settle_time)
+        memory = [read_memory(pid) for pid in [os.getpid()] + [step.pid for step in steps]]
+    finally:
+        for step in steps:
+            step.terminate()
+            step.join()
+    return sum(pss for pss, _ in memory) / 1024, sum(uss for _, uss in memory) / 1024
+
+
+def main(number_of_steps=20, heap_size=200000):
+    heap = [{'step': n, 'output': ['message {}'.format(n)]} for n in range(heap_size)]  # noqa: F841
+    print('{:>8} {:>10} {:>12} {:>12}'.format('Steps', 'Freeze GC', 'PSS (MiB)', 'USS (MiB)'))
+    for freeze in (False, True):
+        freeze_gc_on_fork(freeze)
+        pss, uss = benchmark(number_of_steps)
+        print('{:>8} {:>10} {:>12.1f} {:>12.1f}'.format(number_of_steps, str(freeze), pss, uss))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -15,7 +15,10 @@
 """
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Manager, Pipe
+from multiprocessing.connection import wait
+from threading import Condition, Thread
 from time import sleep
 
 from autotrail.core.api.management import ConnectionServer, MethodAPIHandlerWrapper
@@ -50,17 +53,156 @@ class ActionCallback:
         raise NotImplementedError()
 
 
+class ObserverMode:
+    """Namespace for the ways in which observer callbacks (see ObserverCallback) can be run."""
+    SERIAL = 'Serial'           # Run in order along with the other callbacks.
+    CONCURRENT = 'Concurrent'   # Run concurrently with the other callbacks. The evaluation waits for them to finish.
+    BACKGROUND = 'Background'   # Handed off to a background worker. The evaluation doesn't wait for them.
+
+
+class ObserverCallback(ActionCallback):
+    """Marks an action callback as a pure observer i.e., a callback that never returns actions.
+
+    Since observers cannot affect the state machines, ChainActionCallbacks may run them concurrently with the other
+    callbacks. Any actions returned by the wrapped callback are ignored.
+    """
+    def __init__(self, callback):
+        """Define the callback that will be wrapped.
+
+        :param callback: An ActionCallback like callable.
+        """
+        self._callback = callback
+
+    def __str__(self):
+        return str(self._callback)
+
+    def __call__(self, states, transitions):
+        """Call the wrapped callback.
+
+        :param states:      As per the ActionCallback class specification.
+        :param transitions: As per the ActionCallback class specification.
+        :return:            None.
+        """
+        self._callback(states, transitions)
+
+
+class BackgroundObserverCallback(ObserverCallback):
+    """An observer callback that hands off the states and transitions to a background thread and returns immediately.
+
+    Only the latest snapshot of the states and transitions is kept. If the wrapped callback is slower than the
+    evaluations, the intermediate snapshots are dropped (latest snapshot wins).
+    Any exception raised by the wrapped callback is logged but not raised.
+
+    Call close when the evaluation ends. It waits for the pending snapshot to be handed to the wrapped callback before
+    stopping the background thread, so that the final states are never lost. Calls made after closing are run
+    synchronously.
+
+    The background thread and the condition shared with it are created on the first call, i.e., in the process running
+    the state machine evaluator. Neither can be pickled, which is needed to pass this to a process that isn't forked
+    (see workflow.helpers.execution.set_start_method).
+    """
+    def __init__(self, callback):
+        """Define the callback that will be wrapped.
+
+        :param callback: An ActionCallback like callable.
+        """
+        super(BackgroundObserverCallback, self).__init__(callback)
+        self._condition = None
+        self._snapshot = None
+        self._closed = False
+        self._thread = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._snapshot is None and not self._closed:
+                    self._condition.wait()
+                if self._snapshot is None:
+                    return
+                states, transitions = self._snapshot
+                self._snapshot = None
+
+            try:
+                self._callback(states, transitions)
+            except Exception as e:
+                logger.exception('Background observer callback {} failed with exception {}.'.format(
+                    self._callback, e))
+
+    def __call__(self, states, transitions):
+        """Hand off a copy of the states and transitions to the background thread.
+
+        :param states:      As per the ActionCallback class specification.
+        :param transitions: As per the ActionCallback class specification.
+        :return:            None.
+        """
+        if self._closed:
+            self._callback(states, transitions)
+            return
+
+        if self._thread is None:
+            self._condition = Condition()
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+        with self._condition:
+            self._snapshot = (dict(states), dict(transitions))
+            self._condition.notify_all()
+
+    def close(self):
+        """Wait for the pending snapshot (if any) to be handed to the wrapped callback and stop the background thread.
+
+        :return: None
+        """
+        if self._thread is None:
+            self._closed = True
+            return
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+
 class ChainActionCallbacks(ActionCallback):
     """A combiner for multiple ActionCallback callables."""
-    def __init__(self, callbacks):
+    def __init__(self, callbacks, concurrent_observers=False):
         """Define the list of callbacks that will be called in the passed order.
 
         Ordering of the callbacks is important. If more than one callback returns actions for the same state machine,
         the latest one takes precedence.
 
-        :param callbacks: An iterable of ActionCallback like callable objects.
+        :param callbacks:               An iterable of ActionCallback like callable objects.
+        :param concurrent_observers:    Boolean. When True, the callbacks that are ObserverCallback objects are run
+                                        concurrently (in a thread pool) with the rest of the callbacks. The
+                                        evaluation still waits for them to finish.
+                                        Otherwise, all callbacks are called in order.
         """
         self._callbacks = callbacks
+        self._concurrent_observers = concurrent_observers
+        self._executor = None
+
+    def _submit_observers(self, states, transitions):
+        observers = [callback for callback in self._callbacks if isinstance(callback, ObserverCallback)]
+        if not observers:
+            return []
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=len(observers))
+        return [(observer, self._executor.submit(observer, states, transitions)) for observer in observers]
+
+    def close(self):
+        """Shut down the thread pool running the observers (if any) and close the callbacks that have a close method
+        (e.g., BackgroundObserverCallback).
+
+        :return: None
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        for callback in self._callbacks:
+            close = getattr(callback, 'close', None)
+            if close is not None:
+                close()
 
     def __call__(self, states, transitions):
         """Calls each of the given callbacks in order and collates the returned actions together.
@@ -70,8 +212,14 @@ class ChainActionCallbacks(ActionCallback):
         :return:            Collated actions returned by each of the callbacks.
         :raises:            If any callable raises an exception, this callable logs and re-raises it.
         """
+        observer_futures = []
+        callbacks = self._callbacks
+        if self._concurrent_observers:
+            observer_futures = self._submit_observers(states, transitions)
+            callbacks = [callback for callback in self._callbacks if not isinstance(callback, ObserverCallback)]
+
         next_actions = {}
-        for callback in self._callbacks:
+        for callback in callbacks:
             try:
                 actions = callback(states, transitions) or {}
             except Exception as e:
@@ -83,6 +231,13 @@ class ChainActionCallbacks(ActionCallback):
 
             next_actions.update(actions)
 
+        for observer, future in observer_futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.exception('Observer callback {} failed with exception {}.'.format(observer, e))
+                raise
+
         if next_actions:
             logger.info('Actions collected from callbacks: {} are: {}'.format(self._callbacks, next_actions))
 
@@ -150,42 +305,133 @@ class DelayCallback(ActionCallback):
         sleep(self._delay)
 
 
+class AdaptiveDelayCallback(ActionCallback):
+    """An action callback that paces the state machine evaluations based on activity.
+
+    While the machines are active (actions are being taken or states have changed since the last call), this callback
+    returns immediately so that the machines are evaluated again without any delay.
+    While the machines are idle, it sleeps for a delay that starts at min_delay and is multiplied by backoff on every
+    idle call until it reaches max_delay.
+
+    If connections are given, an idle sleep is cut short as soon as any of them has data to be read (e.g., an API
+    request or an injected action). This is treated as activity.
+    """
+    def __init__(self, max_delay=1, min_delay=0.01, backoff=2, connections=None):
+        """Define the bounds of the delay and the rate at which it grows.
+
+        :param max_delay:   Float representing the ceiling of the delay in seconds.
+        :param min_delay:   Float representing the delay in seconds introduced on the first idle call after activity.
+        :param backoff:     The factor by which the delay is multiplied on every consecutive idle call.
+        :param connections: An iterable of multiprocessing.Connection like objects (supporting fileno()) whose
+                            readiness ends an idle sleep.
+        """
+        self._max_delay = max_delay
+        self._min_delay = min_delay
+        self._backoff = backoff
+        self._connections = list(connections or [])
+        self._delay = min_delay
+        self._last_states = None
+
+    def _sleep(self, delay):
+        """Sleep for the given delay or until any of the connections are ready.
+
+        :param delay:   Float representing seconds.
+        :return:        True if the sleep was cut short by a connection. False otherwise.
+        """
+        if self._connections:
+            return bool(wait(self._connections, timeout=delay))
+        sleep(delay)
+        return False
+
+    def __call__(self, states, transitions, actions=None):
+        """Sleep based on the activity of the machines.
+
+        :param states:      As per the ActionCallback class specification.
+        :param transitions: Ignored. Accepted to comply with the ActionCallback class specification.
+        :param actions:     The actions collected from other callbacks in this evaluation, if available. Any action is
+                            treated as activity.
+        :return:            None
+        """
+        active = bool(actions) or states != self._last_states
+        self._last_states = dict(states)
+
+        if active:
+            self._delay = self._min_delay
+        elif self._sleep(self._delay):
+            self._delay = self._min_delay
+        else:
+            self._delay = min(self._delay * self._backoff, self._max_delay)
+
+
 class StatesCallback(ActionCallback):
     """An action callback that stores the passed machine states in a multiprocessing.Manager shared dictionary.
 
     The shared dictionary can be accessed with the 'states' instance attribute.
+    The 'version' instance attribute is a multiprocessing.Manager shared integer value that is incremented every time
+    the states change. Readers can compare it with the version they last saw to know if the states have changed
+    without copying them.
+    The 'changes' instance attribute is a multiprocessing.Manager shared list of the states that changed in each
+    version, i.e., changes[i] is a dictionary of the states that changed in version i + 1. Readers can apply
+    changes[<version they last saw>:<latest version>] to their copy of the states instead of copying all of them.
     """
     def __init__(self):
-        """Initialize the shared dictionary."""
-        self.states = Manager().dict()
+        """Initialize the shared dictionary, list of changes and version."""
+        manager = Manager()
+        self.states = manager.dict()
+        self.changes = manager.list()
+        self.version = manager.Value('i', 0)
+        self._last_states = {}
 
     def __call__(self, states, transitions):
-        """Update the 'states' shared dictionary with the passed states.
+        """Update the 'states' shared dictionary with the passed states that have changed, record them in the
+        'changes' shared list and increment the version.
 
         :param states:      As per the ActionCallback class specification.
         :param transitions: Ignored. Accepted to comply with the ActionCallback class specification.
         :return:            None
         """
-        self.states.update(states)
+        changed_states = {name: state for name, state in states.items()
+                          if name not in self._last_states or self._last_states[name] != state}
+        if not changed_states:
+            return
+
+        self.states.update(changed_states)
+        self.changes.append(changed_states)
+        self._last_states.update(changed_states)
+        self.version.value += 1
 
 
 class TransitionsCallback(ActionCallback):
     """An action callback that stores the passed machine transitions in a multiprocessing.Manager shared dictionary.
 
     The shared dictionary can be accessed with the 'transitions' instance attribute.
+    The 'version' instance attribute is a multiprocessing.Manager shared integer value that is incremented every time
+    the transitions change (see StatesCallback). The transitions are recorded separately from the states, so readers
+    that use both need both versions.
     """
     def __init__(self):
-        """Initialize the shared dictionary."""
-        self.transitions = Manager().dict()
+        """Initialize the shared dictionary and version."""
+        manager = Manager()
+        self.transitions = manager.dict()
+        self.version = manager.Value('i', 0)
+        self._last_transitions = {}
 
     def __call__(self, states, transitions):
-        """Update the 'transitions' shared dictionary with the passed states.
+        """Update the 'transitions' shared dictionary with the passed transitions that have changed and increment the
+        version.
 
         :param states:      Ignored. Accepted to comply with the ActionCallback class specification.
         :param transitions: As per the ActionCallback class specification.
         :return:            None
         """
-        self.transitions.update(transitions)
+        changed_transitions = {name: actions for name, actions in transitions.items()
+                               if name not in self._last_transitions or self._last_transitions[name] != actions}
+        if not changed_transitions:
+            return
+
+        self.transitions.update(changed_transitions)
+        self._last_transitions.update(changed_transitions)
+        self.version.value += 1
 
 
 class AutomatedActionCallback(ActionCallback):
@@ -258,10 +504,13 @@ class InjectedActionCallback(ActionCallback):
 
     If an action that is not possible/available for a machine is injected, it will have no
     effect and will be ignored.
+
+    The endpoint the actions are read from is the 'actions_reader' instance attribute (a read-only
+    multiprocessing.Connection), e.g., to wait for actions to be injected.
     """
     def __init__(self):
         """Initialize the multiprocessing.Pipe endpoints to receive actions."""
-        self._actions_reader, self.actions_writer = Pipe(duplex=False)
+        self.actions_reader, self.actions_writer = Pipe(duplex=False)
 
     def __call__(self, states, transitions):
         """Read actions from the multiprocessing.Pipe endpoint and return them per the ActionCallback class
@@ -272,9 +521,9 @@ class InjectedActionCallback(ActionCallback):
         :return:            As per the ActionCallback class specification.
         """
         next_actions = {}
-        if self._actions_reader.poll():
+        if self.actions_reader.poll():
             try:
-                next_actions = self._actions_reader.recv()
+                next_actions = self.actions_reader.recv()
             except EOFError:
                 pass
 
@@ -286,8 +535,16 @@ class ManagedCallback(ActionCallback):
 
     The following instance attributes are available:
     states:                            Store the machine states in a multiprocessing.Manager shared dictionary.
+    states_version:                    A multiprocessing.Manager shared integer value that is incremented every
+                                        time the machine states change.
+    states_changes:                    A multiprocessing.Manager shared list of the machine states that changed in
+                                        each version (see StatesCallback).
     transitions:                       Store the machine transitions available/possible in a
                                         multiprocessing.Manager shared dictionary.
+    transitions_version:               A multiprocessing.Manager shared integer value that is incremented every
+                                        time the machine transitions change.
+    context_serializer:                The context serializer passed (if any). Readers can use its snapshot()
+                                        method to get a copy of the serialized context.
     api_client_connection:             The connection object used to send and receive API requests.
     actions_writer:                    Write-only multiprocessing.Connection object that expects messages
                                         representing actions in the following form:
@@ -307,7 +564,7 @@ class ManagedCallback(ActionCallback):
     """
     def __init__(self, api_handler, machine_action_definitions, machine_name_to_object_mapping, context=None,
                  machine_serializer=None, context_serializer=None, delay=1, final_callback_function=None,
-                 api_server_timeout=1):
+                 api_server_timeout=1, adaptive_delay=False, observer_mode=ObserverMode.SERIAL):
         """Define the resources required to set up a standard set of action callbacks.
 
         If the parameters required to setup an action callback is not passed, then it is not included.
@@ -362,6 +619,7 @@ class ManagedCallback(ActionCallback):
         :param delay:                           Introduce a delay in the loop of the state machine evaluations.
                                                 This delay affects how frequently callbacks are called.
                                                 An float. Defaults to 1 second.
+                                                When adaptive_delay is True, this is the ceiling of the delay.
         :param final_callback_function:         Function to execute when the final states are reached, i.e., no further
                                                 actions are available or possible. This needs to be a callable that
                                                 accepts the machine states of the form:
@@ -372,27 +630,50 @@ class ManagedCallback(ActionCallback):
                                                 The return value of this function is ignored.
         :param api_server_timeout:              The timeout in seconds (float) the API server will wait to receive and
                                                 serve requests.
+                                                Ignored when adaptive_delay is True, since the delay is cut short as
+                                                soon as a request arrives.
+        :param adaptive_delay:                  Boolean. When True, the delay is introduced by an AdaptiveDelayCallback
+                                                i.e., the machines are evaluated without delay while actions are being
+                                                taken and the delay backs off up to the given delay while they are idle.
+        :param observer_mode:                   A value from the ObserverMode namespace deciding how the callbacks that
+                                                only observe the machines (recording states and transitions and
+                                                serializing the machines and context) are run.
+                                                ObserverMode.SERIAL: In order with the other callbacks (default).
+                                                ObserverMode.CONCURRENT: Concurrently with the other callbacks.
+                                                ObserverMode.BACKGROUND: Handed off to background workers, only the
+                                                latest snapshot is recorded/serialized.
         """
+        if observer_mode == ObserverMode.BACKGROUND:
+            make_observer = BackgroundObserverCallback
+        elif observer_mode == ObserverMode.CONCURRENT:
+            make_observer = ObserverCallback
+        else:
+            make_observer = lambda callback: callback
+
         callbacks = [AutomatedActionCallback(machine_name_to_object_mapping, context, machine_action_definitions)]
 
         self._states_callback = StatesCallback()
-        callbacks.append(self._states_callback)
+        callbacks.append(make_observer(self._states_callback))
         self.states = self._states_callback.states
+        self.states_version = self._states_callback.version
+        self.states_changes = self._states_callback.changes
 
         self._transitions_callback = TransitionsCallback()
-        callbacks.append(self._transitions_callback)
+        callbacks.append(make_observer(self._transitions_callback))
         self.transitions = self._transitions_callback.transitions
+        self.transitions_version = self._transitions_callback.version
 
         self.machines_serialized = None
         if machine_serializer is not None:
             self._machines_serializer_callback = SimpleCallback(machine_serializer)
-            callbacks.append(self._machines_serializer_callback)
+            callbacks.append(make_observer(self._machines_serializer_callback))
             self.machines_serialized = machine_serializer.serialized
 
+        self.context_serializer = context_serializer
         self.context_serialized = None
         if context_serializer is not None:
             self._context_serializer_callback = SimpleCallback(context_serializer)
-            callbacks.append(self._context_serializer_callback)
+            callbacks.append(make_observer(self._context_serializer_callback))
             self.context_serialized = context_serializer.serialized
 
         self._injected_action_callback = InjectedActionCallback()
@@ -402,16 +683,23 @@ class ManagedCallback(ActionCallback):
         self.api_client_connection, self._server_connection = Pipe(duplex=True)
         self._api_callback = ConnectionServer(MethodAPIHandlerWrapper(api_handler),
                                               self._server_connection,
-                                              timeout=api_server_timeout)
+                                              timeout=0 if adaptive_delay else api_server_timeout)
         callbacks.append(self._api_callback)
 
         if final_callback_function is not None:
             callbacks.append(FinalCallback(final_callback_function))
 
+        self._adaptive_delay_callback = None
         if delay is not None:
-            callbacks.append(DelayCallback(delay))
+            if adaptive_delay:
+                self._adaptive_delay_callback = AdaptiveDelayCallback(
+                    max_delay=delay, connections=[self._server_connection,
+                                                  self._injected_action_callback.actions_reader])
+            else:
+                callbacks.append(DelayCallback(delay))
 
-        self._action_callback = ChainActionCallbacks(callbacks)
+        self._action_callback = ChainActionCallbacks(callbacks,
+                                                     concurrent_observers=(observer_mode == ObserverMode.CONCURRENT))
 
     def __call__(self, states, transitions):
         """Call the defined callbacks and return the collated actions from all of them.
@@ -422,19 +710,34 @@ class ManagedCallback(ActionCallback):
         3. Record machine transitions:  Store the machine transitions available/possible in a multiprocessing.Manager
         4. Serialize machine objects:   To serialize the machine objects to some medium. (Optional)
         5. Serialize context object:    To serialize the context object to some medium. (Optional)
+        Callbacks 2-5 are observers and may run concurrently or in the background depending on the observer_mode.
         6. Injected actions:            Ability to inject actions into the state machines.
         7. API server:                  Run a multiprocessing.Pipe based server to facilitate API calls.
         8. Final callback:              Function to execute when the final states are reached, i.e., no further actions
                                         are available or possible. (Optional)
         9. Delay:                       Introduce a delay in the loop of the state machine evaluations. This delay
                                         affects how frequently callbacks are called. (Optional)
+                                        With adaptive_delay, the delay is introduced after the collated actions are
+                                        known, so that there is no delay while actions are being taken.
 
         :param states:      As per the ActionCallback class specification.
         :param transitions: As per the ActionCallback class specification.
         :return:            As per the ActionCallback class specification, the actions returned by all the callbacks
                             are collated and returned.
         """
-        return self._action_callback(states, transitions)
+        actions = self._action_callback(states, transitions)
+        if self._adaptive_delay_callback is not None:
+            self._adaptive_delay_callback(states, transitions, actions)
+        return actions
+
+    def close(self):
+        """Release the resources of the callbacks once the evaluation ends (see
+        core.state_machine.state_machine_evaluator), i.e., shut down the threads running the observers after they have
+        recorded the final states.
+
+        :return: None
+        """
+        self._action_callback.close()
 
 
 def attempt_actions_for_machine(machine_action_definition, machine, context, actions):
@@ -14,24 +14,47 @@
 
 """
 import logging
+import os
+import zlib
 
-from multiprocessing.connection import Listener, Client
-from time import sleep
+from collections import deque
+from multiprocessing import AuthenticationError
+from multiprocessing.reduction import ForkingPickler
+from multiprocessing.connection import (Listener, Client, address_type, answer_challenge, deliver_challenge,
+                                        wait)
+from threading import BoundedSemaphore, Condition, Event, Lock, Thread
 
 
 logger = logging.getLogger(__name__)
 
 
-def read_message(connection, timeout=0.1):
+def send_message(connection, message, codec=None):
+    """Send a single message over the given multiprocessing.Connection object.
+
+    :param connection:  A multiprocessing.Connection like object that supports send() and send_bytes() methods.
+    :param message:     The message to send.
+    :param codec:       The codec (see PickleCodec) used to encode the message. None means it is sent as-is.
+    :return:            None
+    """
+    if codec is None:
+        connection.send(message)
+    else:
+        connection.send_bytes(codec.encode(message))
+
+
+def read_message(connection, timeout=0.1, codec=None):
     """Attempt to read a single message from the given multiprocessing.Connection object.
 
     :param connection: A multiprocessing.Connection like object that supports poll(<timeout>) and recv() methods.
     :param timeout:    The timeout (in seconds) while waiting for messages.
+    :param codec:      The codec (see PickleCodec) used to decode the message. None means it is received as-is.
     :return:           The message received from the connection.
     """
     if connection.poll(timeout):
         try:
-            return connection.recv()
+            if codec is None:
+                return connection.recv()
+            return codec.decode(connection.recv_bytes())
         except EOFError:
             pass
 
@@ -51,6 +74,51 @@ def read_messages(connection, timeout=0.1):
             break
 
 
+def read_ready_messages(connections, timeout=0):
+    """Read all the messages available in the given multiprocessing.Connection objects with a single wait.
+
+    Only the connections that are ready are read, and each of them is drained without blocking. Therefore, the cost of
+    this call depends on the number of messages available and not the number of connections.
+
+    :param connections: An iterable of multiprocessing.Connection like objects that support fileno(), poll(<timeout>)
+                        and recv() methods.
+    :param timeout:     The timeout (in seconds) to wait for any of the connections to be ready. Defaults to 0, i.e.,
+                        no waiting.
+    :return:            A dictionary of the form:
+                        {
+                            <connection>: [<message 1>, <message 2>, ...],
+                            ...
+                        }
+                        Only the connections from which messages were read are present.
+    """
+    connections = list(connections)
+    if not connections:
+        return {}
+
+    messages = {}
+    for connection in wait(connections, timeout):
+        connection_messages = []
+        while connection.poll(0):
+            try:
+                connection_messages.append(connection.recv())
+            except EOFError:
+                break
+        if connection_messages:
+            messages[connection] = connection_messages
+    return messages
+
+
+def make_client_connection(address, authkey=None):
+    """Connect to a server listening at the given address.
+
+    :param address: A Unix socket file (str) or a TCP address of the form: (<host (str)>, <port (int)>).
+    :param authkey: The secret key (bytes) shared with the server to authenticate the connection. None means the
+                    connection is not authenticated.
+    :return:        A multiprocessing.Connection object.
+    """
+    return Client(address=address, family=address_type(address), authkey=authkey)
+
+
 def send_messages(connection, messages):
     """Send messages to the given connection.
 
@@ -85,6 +153,59 @@ class APIRequest:
         return str(repr(self))
 
 
+class APIBatchRequest:
+    """API request object containing a sequence of APIRequest objects that are served in order as a single request."""
+    def __init__(self, requests, stop_on_error=False):
+        """Define the requests to be served.
+
+        :param requests:        A sequence of APIRequest objects.
+        :param stop_on_error:   When True, the requests following the first request that results in an exception are
+                                not served.
+        """
+        self.requests = list(requests)
+        self.stop_on_error = stop_on_error
+
+    def __repr__(self):
+        return 'APIBatchRequest({requests}, stop_on_error={stop_on_error})'.format(
+            requests=self.requests, stop_on_error=self.stop_on_error)
+
+    def __str__(self):
+        return str(repr(self))
+
+
+def collate_relay_values(relay_values):
+    """Collate the relay values of multiple APIHandlerResponse objects into a single relay value.
+
+    :param relay_values:    An iterable of relay values.
+    :return:                None if all the relay values are None.
+                            SocketServer.SHUTDOWN if any of the relay values is SocketServer.SHUTDOWN, so that a
+                            request to shutdown the server is never lost.
+                            A dictionary updated with all the dictionary relay values in order, if there are no other
+                            relay values.
+                            Otherwise, the last relay value that is neither None nor a dictionary (e.g., a
+                            Subscription). The dictionary relay values are then dropped and a warning is logged.
+    """
+    collated = None
+    other_relay_values = []
+    for relay_value in relay_values:
+        if relay_value is None:
+            continue
+        if isinstance(relay_value, dict):
+            collated = {} if collated is None else collated
+            collated.update(relay_value)
+        elif relay_value == SocketServer.SHUTDOWN:
+            return SocketServer.SHUTDOWN
+        else:
+            other_relay_values.append(relay_value)
+
+    if not other_relay_values:
+        return collated
+
+    if collated is not None:
+        logger.warning('Dropping the relay values {} collated with {}.'.format(collated, other_relay_values[-1]))
+    return other_relay_values[-1]
+
+
 class APIResponse:
     """Response to an API call. This is the response object sent to the requester of the API call.
 
@@ -139,11 +260,291 @@ class APIHandlerResponse:
         return str(repr(self))
 
 
+class Subscription:
+    """A bounded queue of events to be streamed to a subscriber.
+
+    A handler returns a Subscription as the relay_value of an APIHandlerResponse to have the SocketServer stream the
+    events put into it over the same connection (after the response has been sent) until the subscriber disconnects or
+    the server is shutdown. Events are sent as lists, each containing all the events that were queued.
+
+    The queue is bounded so that a slow subscriber cannot consume an unbounded amount of memory. When the queue is full,
+    new events are dropped and counted. The subscriber then receives an event of the form:
+        {'type': Subscription.OVERFLOW, 'dropped': <Number of events dropped (int)>}
+    in place of the events dropped, so that it can recover, e.g., by fetching the full status.
+    """
+
+    OVERFLOW = 'Overflow'   # The type of the event that replaces dropped events.
+
+    def __init__(self, size=1000):
+        """Define the size of the queue.
+
+        :param size:    The maximum number of events (int) that are queued for the subscriber.
+        """
+        self._size = size
+        self._events = deque()
+        self._dropped = 0
+        self._condition = Condition()
+        self.closed = False
+
+    def put(self, events):
+        """Queue the given events to be sent to the subscriber.
+
+        :param events:  An iterable of events. Each event is any object that can be sent over a connection.
+        :return:        False if the subscription is closed and the events were discarded. True otherwise.
+        """
+        with self._condition:
+            if self.closed:
+                return False
+
+            for event in events:
+                if len(self._events) < self._size:
+                    self._events.append(event)
+                else:
+                    self._dropped += 1
+            self._condition.notify_all()
+        return True
+
+    def get(self, timeout=None):
+        """Get all the queued events, waiting for the given timeout if none are queued.
+
+        :param timeout: The amount of time in seconds to wait for events. None means wait until events are queued or
+                        the subscription is closed.
+        :return:        A list of events, which is empty if none were queued within the timeout.
+        """
+        with self._condition:
+            if not self._events and not self._dropped and not self.closed:
+                self._condition.wait(timeout)
+
+            events = list(self._events)
+            self._events.clear()
+            if self._dropped:
+                events.append({'type': self.OVERFLOW, 'dropped': self._dropped})
+                self._dropped = 0
+        return events
+
+    def close(self):
+        """Close the subscription. Any events put after this are discarded."""
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class PickleCodec:
+    """The default codec used to encode messages into bytes and decode them. Messages are pickled exactly as
+    multiprocessing.Connection.send does, i.e., the wire format is the same as when no codec is used.
+
+    A codec is an object with the following methods:
+        encode(<message>) -> <bytes>
+        decode(<bytes>) -> <message>
+        detect(<bytes>) -> A codec object that can decode the bytes (and should be used to encode the reply), or None
+                           if the bytes were not encoded by this type of codec. This is a classmethod.
+    """
+    def encode(self, message):
+        return bytes(ForkingPickler.dumps(message))
+
+    def decode(self, data):
+        return ForkingPickler.loads(data)
+
+    @classmethod
+    def detect(cls, data):
+        return cls()
+
+
+class _Table:
+    """A table of rows that have the same fields. Used by CompactCodec to send the field names once."""
+    def __init__(self, row_keys, fields, columns):
+        self.row_keys = row_keys
+        self.fields = fields
+        self.columns = columns
+
+
+def _get_table_fields(rows):
+    """Return the field names (list) shared by all the rows (dictionaries), or None if the rows can't form a table."""
+    if len(rows) < 2 or type(rows[0]) is not dict or not rows[0]:
+        return None
+    fields = rows[0].keys()
+    if all(type(row) is dict and row.keys() == fields for row in rows):
+        return list(fields)
+
+
+def compact(message):
+    """Compact a message by replacing dictionaries (or lists) of dictionaries that have the same keys with tables
+    containing the keys once followed by the values of each key (columns). APIResponse and APIRequest objects are
+    compacted by compacting their attributes.
+
+    :param message: The message to compact.
+    :return:        The compacted message, which can be restored with expand().
+    """
+    if isinstance(message, APIResponse):
+        return APIResponse(compact(message.return_value), message.exception)
+    if isinstance(message, APIRequest):
+        return APIRequest(message.method, compact(message.args), compact(message.kwargs))
+    if isinstance(message, APIBatchRequest):
+        return APIBatchRequest([compact(request) for request in message.requests], message.stop_on_error)
+    if type(message) is list:
+        fields = _get_table_fields(message)
+        if fields is not None:
+            return _Table(None, fields, [compact([row[field] for row in message]) for field in fields])
+        return _compact_values(message)
+    if type(message) is tuple:
+        return tuple(_compact_values(message))
+    if type(message) is dict:
+        rows = list(message.values())
+        fields = _get_table_fields(rows)
+        if fields is not None:
+            return _Table(list(message), fields, [compact([row[field] for row in rows]) for field in fields])
+        return dict(zip(message, _compact_values(rows)))
+    return message
+
+
+def _compact_values(values):
+    # Most values (e.g., the states of the steps) are not compound, which needn't be compacted one by one.
+    if not any(type(value) in _COMPOUND_TYPES for value in values):
+        return values
+    return [compact(value) for value in values]
+
+
+def expand(message):
+    """Restore a message compacted by compact().
+
+    :param message: The compacted message.
+    :return:        The original message.
+    """
+    if isinstance(message, _Table):
+        columns = [expand(column) for column in message.columns]
+        rows = [dict(zip(message.fields, values)) for values in zip(*columns)]
+        return rows if message.row_keys is None else dict(zip(message.row_keys, rows))
+    if isinstance(message, APIResponse):
+        return APIResponse(expand(message.return_value), message.exception)
+    if isinstance(message, APIRequest):
+        return APIRequest(message.method, expand(message.args), expand(message.kwargs))
+    if isinstance(message, APIBatchRequest):
+        return APIBatchRequest([expand(request) for request in message.requests], message.stop_on_error)
+    if type(message) in (list, tuple):
+        return type(message)(_expand_values(message))
+    if type(message) is dict:
+        return dict(zip(message, _expand_values(list(message.values()))))
+    return message
+
+
+def _expand_values(values):
+    if not any(type(value) in _COMPOUND_TYPES or type(value) is _Table for value in values):
+        return values
+    return [expand(value) for value in values]
+
+
+class CompactCodec:
+    """A codec (see PickleCodec) that sends nested structures like the status of a workflow compactly.
+
+    Dictionaries (or lists) of dictionaries with the same keys (e.g., the status of each step) are sent as tables,
+    i.e., the keys are sent once followed by the values of each key (see compact()). The result is pickled and
+    optionally compressed with zlib.
+
+    Encoded messages start with CompactCodec.MAGIC followed by a byte of flags, so that servers can detect the codec
+    used by a client and reply in kind.
+    """
+
+    MAGIC = b'ATC\x01'
+    COMPRESSED = 1      # Flag set when the payload is compressed.
+    COMPRESSION = 2     # Flag set when the sender uses compression, asking for compressed replies.
+
+    def __init__(self, compress=False, level=6, min_compress_size=1024):
+        """Define the compression.
+
+        :param compress:            Boolean. When True, payloads of at least min_compress_size bytes are compressed.
+        :param level:               The zlib compression level (int).
+        :param min_compress_size:   The minimum size of a payload (bytes) to compress.
+        """
+        self.compress = compress
+        self.level = level
+        self.min_compress_size = min_compress_size
+
+    def encode(self, message):
+        payload = ForkingPickler.dumps(compact(message))
+        flags = self.COMPRESSION if self.compress else 0
+        if self.compress and len(payload) >= self.min_compress_size:
+            payload = zlib.compress(payload, self.level)
+            flags |= self.COMPRESSED
+        return self.MAGIC + bytes([flags]) + bytes(payload)
+
+    def decode(self, data):
+        if not data.startswith(self.MAGIC):
+            raise ValueError('Data was not encoded by {}.'.format(type(self).__name__))
+        flags = data[len(self.MAGIC)]
+        payload = data[len(self.MAGIC) + 1:]
+        if flags & self.COMPRESSED:
+            payload = zlib.decompress(payload)
+        return expand(ForkingPickler.loads(payload))
+
+    @classmethod
+    def detect(cls, data):
+        if data.startswith(cls.MAGIC):
+            return cls(compress=bool(data[len(cls.MAGIC)] & cls.COMPRESSION))
+
+
+_COMPOUND_TYPES = {list, tuple, dict, APIResponse, APIRequest, APIBatchRequest}
+
+DEFAULT_CODECS = (CompactCodec, PickleCodec)    # The codecs detected by default, in order.
+
+
+def detect_codec(data, codecs=DEFAULT_CODECS):
+    """Detect the codec that encoded the given data.
+
+    :param data:    The encoded message (bytes).
+    :param codecs:  The codec classes to try in order. See PickleCodec for the definition of a codec.
+    :return:        The codec object returned by the first codec class that detects the data. None if none of them do.
+    """
+    for codec in codecs:
+        detected_codec = codec.detect(data)
+        if detected_codec is not None:
+            return detected_codec
+
+
+class DeferredResponse:
+    """A response that is computed after the handler returns, so that it can wait (e.g., for a condition to hold)
+    without blocking other requests from being handled.
+
+    A handler returns a DeferredResponse as the relay_value of an APIHandlerResponse. The server then calls it outside
+    the handler (and any lock held while handling requests) and sends the APIHandlerResponse it returns instead.
+    """
+    def __init__(self, function, *args, **kwargs):
+        """Define the function that computes the response.
+
+        :param function:    A callable that returns an APIHandlerResponse or similar object. It is called with the given
+                            args and kwargs. It must be safe to call it concurrently with the handler.
+        :param args:        Passed as-is to the function.
+        :param kwargs:      Passed as-is to the function.
+        """
+        self._function = function
+        self._args = args
+        self._kwargs = kwargs
+
+    def __call__(self):
+        """Compute the response.
+
+        :return:    The APIHandlerResponse returned by the function.
+                    If the function raises an exception, the following APIHandlerResponse object will be returned:
+                        APIHandlerResponse(None, <exception raised>, None)
+        """
+        try:
+            return self._function(*self._args, **self._kwargs)
+        except Exception as e:
+            logger.exception('Deferred response failed with the exception {} with the message: {}'.format(type(e), e))
+            return APIHandlerResponse(None, e)
+
+    def __repr__(self):
+        return 'DeferredResponse({function}, {args}, {kwargs})'.format(
+            function=self._function, args=self._args, kwargs=self._kwargs)
+
+    def __str__(self):
+        return str(repr(self))
+
+
 class ConnectionServer:
     """A single request API server callable that communicates using the given multiprocessing.Connection object by
     invoking the given handler.
     """
-    def __init__(self, handler, connection, timeout=0.1):
+    def __init__(self, handler, connection, timeout=0.1, defer=False, codec=None):
         """Define the connection over which requests will be served and the handler used to process the requests.
 
         :param handler:     A callable that must:
@@ -157,10 +558,18 @@ class ConnectionServer:
                             attributes from the received APIHandlerResponse object. This APIResponse object will be
                             sent using the given connection.
         :param timeout:     The timeout (in seconds) while waiting for requests.
+        :param defer:       When True, a DeferredResponse relayed by the handler is returned without sending a response,
+                            and the caller is responsible for calling it and sending its response using send().
+                            When False, it is called immediately and its response is sent.
+        :param codec:       The codec (see PickleCodec) used to decode requests and encode responses. None means they
+                            are sent and received as-is. The 'codec' attribute can be changed to reply to each request
+                            in kind.
         """
         self._handler = handler
         self._connection = connection
         self._timeout = timeout
+        self._defer = defer
+        self.codec = codec
 
     def __call__(self, *args, **kwargs):
         """This callable will serve a single request by calling the handler, sending the response and returning the
@@ -181,11 +590,27 @@ class ConnectionServer:
         :return:        None, if no request is received.
                         The relay_value attribute from the APIHandlerResponse object returned by the handler.
         """
-        request = read_message(self._connection, self._timeout)
+        request = read_message(self._connection, self._timeout, codec=self.codec)
         logger.debug('Received request: {}'.format(request))
         if not request:
             return
 
+        return self.serve(request, *args, **kwargs)
+
+    def serve(self, request, *args, **kwargs):
+        """Serve a request that has already been received by calling the handler, sending the response and returning
+        the relay value.
+
+        See __call__ for the details of how the handler is called and the response is sent.
+
+        :param request: The request received from the connection.
+        :param args:    Passed along with the request to the handler. The request will be the first parameter.
+        :param kwargs:  Passed as-is to the handler.
+        :return:        The relay_value attribute from the APIHandlerResponse object returned by the handler.
+                        None if the handler raises an exception.
+                        If the relay_value is a DeferredResponse and defer is True, no response is sent and the
+                        DeferredResponse is returned.
+        """
         try:
             handler_response = self._handler(request, *args, **kwargs)
         except Exception as e:
@@ -193,16 +618,32 @@ class ConnectionServer:
                               'due to error={}').format(self._handler, request, args, kwargs, e))
             return
 
+        if isinstance(handler_response.relay_value, DeferredResponse):
+            if not self._defer:
+                handler_response = handler_response.relay_value()
+            else:
+                logger.debug('Deferring response: {}'.format(handler_response.relay_value))
+                return handler_response.relay_value
+
+        self.send(handler_response)
+        logger.debug('Returning response: {}'.format(handler_response.relay_value))
+        return handler_response.relay_value
+
+    def send(self, handler_response):
+        """Send the APIResponse for the given APIHandlerResponse (or similar object) over the connection.
+
+        If the connection is closed, it will be ignored.
+
+        :param handler_response:    An APIHandlerResponse or similar object.
+        :return:                    None
+        """
         api_response = APIResponse(handler_response.return_value, handler_response.exception)
         try:
             logger.debug('Sending response: {}'.format(api_response))
-            self._connection.send(api_response)
+            send_message(self._connection, api_response, codec=self.codec)
         except IOError:
             pass
 
-        logger.debug('Returning response: {}'.format(handler_response.relay_value))
-        return handler_response.relay_value
-
     def __del__(self):
         try:
             self._connection.close()
@@ -212,12 +653,15 @@ class ConnectionServer:
 
 class ConnectionClient:
     """Client to send requests and receive responses using a multiprocessing.Connection object."""
-    def __init__(self, connection):
+    def __init__(self, connection, codec=None):
         """Define the connection to be used for API communication.
 
         :param connection:  A multiprocessing.Connection like object that supports poll(<timeout>) and recv() methods.
+        :param codec:       The codec (see PickleCodec) used to encode requests and decode responses. None means they
+                            are sent and received as-is.
         """
         self._connection = connection
+        self._codec = codec
 
     def __call__(self, request, timeout=1):
         """Sends the passed request using the given connection object and returns the response.
@@ -226,35 +670,161 @@ class ConnectionClient:
         :param timeout: The timeout (in seconds) while waiting for requests.
         :return:        The response received.
         """
-        self._connection.send(request)
-        response = read_message(self._connection, timeout)
+        send_message(self._connection, request, codec=self._codec)
+        response = read_message(self._connection, timeout, codec=self._codec)
         return response
 
 
 class SocketServer:
-    """Serve API calls through a Unix socket file using ConnectionServer until signalled to shutdown.
+    """Serve API calls through a Unix socket file (or a TCP address) until signalled to shutdown.
+
+    Many clients are served concurrently, each connection in its own thread. A connection is kept open and any number
+    of requests can be sent over it. The handler is never called concurrently, i.e., requests are handled one at a
+    time in the order they are received, while waiting for connections and requests happens concurrently.
 
     When the handler returns an APIHandlerResponse (or similar object) with a relay_value of SocketServer.SHUTDOWN, it
     signals the server to stop serving any more requests.
+
+    When the handler returns an APIHandlerResponse (or similar object) with a Subscription as the relay_value, the
+    connection is used to stream the events of the subscription instead of serving any more requests.
+
+    When the handler returns an APIHandlerResponse (or similar object) with a DeferredResponse as the relay_value, it is
+    called without holding the handler, so that other requests continue to be handled while it waits.
     """
 
     SHUTDOWN = 'Shutdown Server'    # Signal to shutdown server.
 
-    def __init__(self, socket_file, handler, delay=1, timeout=1):
+    def __init__(self, socket_file, handler, delay=1, timeout=1, idle_timeout=None, authkey=None,
+                 codecs=DEFAULT_CODECS):
         """
 
-        :param socket_file: A Unix socket file that will be used to communicate.
-        :param handler:     A callable that is called with requests read from the socket. It is called with the request
-                            as the only parameter. The handler must return a APIHandlerResponse or similar object.
-                            If the APIHandlerResponse object's relay_value is SocketServer.SHUTDOWN, the server will
-                            stop serving any more requests and close communications at the socket.
-        :param delay:       The delay between serving API requests in seconds.
-        :param timeout:     The amount of time in seconds to wait for a request once a connection has been accepted.
+        :param socket_file:     A Unix socket file that will be used to communicate. Or, a TCP address of the form:
+                                (<host (str)>, <port (int)>).
+        :param handler:         A callable that is called with requests read from the socket. It is called with the
+                                request as the only parameter. The handler must return a APIHandlerResponse or similar
+                                object.
+                                If the APIHandlerResponse object's relay_value is SocketServer.SHUTDOWN, the server will
+                                stop serving any more requests and close communications at the socket.
+        :param delay:           Not used. Requests are served as soon as they are received. Accepted for backwards
+                                compatibility.
+        :param timeout:         The amount of time in seconds to wait for the first request once a connection has been
+                                accepted.
+        :param idle_timeout:    The amount of time in seconds a connection may remain idle between requests before it
+                                is closed. None means the connection is kept open until the client closes it.
+        :param authkey:         The secret key (bytes) that clients need to authenticate with. Connections that fail to
+                                authenticate are closed. None means connections are not authenticated, which is
+                                allowed only for Unix socket files.
+        :param codecs:          The codec classes (see PickleCodec) that requests may be encoded with. The codec of each
+                                request is detected (see detect_codec) and its response is encoded with the same codec.
+        :raises:                ValueError if a TCP address is given without an authkey.
         """
+        if address_type(socket_file) != 'AF_UNIX' and authkey is None:
+            raise ValueError('An authkey is required to serve API calls at the TCP address: {}'.format(socket_file))
+
         self._socket_file = socket_file
+        self._authkey = authkey
         self._handler = handler
         self._delay = delay
         self._timeout = timeout
+        self._idle_timeout = idle_timeout
+        self._codecs = codecs
+        self._handler_lock = None
+        self._shutdown = None
+
+    def _authenticate(self, connection):
+        """Authenticate the connection with the authkey (if any) in the same way as multiprocessing.connection.Listener.
+
+        :return:    True if the connection is authenticated. False otherwise.
+        """
+        if self._authkey is None:
+            return True
+
+        try:
+            deliver_challenge(connection, self._authkey)
+            answer_challenge(connection, self._authkey)
+        except (AuthenticationError, EOFError, OSError) as e:
+            logger.warning('Unable to authenticate a connection. Error: {}'.format(e))
+            return False
+        return True
+
+    def _serve_connection(self, connection, args, kwargs):
+        """Serve the requests received over a connection until it is closed, idle or the server is shutdown."""
+        if not self._authenticate(connection):
+            connection.close()
+            return
+
+        server = ConnectionServer(self._handler, connection, defer=True)
+        timeout = self._timeout
+        try:
+            while not self._shutdown.is_set() and connection.poll(timeout):
+                try:
+                    data = connection.recv_bytes()
+                except (EOFError, OSError):
+                    break
+                server.codec = detect_codec(data, self._codecs)
+                if server.codec is None:
+                    logger.warning('Unable to detect the codec of a request. Closing the connection.')
+                    break
+                try:
+                    request = server.codec.decode(data)
+                except Exception as e:
+                    # Truncated or malformed data (e.g., encoded with another codec) can raise any error.
+                    logger.warning('Unable to decode a request. Closing the connection. Error: {}'.format(e))
+                    server.send(APIHandlerResponse(None, exception=ValueError(
+                        'Unable to decode the request: {}'.format(e))))
+                    break
+                logger.debug('Received request: {}'.format(request))
+                timeout = self._idle_timeout
+
+                with self._handler_lock:
+                    if self._shutdown.is_set():
+                        break
+                    relay_value = server.serve(request, *args, **kwargs)
+                    if relay_value == self.SHUTDOWN:
+                        logger.info('Received signal to shutdown server. Shutting down.')
+                        self._shutdown.set()
+
+                if isinstance(relay_value, DeferredResponse):
+                    server.send(relay_value())
+                elif isinstance(relay_value, Subscription):
+                    self._stream(connection, relay_value, server.codec)
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+
+    def _stream(self, connection, subscription, codec):
+        """Send the events of the subscription over the connection until the subscriber disconnects or the server is
+        shutdown. The subscription is closed once streaming stops."""
+        try:
+            while not self._shutdown.is_set() and not subscription.closed:
+                events = subscription.get(timeout=self._timeout)
+                # Subscribers don't send anything, so the connection being readable means that it has been closed.
+                if connection.poll(0):
+                    break
+                if events:
+                    send_message(connection, events, codec=codec)
+        except (EOFError, OSError):
+            pass
+        finally:
+            subscription.close()
+
+    def _accept_connections(self, listener, args, kwargs):
+        """Accept connections and serve each of them in a separate thread until the server is shutdown."""
+        while not self._shutdown.is_set():
+            try:
+                connection = listener.accept()
+            except Exception as e:
+                if self._shutdown.is_set():
+                    break
+                logger.exception('Unable to accept a connection. Error: {}'.format(e))
+                continue
+
+            if self._shutdown.is_set():
+                connection.close()
+                break
+            Thread(target=self._serve_connection, args=(connection, args, kwargs), daemon=True).start()
 
     def __call__(self, *args, **kwargs):
         """Start the server loop. Serve requests until signalled to stop.
@@ -265,20 +835,31 @@ class SocketServer:
                         SocketServer.SHUTDOWN.
         """
         try:
-            listener = Listener(address=self._socket_file, family='AF_UNIX')
-            logger.debug('Created listener for socket file: {}'.format(self._socket_file))
+            # Connections are authenticated in their own threads, so that a slow client doesn't block the others.
+            listener = Listener(address=self._socket_file, family=address_type(self._socket_file))
+            logger.debug('Created listener for address: {}'.format(self._socket_file))
         except Exception as e:
             logger.exception('Unable to start the listener. Error: {}'.format(e))
             raise
 
-        while True:
-            connection = listener.accept()
-            server = ConnectionServer(self._handler, connection, timeout=self._timeout)
-            relay_value = server(*args, **kwargs)
-            if relay_value == self.SHUTDOWN:
-                logger.info('Received signal to shutdown server. Shutting down.')
-                break
-            sleep(self._delay)
+        # These are created here (and not during initialisation) since the server is usually run in another process.
+        self._handler_lock = Lock()
+        self._shutdown = Event()
+
+        accept_thread = Thread(target=self._accept_connections, args=(listener, args, kwargs), daemon=True)
+        accept_thread.start()
+        self._shutdown.wait()
+
+        # Unblock the thread waiting to accept connections.
+        address = listener.address
+        if address_type(address) == 'AF_INET' and address[0] in ('', '0.0.0.0'):
+            address = ('127.0.0.1', address[1])
+        try:
+            make_client_connection(address).close()
+        except OSError:
+            pass
+        accept_thread.join()
+        listener.close()
 
 
 class SocketClient:
@@ -286,12 +867,18 @@ class SocketClient:
 
     This is a callable that sends the passed request over the given socket file and returns the response.
     """
-    def __init__(self, address):
+    def __init__(self, address, authkey=None, codec=None):
         """Initialise the SocketClient to use a given socket file.
 
-        :param address:     A Unix socket file that will be used to communicate.
+        :param address:     A Unix socket file that will be used to communicate. Or, a TCP address of the form:
+                            (<host (str)>, <port (int)>).
+        :param authkey:     The secret key (bytes) shared with the server to authenticate the connections.
+        :param codec:       The codec (see PickleCodec) used to encode requests and decode responses. None means they
+                            are pickled.
         """
         self._address = address
+        self._authkey = authkey
+        self._codec = codec
 
     def __call__(self, request, timeout=1):
         """Make a request over the socket, wait for a response and return it.
@@ -300,13 +887,185 @@ class SocketClient:
         :param timeout: The amount of time in seconds to wait for a response after a requeset has been sent.
         :return:        The response received over the socket.
         """
-        connection = Client(address=self._address, family='AF_UNIX')
-        client = ConnectionClient(connection)
+        connection = make_client_connection(self._address, authkey=self._authkey)
+        client = ConnectionClient(connection, codec=self._codec)
         response = client(request, timeout=timeout)
         connection.close()
         return response
 
 
+class SubscriptionClient:
+    """Client to receive the events streamed over a socket file for a subscription.
+
+    The subscription request is sent when the client is initialised, e.g.,
+        subscription_client = SubscriptionClient(socket_file, APIRequest('subscribe', (), {}))
+        for event in subscription_client:
+            print(event)
+
+    The iteration ends when the server stops streaming. Call close() to unsubscribe.
+    """
+    def __init__(self, address, request, timeout=5, authkey=None, codec=None):
+        """Send the subscription request over the given socket file.
+
+        :param address: A Unix socket file that will be used to communicate. Or, a TCP address of the form:
+                        (<host (str)>, <port (int)>).
+        :param request: The request (any object that can be sent over a Unix socket) that the server responds to with
+                        an APIResponse and then streams the events of a Subscription.
+        :param timeout: The amount of time in seconds to wait for a response after the request has been sent.
+        :param authkey: The secret key (bytes) shared with the server to authenticate the connection.
+        :param codec:   The codec (see PickleCodec) used to encode the request and decode the response and events.
+                        None means they are pickled.
+        :raises:        The exception in the response if the subscription fails.
+                        IOError if no response is received within the timeout.
+        """
+        self._codec = codec
+        self._connection = make_client_connection(address, authkey=authkey)
+        send_message(self._connection, request, codec=codec)
+        response = read_message(self._connection, timeout, codec=codec)
+
+        if not response:
+            self.close()
+            raise IOError('No response received for the subscription request: {}'.format(request))
+
+        if response.exception is not None:
+            self.close()
+            raise response.exception
+        self.return_value = response.return_value
+
+    def get(self, timeout=None):
+        """Get the events received within the given timeout.
+
+        :param timeout: The amount of time in seconds to wait for events. None means wait until events are received.
+        :return:        A list of events, which is empty if none were received within the timeout.
+                        None if the server has stopped streaming.
+        """
+        try:
+            if not self._connection.poll(timeout):
+                return []
+            if self._codec is None:
+                return self._connection.recv()
+            return self._codec.decode(self._connection.recv_bytes())
+        except (EOFError, OSError):
+            return None
+
+    def __iter__(self):
+        while True:
+            events = self.get()
+            if events is None:
+                break
+            for event in events:
+                yield event
+
+    def close(self):
+        """Close the connection, which ends the subscription."""
+        self._connection.close()
+
+
+class PooledSocketClient:
+    """A SocketClient like class that keeps connections open and reuses them for subsequent requests.
+
+    This is a callable that sends the passed request over the given socket file and returns the response. Connections
+    are taken from a pool of idle connections (or made if there are none) and returned to the pool once a response is
+    received. At most pool_size requests are sent concurrently, so this can be shared by multiple threads.
+
+    A connection that is found to be closed by the server (before the request is sent on it) is replaced with a new
+    connection automatically. A connection on which a response wasn't received within the timeout is discarded since a
+    late response would otherwise be received as the response of a subsequent request. Requests that were sent are
+    never resent.
+    """
+    def __init__(self, address, pool_size=2, authkey=None, codec=None):
+        """Initialise the PooledSocketClient to use a given socket file.
+
+        :param address:     A Unix socket file that will be used to communicate. Or, a TCP address of the form:
+                            (<host (str)>, <port (int)>).
+        :param pool_size:   The maximum number of connections (int) to keep open and use concurrently.
+        :param authkey:     The secret key (bytes) shared with the server to authenticate the connections.
+        :param codec:       The codec (see PickleCodec) used to encode requests and decode responses. None means they
+                            are pickled.
+        """
+        self._address = address
+        self._authkey = authkey
+        self._codec = codec
+        self._idle_connections = []
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(pool_size)
+        self._pid = os.getpid()
+
+    def _connect(self):
+        return make_client_connection(self._address, authkey=self._authkey)
+
+    def _acquire(self):
+        """Get an idle connection from the pool (or a new one) and whether it has been used before."""
+        with self._lock:
+            if self._pid != os.getpid():
+                # The connections of the parent process must not be shared with a forked process.
+                self._idle_connections = []
+                self._pid = os.getpid()
+
+            while self._idle_connections:
+                connection = self._idle_connections.pop()
+                # An idle connection has nothing to be read unless it has been closed by the server.
+                if not connection.poll(0):
+                    return connection, True
+                connection.close()
+        return self._connect(), False
+
+    def _release(self, connection):
+        with self._lock:
+            self._idle_connections.append(connection)
+
+    def _send(self, connection, request, timeout):
+        """Send the request and receive the response.
+
+        :return:    A tuple of the form: (<response>, <connection is usable>, <request was sent>), where <response> is
+                    None if the connection is closed or the response wasn't received within the timeout.
+        """
+        try:
+            send_message(connection, request, codec=self._codec)
+        except (EOFError, OSError):
+            return None, False, False
+
+        try:
+            if not connection.poll(timeout):
+                return None, False, True
+            if self._codec is None:
+                return connection.recv(), True, True
+            return self._codec.decode(connection.recv_bytes()), True, True
+        except (EOFError, OSError):
+            return None, False, True
+
+    def __call__(self, request, timeout=1):
+        """Make a request over the socket, wait for a response and return it.
+
+        :param request: Any object that can be sent over a Unix socket.
+        :param timeout: The amount of time in seconds to wait for a response after a request has been sent.
+        :return:        The response received over the socket. None if no response was received within the timeout.
+        """
+        with self._slots:
+            connection, reused = self._acquire()
+            response, usable, sent = self._send(connection, request, timeout)
+            if not sent and reused:
+                # The server closed the idle connection. Retry with a new connection. Requests that were sent aren't
+                # retried since the server may have served them (e.g., a late response), and they may not be
+                # idempotent.
+                connection.close()
+                connection = self._connect()
+                response, usable, _ = self._send(connection, request, timeout)
+
+            if usable:
+                self._release(connection)
+            else:
+                connection.close()
+            return response
+
+    def close(self):
+        """Close all the idle connections."""
+        with self._lock:
+            for connection in self._idle_connections:
+                connection.close()
+            self._idle_connections = []
+
+
 class MethodAPIHandlerWrapper:
     """Wrap a given handler object as an API handler that accepts APIRequest objects as requests, invokes handler
     methods and returns an APIHandlerResponse object."""
@@ -321,9 +1080,49 @@ class MethodAPIHandlerWrapper:
                                                             this callable>)
                         If the handler raises an exception, the following APIHandlerResponse object will be returned:
                             APIHandlerResponse(None, <exception raised>, None)
+                        If the handler is a context manager, each request (or all the requests of an APIBatchRequest)
+                        is served within a single context. This allows the handler to serve it using a consistent
+                        snapshot of its state.
         """
         self._handler = handler
 
+    def _serve_batch(self, batch_request, *args, **kwargs):
+        """Serve the requests of an APIBatchRequest in order.
+
+        :param batch_request:   An APIBatchRequest or similar object.
+        :param args:            Passed to each request as explained in __call__.
+        :param kwargs:          Passed to each request as explained in __call__.
+        :return:                An APIHandlerResponse object whose 'return_value' is the list of APIResponse objects
+                                (one for each request served) and whose 'relay_value' is the collation of the relay
+                                values of all the requests (see collate_relay_values).
+        """
+        handler_responses = []
+        for request in batch_request.requests:
+            handler_response = self._serve(request, *args, **dict(kwargs))
+            if isinstance(handler_response.relay_value, DeferredResponse):
+                # Requests are served in order, so the response can't be deferred beyond the batch.
+                handler_response = handler_response.relay_value()
+            handler_responses.append(handler_response)
+            if batch_request.stop_on_error and handler_response.exception is not None:
+                break
+
+        return APIHandlerResponse(
+            [APIResponse(response.return_value, response.exception) for response in handler_responses],
+            relay_value=collate_relay_values(response.relay_value for response in handler_responses))
+
+    def _serve(self, request, *args, **kwargs):
+        try:
+            method = getattr(self._handler, request.method)
+            args = list(args) + list(request.args)
+            kwargs.update(request.kwargs)
+            response = method(*args, **kwargs)
+        except Exception as e:
+            logger.exception('APIHandler got the exception {} with the message: {}'.format(type(e), e))
+            response = APIHandlerResponse(None, e)
+
+        logger.debug('Received request: {request} -- Response: {response}'.format(request=request, response=response))
+        return response
+
     def __call__(self, request, *args, **kwargs):
         """Serve a single request by calling handler methods and returning the APIHandlerResponse they return.
 
@@ -339,18 +1138,15 @@ class MethodAPIHandlerWrapper:
         :return:        An APIHandlerResponse object.
                         If the handler raises an exception, the following APIHandlerResponse object will be returned:
                             APIHandlerResponse(None, <exception raised>, None)
+                        If the request is an APIBatchRequest, the 'return_value' will be the list of APIResponse
+                        objects, one for each request served.
         """
-        try:
-            method = getattr(self._handler, request.method)
-            args = list(args) + list(request.args)
-            kwargs.update(request.kwargs)
-            response = method(*args, **kwargs)
-        except Exception as e:
-            logger.exception('APIHandler got the exception {} with the message: {}'.format(type(e), e))
-            response = APIHandlerResponse(None, e)
+        serve = self._serve_batch if isinstance(request, APIBatchRequest) else self._serve
+        if not hasattr(self._handler, '__enter__'):
+            return serve(request, *args, **kwargs)
 
-        logger.debug('Received request: {request} -- Response: {response}'.format(request=request, response=response))
-        return response
+        with self._handler:
+            return serve(request, *args, **kwargs)
 
 
 class MethodAPIClientWrapper:
@@ -373,6 +1169,33 @@ class MethodAPIClientWrapper:
         self._client = client
         self._timeout = timeout
 
+    def _get_timeout(self, method, args, kwargs):
+        """Get the timeout (in seconds) while waiting for the response to an API call. Subclasses can override this
+        for API calls that take longer to respond, e.g., those that wait in the server.
+
+        :param method:  The method name (str).
+        :param args:    The args of the API call.
+        :param kwargs:  The kwargs of the API call.
+        :return:        The timeout (in seconds) given when this object was created.
+        """
+        return self._timeout
+
+    def batch(self, stop_on_error=False):
+        """Create an APIBatch to send multiple API calls as a single request.
+
+        The API calls are made on the returned APIBatch object like they are made on this object. They are sent only
+        when its send() method is called. E.g.,
+            batch = method_client.batch()
+            batch.foo(42)
+            batch.bar(baz='qux')
+            responses = batch.send()
+
+        :param stop_on_error:   When True, the calls following the first call that results in an exception are not
+                                served.
+        :return:                An APIBatch object.
+        """
+        return APIBatch(self._client, stop_on_error=stop_on_error, timeout=self._timeout)
+
     def __getattr__(self, method):
         """Return a function that will convert the method call into a request, send it using the client and
         return the remote call's return value or raise the exception received.
@@ -388,9 +1211,14 @@ class MethodAPIClientWrapper:
                         5. Returns the APIResponse's 'return_value' attribute if there its 'exception' attribute is
                            None.
                            Raises the exception if the value of 'exception' is not None.
+        :raises:        AttributeError for special (dunder) and private attributes, which are never API calls. This
+                        also prevents recursion while the object is unpickled (before '_client' is set).
         """
+        if method.startswith('_'):
+            raise AttributeError(method)
+
         def method_callable(*args, **kwargs):
-            response = self._client(APIRequest(method, args, kwargs), timeout=self._timeout)
+            response = self._client(APIRequest(method, args, kwargs), timeout=self._get_timeout(method, args, kwargs))
 
             if not response:
                 return None
@@ -400,3 +1228,52 @@ class MethodAPIClientWrapper:
             return response.return_value
 
         return method_callable
+
+
+class APIBatch:
+    """Collects API calls made as method calls and sends them as a single APIBatchRequest.
+
+    See MethodAPIClientWrapper.batch for an example.
+    """
+    def __init__(self, client, stop_on_error=False, timeout=1):
+        """Define the client to be used for communication.
+
+        :param client:          A ConnectionClient like callable.
+        :param stop_on_error:   When True, the calls following the first call that results in an exception are not
+                                served.
+        :param timeout:         The timeout (in seconds) while waiting for a response.
+        """
+        self._client = client
+        self._stop_on_error = stop_on_error
+        self._timeout = timeout
+        self._requests = []
+
+    def send(self):
+        """Send the API calls collected so far as a single request.
+
+        :return:    A list of APIResponse objects, one for each API call served, in the order in which the calls were
+                    made. The list is shorter than the number of calls made if stop_on_error is True and a call
+                    resulted in an exception. None if no response was received.
+        """
+        requests, self._requests = self._requests, []
+        response = self._client(APIBatchRequest(requests, stop_on_error=self._stop_on_error), timeout=self._timeout)
+
+        if not response:
+            return None
+
+        if response.exception is not None:
+            raise response.exception
+        return response.return_value
+
+    def __getattr__(self, method):
+        """Return a function that will convert the method call into an APIRequest and collect it to be sent later.
+
+        :param method:  The method name (str).
+        :return:        A function that accepts *args and **kwargs and returns the index (int) of the APIResponse of
+                        this call in the list returned by send().
+        """
+        def method_callable(*args, **kwargs):
+            self._requests.append(APIRequest(method, args, kwargs))
+            return len(self._requests) - 1
+
+        return method_callable
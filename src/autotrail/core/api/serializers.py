@@ -40,6 +40,13 @@ class Serializer:
         for serializer_callable in self._serializer_callables:
             self.serialized.update(serializer_callable())
 
+    def snapshot(self):
+        """Get a copy of the serialized dictionary.
+
+        :return: A dictionary copy of the multiprocessing.Manager dictionary.
+        """
+        return dict(self.serialized)
+
 
 class SerializerCallable:
     """A callable object that calls the given serializer function with the given object returns a serialized
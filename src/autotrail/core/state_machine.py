@@ -293,24 +293,31 @@ def state_machine_evaluator(definitions, callback):
                             }
                             If the returned action is not part of the available actions, it will have no effect. The
                             integrity of the state machines will not be compromised by injecting arbitrary actions.
+                        If the callback has a close method, it is called (with no parameters) when the evaluation ends,
+                        including when it ends due to an exception.
     :return:            None. The evaluator returns when there are no possible actions for any of the machines (no state
                         transitions possible).
                         Any exception (Exception) raised by the callback function will be logged and re-raised.
     """
     rules, states = parse_definitions(definitions)
-    while True:
-        transitions = {name: determine_transitions(rules, states, name) for name in states}
-
-        try:
-            actions = callback(states, transitions)
-        except Exception as e:
-            logger.exception('Callback failed with error: {}'.format(e))
-            raise
-
-        if not any(transitions.values()):
-            break
-
-        states.update(transition(transitions, actions))
+    try:
+        while True:
+            transitions = {name: determine_transitions(rules, states, name) for name in states}
+
+            try:
+                actions = callback(states, transitions)
+            except Exception as e:
+                logger.exception('Callback failed with error: {}'.format(e))
+                raise
+
+            if not any(transitions.values()):
+                break
+
+            states.update(transition(transitions, actions))
+    finally:
+        close = getattr(callback, 'close', None)
+        if close is not None:
+            close()
 
 
 def run_state_machine_evaluator(state_machine_definitions, callback):
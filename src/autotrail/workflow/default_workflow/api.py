@@ -13,14 +13,28 @@
   limitations under the License.
 
 """
+import inspect
 import logging
+import os
+
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from signal import SIGTERM
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
 
 from autotrail.core.api.management import (MethodAPIClientWrapper, SocketServer, SocketClient, ConnectionClient,
-                                           APIHandlerResponse)
+                                           APIHandlerResponse, PooledSocketClient, APIRequest, Subscription,
+                                           SubscriptionClient, DeferredResponse)
 from autotrail.workflow.default_workflow.state_machine import Action, State
+from autotrail.workflow.helpers.context import read_step_messages
+from autotrail.workflow.helpers.results import CacheResult
+from autotrail.workflow.helpers.step import is_dict_subset_of
 
 
 logger = logging.getLogger(__name__)
+# Serializes the lazy start of the WorkflowEventPublisher objects, which can be started by concurrent API calls.
+_publisher_start_lock = Lock()
 
 
 def filter_steps_by_states(steps, step_states, states):
@@ -48,6 +62,18 @@ def filter_steps_by_tags(steps, tags):
     return (step for step in steps if tags in step)
 
 
+def get_tail(messages, tail):
+    """Get the last few messages.
+
+    :param messages:    A list of messages or None.
+    :param tail:        The maximum number (int) of messages to return. None means all messages.
+    :return:            The last 'tail' messages. None if messages is None.
+    """
+    if messages is None or tail is None:
+        return messages
+    return messages[max(len(messages) - tail, 0):]
+
+
 def filter_steps_by_action(steps, transitions, action):
     """Filter step objects on which, the given action can be performed.
 
@@ -85,6 +111,13 @@ def get_class_globals(klass):
             for attribute in dir(klass) if not attribute.startswith('_') and attribute.isupper()}
 
 
+# The default time (in seconds) that the API calls waiting in the server (see WorkflowAPIHandler.wait_for_change) wait.
+DEFAULT_WAIT_TIMEOUT = 60
+
+# The API calls that wait in the server for at most their 'timeout' argument.
+WAITING_API_CALLS = {'wait_for_change', 'wait_for_states'}
+
+
 class StatusField:
     """Namespace for the fields returned as part of the status API call. Use this class instead of plain strings."""
     NAME = 'Name'
@@ -95,6 +128,394 @@ class StatusField:
     OUTPUT = 'Output'
     RETURN_VALUE = 'Return value'
     EXCEPTION = 'Exception'
+    RESOURCE_USAGE = 'Resources'
+
+
+# The keys of the step data (see workflow.helpers.context.serialize_step_data) that the status fields are read from.
+STATUS_FIELD_STEP_DATA_KEYS = {
+    StatusField.IO: 'io',
+    StatusField.OUTPUT: 'output',
+    StatusField.RETURN_VALUE: 'return_value',
+    StatusField.EXCEPTION: 'exception',
+    StatusField.RESOURCE_USAGE: 'resource_usage',
+}
+CONTEXT_STATUS_FIELDS = set(STATUS_FIELD_STEP_DATA_KEYS)
+
+
+def get_cpu_time(resource_usage):
+    """Get the total CPU time of a run, i.e., the user and system time of the run and of its child processes.
+
+    :param resource_usage:  The resource usage of a run (see workflow.helpers.execution.get_resource_usage).
+    :return:                The CPU time in seconds (float).
+    """
+    return sum(resource_usage.get(key, 0) for key in ['user_time', 'system_time', 'children_user_time',
+                                                      'children_system_time'])
+
+
+class ResourceSortKey:
+    """Namespace for the keys by which the steps are ranked by the resource_summary API call."""
+    CPU_TIME = 'cpu_time'
+    WALL_TIME = 'wall_time'
+    MAX_RSS = 'max_rss'
+    BLOCK_IO = 'block_io'
+
+
+RESOURCE_SORT_KEY_FUNCTIONS = {
+    ResourceSortKey.CPU_TIME: get_cpu_time,
+    ResourceSortKey.WALL_TIME: lambda usage: usage['wall_time'],
+    ResourceSortKey.MAX_RSS: lambda usage: max(usage.get('max_rss') or 0, usage.get('children_max_rss') or 0),
+    ResourceSortKey.BLOCK_IO: lambda usage: usage.get('block_input', 0) + usage.get('block_output', 0),
+}
+
+
+def freeze(value):
+    """Convert a value made of lists, tuples, sets and dictionaries into a hashable value.
+
+    :param value:   The value to convert.
+    :return:        A hashable value that is equal to the hashable value of any other equal value.
+    """
+    if isinstance(value, dict):
+        return frozenset((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (set, frozenset)):
+        return frozenset(freeze(item) for item in value)
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class LRUCache:
+    """A mapping of a bounded size that evicts the least recently used items."""
+    def __init__(self, size=128):
+        """Define the size of the cache.
+
+        :param size:    The maximum number of items (int) in the cache.
+        """
+        self._size = size
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        """Get the value of the key and mark it as the most recently used.
+
+        :param key:     The key of the item.
+        :param default: Returned if the key is not in the cache.
+        :return:        The value of the key or the default.
+        """
+        if key not in self._items:
+            return default
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def put(self, key, value):
+        """Add an item to the cache and evict the least recently used item if the cache is full.
+
+        :param key:     The key of the item. Must be hashable.
+        :param value:   The value of the item.
+        :return:        None
+        """
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self._size:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class TagIndex:
+    """An inverted index of the tags of steps that finds the steps matching the given tags without checking every step.
+
+    Each (<tag key>, <tag value>) pair is mapped to the set of positions of the steps having it, so finding the steps
+    matching some tags is an intersection of sets. Tag keys that have an unhashable value (e.g., a list) in any step are
+    not indexed and are matched by checking the tags of each step instead, like filter_steps_by_tags does.
+    """
+    def __init__(self, steps):
+        """Build the index.
+
+        :param steps:   A list of step objects (similar to default_workflow.step.Step) in topological order. The tags of
+                        the steps must not change after the index is built.
+        """
+        self._steps = steps
+        self._positions = defaultdict(set)
+        self._unindexed_keys = set()
+        for position, step in enumerate(self._steps):
+            for key, value in step.tags.items():
+                try:
+                    self._positions[(key, value)].add(position)
+                except TypeError:
+                    self._unindexed_keys.add(key)
+
+    def find_positions(self, tags):
+        """Find the positions of the steps matching the tags.
+
+        :param tags:    Tags are arbitrary key-value pairs (dictionary) that can be associated with a step.
+        :return:        A sorted list of the positions (int) of the matching steps in the list of steps.
+        """
+        positions = None
+        unindexed_tags = {}
+        for key, value in tags.items():
+            if key in self._unindexed_keys:
+                unindexed_tags[key] = value
+                continue
+            try:
+                matching_positions = self._positions.get((key, value), set())
+            except TypeError:
+                unindexed_tags[key] = value
+                continue
+            positions = matching_positions if positions is None else (positions & matching_positions)
+            if not positions:
+                return []
+
+        positions = range(len(self._steps)) if positions is None else sorted(positions)
+        if unindexed_tags:
+            return [position for position in positions if is_dict_subset_of(unindexed_tags, self._steps[position].tags)]
+        return list(positions)
+
+    def find(self, tags):
+        """Find the steps matching the tags.
+
+        :param tags:    Tags are arbitrary key-value pairs (dictionary) that can be associated with a step.
+        :return:        A list of the matching step objects in topological order.
+        """
+        return [self._steps[position] for position in self.find_positions(tags)]
+
+
+class StateIndex:
+    """An index of the IDs of the steps in each state.
+
+    The index is updated with only the states that changed after the version it was last updated to, so neither
+    updating it nor finding the steps in some states needs checking the state of every step.
+    """
+    def __init__(self, changes):
+        """Define the changes the index is updated with.
+
+        :param changes: A sequence of the states that changed in each version (like the 'changes' attribute of
+                        core.api.callbacks.StatesCallback), i.e., changes[i] is of the form:
+                        {
+                            <Step ID>: <State of the step (str)>,
+                            ...
+                        }
+                        Containing the states that changed in version i + 1.
+        """
+        self._changes = changes
+        self._version = 0
+        self._states = {}
+        self._step_ids = defaultdict(set)
+
+    def update(self, version):
+        """Update the index with the states that changed after the last update up to the given version.
+
+        :param version: The version (int) of the states to update the index to.
+        :return:        None
+        """
+        if version <= self._version:
+            return
+
+        for changed_states in self._changes[self._version:version]:
+            for step_id, state in changed_states.items():
+                last_state = self._states.get(step_id)
+                if last_state is not None:
+                    self._step_ids[last_state].discard(step_id)
+                self._step_ids[state].add(step_id)
+            self._states.update(changed_states)
+        self._version = version
+
+    def get_state(self, step_id):
+        """Get the state of a step as of the version the index was last updated to.
+
+        :param step_id: The ID of the step.
+        :return:        The state of the step (str) or None if its state isn't known.
+        """
+        return self._states.get(step_id)
+
+    def find(self, states):
+        """Find the IDs of the steps in any of the given states.
+
+        :param states:  An iterable of states (str).
+        :return:        A set of step IDs.
+        """
+        step_ids = set()
+        for state in set(states):
+            step_ids.update(self._step_ids.get(state, ()))
+        return step_ids
+
+
+class EventType:
+    """Namespace for the types of events sent to subscribers. Use this class instead of plain strings.
+
+    Events are dictionaries of the following forms:
+        State change:   {'type': EventType.STATE, 'step_id': <Step ID>, StatusField.NAME: <Name of the step>,
+                         StatusField.STATE: <New state of the step>}
+        New messages:   {'type': EventType.IO or EventType.OUTPUT, 'step_id': <Step ID>,
+                         StatusField.NAME: <Name of the step>, 'messages': <List of new messages>}
+        Overflow:       {'type': EventType.OVERFLOW, 'dropped': <Number of events dropped>}
+    """
+    STATE = 'State'
+    IO = StatusField.IO
+    OUTPUT = StatusField.OUTPUT
+    OVERFLOW = Subscription.OVERFLOW
+
+
+class WorkflowEventPublisher:
+    """Watches a workflow for changes and publishes them as events (see EventType) to subscriptions and wakes up the
+    callers waiting for the states to change.
+
+    Changes are checked periodically, so a step that changes state more than once between checks will have only its
+    latest state published.
+
+    The states are copied only when the states version of the callback manager changes. Only the changed steps' data is
+    fetched from versioned context serializers (like workflow.helpers.context.IncrementalContextSerializer). Therefore,
+    the cost of watching is proportional to the volume of changes.
+
+    The watcher thread is started when the first subscription is added or wait is called, i.e., in the process serving
+    the API.
+    """
+    def __init__(self, steps, callback_manager, interval=0.1):
+        """Define the workflow to watch.
+
+        :param steps:               An iterable of step objects (similar to default_workflow.step.Step).
+        :param callback_manager:    A managed callback callable similar to core.api.callbacks.ManagedCallback.
+        :param interval:            The amount of time in seconds between checks for changes.
+        """
+        self._steps = {step.id: step for step in steps}
+        self._callback_manager = callback_manager
+        self._interval = interval
+        self._subscriptions = []
+        self._waiters = 0
+        self._lock = None
+        self._states_changed = None
+        self._states_version = None
+        self._states = {}
+        self._context_version = 0
+        self._message_counts = {}
+
+    def _make_state_events(self):
+        version = self._callback_manager.states_version.value
+        if version == self._states_version:
+            return []
+
+        self._states_version = version
+        states = dict(self._callback_manager.states)
+        events = []
+        for step_id, state in states.items():
+            if self._states.get(step_id) != state:
+                events.append({'type': EventType.STATE, 'step_id': step_id,
+                               StatusField.NAME: self._steps[step_id].tags['name'], StatusField.STATE: state})
+        self._states = states
+        return events
+
+    def _make_message_events(self):
+        context_serializer = self._callback_manager.context_serializer
+        if context_serializer is None:
+            return []
+
+        if hasattr(context_serializer, 'changes'):
+            changes = context_serializer.changes(self._context_version)
+            self._context_version = changes['version']
+            all_step_data = changes['step_data']
+        else:
+            all_step_data = context_serializer.snapshot().get('step_data', {})
+
+        events = []
+        for step_id, step_data in all_step_data.items():
+            for key, event_type in [('io', EventType.IO), ('output', EventType.OUTPUT)]:
+                messages = list(step_data.get(key) or [])
+                count = step_data.get('{}_count'.format(key), len(messages))
+                last_count = self._message_counts.get((step_id, key), 0)
+                self._message_counts[(step_id, key)] = count
+                if count < last_count:
+                    # The messages have been reset (e.g., when the step is re-run).
+                    last_count = 0
+                if count > last_count:
+                    events.append({'type': event_type, 'step_id': step_id,
+                                   StatusField.NAME: self._steps[step_id].tags['name'],
+                                   'messages': messages[-(count - last_count):]})
+        return events
+
+    def _publish(self):
+        """Publish the changes since the last call to the open subscriptions and wake up the waiters if the states
+        have changed. Must be called with the lock held."""
+        events = self._make_state_events()
+        if events:
+            self._states_changed.notify_all()
+
+        self._subscriptions = [subscription_filter for subscription_filter in self._subscriptions
+                               if not subscription_filter[0].closed]
+        if not self._subscriptions:
+            return
+
+        events.extend(self._make_message_events())
+        for subscription, step_ids, states, event_types in self._subscriptions:
+            matching_events = [event for event in events
+                               if event['step_id'] in step_ids and event['type'] in event_types
+                               and self._states.get(event['step_id']) in states]
+            if matching_events:
+                subscription.put(matching_events)
+
+    def _run(self):
+        while True:
+            sleep(self._interval)
+            with self._lock:
+                if not self._subscriptions and not self._waiters:
+                    continue
+                try:
+                    self._publish()
+                except Exception as e:
+                    logger.exception('Unable to publish workflow events due to error: {}'.format(e))
+
+    def _start(self):
+        with _publisher_start_lock:
+            if self._lock is None:
+                # Created here (and not during initialisation) since the API is usually served in another process.
+                self._lock = Lock()
+                self._states_changed = Condition(self._lock)
+                Thread(target=self._run, daemon=True).start()
+
+    def wait(self, predicate, timeout):
+        """Wait until the states satisfy the given predicate or the timeout expires.
+
+        :param predicate:   A callable that accepts (<states>, <states version>) and returns a boolean. Where <states>
+                            is a dictionary of the form: {<Step ID>: <State of the step (str)>, ...}.
+        :param timeout:     The maximum amount of time in seconds to wait.
+        :return:            A tuple of the form: (<Return value of the last call to the predicate>, <states version>).
+        """
+        self._start()
+        deadline = monotonic() + timeout
+        with self._lock:
+            self._waiters += 1
+            try:
+                self._publish()
+                result = predicate(self._states, self._states_version)
+                while not result and monotonic() < deadline:
+                    self._states_changed.wait(deadline - monotonic())
+                    result = predicate(self._states, self._states_version)
+                return result, self._states_version
+            finally:
+                self._waiters -= 1
+
+    def subscribe(self, subscription, step_ids, states=None, event_types=None):
+        """Add a subscription, which will receive the events of the given steps.
+
+        The subscription first receives a state event for each of the matching steps with their current states.
+
+        :param subscription:    A core.api.management.Subscription object.
+        :param step_ids:        A collection of the step IDs whose events will be published to the subscription.
+        :param states:          A collection of states. Only the events of the steps that are in one of these states
+                                are published. None means all the states.
+        :param event_types:     A collection of the event types (from the EventType namespace) to be published. None
+                                means all the event types.
+        :return:                None
+        """
+        self._start()
+        states = set(states or get_class_globals(State))
+        event_types = set(event_types or get_class_globals(EventType))
+        with self._lock:
+            self._publish()
+            if EventType.STATE in event_types:
+                subscription.put([{'type': EventType.STATE, 'step_id': step_id,
+                                   StatusField.NAME: self._steps[step_id].tags['name'], StatusField.STATE: state}
+                                  for step_id, state in self._states.items()
+                                  if step_id in step_ids and state in states])
+            self._subscriptions.append((subscription, set(step_ids), states, event_types))
 
 
 class WorkflowAPIHandler:
@@ -107,38 +528,157 @@ class WorkflowAPIHandler:
     If a method wants to shutdown the API server, it must set relay_value=SocketServer.SHUTDOWN in the returned
         APIHandlerResponse object.
 
+    The responses of the read-only API calls (list, status and steps_waiting_for_user_input) are cached by the version
+    of the workflow they were computed from. These API calls accept an 'if_changed_since' version. When given, the
+    response is a dictionary of the form:
+        {'version': <The version of the workflow>, 'result': <The result or WorkflowAPIHandler.NOT_MODIFIED>}
+    where the result is NOT_MODIFIED if the version is the same as the 'if_changed_since' version. Pass 0 as the
+    'if_changed_since' version in the first call and the returned 'version' in the next call to get the result only
+    when it has changed. The version is 0 if the result depends on the serialized context and the context serializer
+    isn't versioned (see workflow.helpers.context.IncrementalContextSerializer), in which case the result is always
+    returned.
+
     For API Requesters:
     The API requester will receive APIResponse objects that are similar to the APIHandlerResponse objects but without
     the relay_value. Therefore, treat the APIHandlerResponse return description as though the were APIResponse objects
     and ignore the relay_value.
     """
-    def __init__(self, steps, callback_manager, process):
+    NOT_MODIFIED = 'Not Modified'   # The result when nothing has changed since the 'if_changed_since' version.
+
+    def __init__(self, steps, callback_manager, process, cache_size=128):
         """Initialise the API handler.
 
         :param steps:               An iterable of step objects (similar to default_workflow.step.Step).
         :param callback_manager:    A managed callback callable similar to core.api.callbacks.ManagedCallback.
-        :param process:             The process running the state machine evaluator.
+        :param process:             The process running the state machine evaluator or its PID (int). The PID can
+                                    be used with every start method, whereas a multiprocessing.Process can only be
+                                    passed to forked processes.
+        :param cache_size:          The maximum number of responses (int) of read-only API calls that are cached.
         """
         self._callback_manager = callback_manager
         self._steps = list(steps)
         self._machine_api_client = MethodAPIClientWrapper(
             ConnectionClient(self._callback_manager.api_client_connection))
         self._process = process
+        self._snapshot = None
+        self._tag_index = TagIndex(self._steps)
+        self._state_index = StateIndex(self._callback_manager.states_changes)
+        self._event_publisher = WorkflowEventPublisher(self._steps, self._callback_manager)
+        self._response_cache = LRUCache(cache_size)
 
-    @property
-    def _states(self):
-        """Creates a dictionary copy of the multiprocessing.Manager shared dictionary of states."""
-        return dict(self._callback_manager.states)
+    def __enter__(self):
+        """Start serving API calls using a single snapshot of the states, transitions and serialized context.
+
+        Each of them is copied at most once (when first used) until __exit__ is called, so that all the API calls
+        served in between see a consistent state of the workflow and the cost of each API call is linear in the number
+        of steps. The states are not copied, instead the state index is updated with the states that changed up to the
+        states version of the snapshot. MethodAPIHandlerWrapper serves each request (or batch of requests) within this
+        context.
+        """
+        self._snapshot = {}
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._snapshot = None
+
+    def _get_snapshot(self, name, make_copy):
+        """Return the copy made by make_copy(), re-using the one in the current snapshot (if any)."""
+        if self._snapshot is None:
+            return make_copy()
+        if name not in self._snapshot:
+            self._snapshot[name] = make_copy()
+        return self._snapshot[name]
+
+    def _update_state_index(self):
+        """Update the state index to the states version of the current snapshot (see _get_version)."""
+        self._state_index.update(self._get_snapshot('states_version',
+                                                    lambda: self._callback_manager.states_version.value))
+
+    def _find_steps(self, tags, states=None):
+        """Find the steps matching the tags (using the tag index) and in one of the states (using the state index).
+
+        :param tags:    Tags are arbitrary key-value pairs (dictionary) that can be associated with a step.
+        :param states:  An iterable of states (str). None means any state.
+        :return:        A list of the matching step objects in topological order.
+        """
+        steps = self._tag_index.find(tags)
+        if states is None:
+            return steps
+
+        self._update_state_index()
+        step_ids = self._state_index.find(states)
+        return [step for step in steps if step.id in step_ids]
 
     @property
     def _transitions(self):
         """Creates a dictionary copy of the multiprocessing.Manager shared dictionary of transitions."""
-        return dict(self._callback_manager.transitions)
+        return self._get_snapshot('transitions', lambda: dict(self._callback_manager.transitions))
 
     @property
     def _context_serialized(self):
         """Creates a dictionary copy of the serialized context that is shared in a multiprocessing.Manager."""
-        return dict(self._callback_manager.context_serialized)
+        return self._get_snapshot('context', self._callback_manager.context_serializer.snapshot)
+
+    def _get_version(self, uses_states=True, uses_context=True, uses_transitions=False):
+        """Get the version of the parts of the workflow that are used.
+
+        The version is read (once per snapshot) before the states, transitions and context are copied, so any result
+        computed from the snapshot is at least as recent as the version.
+
+        :param uses_states:         Boolean. True if the states are used.
+        :param uses_context:        Boolean. True if the serialized context is used.
+        :param uses_transitions:    Boolean. True if the transitions are used. They are versioned separately from the
+                                    states since they are recorded separately (possibly concurrently, see
+                                    core.api.callbacks.ObserverMode).
+        :return:                    A tuple of the form:
+                                    (<states version (int)>, <transitions version (int)>, <context version (int)>),
+                                    where the version of a part that isn't used is 0.
+                                    None if the serialized context is used but the context serializer isn't versioned
+                                    (see workflow.helpers.context.IncrementalContextSerializer).
+        """
+        states_version = self._get_snapshot('states_version', lambda: self._callback_manager.states_version.value)
+        transitions_version = 0
+        if uses_transitions:
+            transitions_version = self._get_snapshot('transitions_version',
+                                                     lambda: self._callback_manager.transitions_version.value)
+        context_version = 0
+        if uses_context:
+            context_serializer = self._callback_manager.context_serializer
+            if not hasattr(context_serializer, 'version'):
+                return None
+            context_version = self._get_snapshot('context_version', lambda: context_serializer.version.value)
+        return (states_version if uses_states else 0), transitions_version, context_version
+
+    def _respond_with_cache(self, key, version, make_result, if_changed_since=None):
+        """Respond with the cached result of a read-only API call, computing it only if it isn't cached.
+
+        :param key:                 A hashable key identifying the API call and its arguments.
+        :param version:             The version (see _get_version) of the workflow. None means the result is not
+                                    cached.
+        :param make_result:         A callable that computes the result.
+        :param if_changed_since:    The version last seen by the caller. See the class docstring.
+        :return:                    An APIHandlerResponse object whose 'return_value' is the result or the dictionary
+                                    explained in the class docstring (if if_changed_since is given).
+        """
+        if if_changed_since is not None and version is not None and freeze(if_changed_since) == version:
+            return APIHandlerResponse({'version': version, 'result': self.NOT_MODIFIED})
+
+        cacheable = version is not None
+        try:
+            hash(key)
+        except TypeError:
+            # Arguments (e.g., tag values) that are not hashable can't be cached.
+            cacheable = False
+
+        result = self._response_cache.get((key, version)) if cacheable else None
+        if result is None:
+            result = make_result()
+            if cacheable:
+                self._response_cache.put((key, version), result)
+
+        if if_changed_since is None:
+            return APIHandlerResponse(result)
+        return APIHandlerResponse({'version': version or 0, 'result': result})
 
     def get_serialized_context(self):
         """Get a serialized copy of the current state of the context.
@@ -148,6 +688,57 @@ class WorkflowAPIHandler:
         """
         return APIHandlerResponse(self._context_serialized)
 
+    def get_serialized_context_changes(self, since_version=0):
+        """Get the serialized data of the steps that changed after the given version.
+
+        This is supported only by versioned context serializers like
+        workflow.helpers.context.IncrementalContextSerializer. For other serializers, all the serialized step data is
+        returned with the version as None.
+
+        :param since_version:   The version (int) last seen by the caller. 0 means all the step data.
+        :return:                An APIHandlerResponse object whose 'return_value' is a dictionary of the form:
+                                {
+                                    'version': <The latest version (int)> or None,
+                                    'step_data': {<Step ID>: <Serialized data of the step>, ...}
+                                }
+                                Pass the returned 'version' as since_version in the next call to get only the
+                                subsequent changes.
+        """
+        context_serializer = self._callback_manager.context_serializer
+        if hasattr(context_serializer, 'changes'):
+            return APIHandlerResponse(context_serializer.changes(since_version))
+        return APIHandlerResponse({'version': None, 'step_data': self._context_serialized['step_data']})
+
+    def read_step_messages(self, step_id, field=StatusField.OUTPUT, offset=0, limit=None):
+        """Read a range of the I/O or output messages of a step from the file they are spilled to.
+
+        This is supported only when the context serializer spills the messages to a run directory (see
+        workflow.helpers.context.serialize_step_data).
+
+        :param step_id: The ID of the step.
+        :param field:   StatusField.OUTPUT or StatusField.IO.
+        :param offset:  The offset from which to read. 0 reads from the first message. Use the offset returned by a
+                        previous call to read subsequent messages.
+        :param limit:   The maximum number of messages to read (int). None means all the available messages.
+        :return:        An APIHandlerResponse object whose 'return_value' is a dictionary of the form:
+                        {
+                            'messages': <List of messages>,
+                            'offset': <Offset of the next message>,
+                        }
+                        The exception will be a ValueError if the messages of the step are not spilled to a file.
+        """
+        key = {StatusField.IO: 'io_file', StatusField.OUTPUT: 'output_file'}[field]
+        file_name = self._get_step_data([step_id], [key]).get(step_id, {}).get(key)
+        if file_name is None:
+            return APIHandlerResponse(None, ValueError('The {} messages of step {} are not spilled to a file.'.format(
+                field, step_id)))
+
+        try:
+            messages, offset = read_step_messages(file_name, offset=offset, limit=limit)
+        except FileNotFoundError:
+            messages = []
+        return APIHandlerResponse({'messages': messages, 'offset': offset})
+
     def start(self, dry_run=True):
         """Start a workflow. This will change the state of all steps in 'Ready' state to 'Waiting' state.
 
@@ -172,9 +763,12 @@ class WorkflowAPIHandler:
         else:
             self.pause(dry_run=False)
             response = self.interrupt(dry_run=False)
-            if not list(filter_steps_by_states(self._steps, self._states, State.RUNNING)):
+            if not self._find_steps({}, states=[State.RUNNING]):
                 try:
-                    self._process.terminate()
+                    if isinstance(self._process, int):
+                        os.kill(self._process, SIGTERM)
+                    else:
+                        self._process.terminate()
                 except OSError:
                     pass
             response.relay_value = SocketServer.SHUTDOWN  # This relay value signals the server to stop.
@@ -190,8 +784,7 @@ class WorkflowAPIHandler:
         :return:        An APIHandlerResponse object whose 'return_value' is the list of step IDs to which the message
                         was sent.
         """
-        step_ids = list(extract_step_ids(
-            filter_steps_by_states(filter_steps_by_tags(self._steps, tags), self._states, [State.RUNNING])))
+        step_ids = list(extract_step_ids(self._find_steps(tags, states=[State.RUNNING])))
 
         if not dry_run:
             step_message_mapping = {step_id: message for step_id in step_ids}
@@ -203,18 +796,96 @@ class WorkflowAPIHandler:
                 raise
         return APIHandlerResponse(step_ids)
 
-    def list(self, **tags):
-        """List all the steps' tags in a workflow (in topological order).
+    def subscribe(self, states=None, events=None, queue_size=1000, **tags):
+        """Subscribe to the events of the workflow (see EventType) as they happen.
 
-        :param tags:    Any key=value pair provided in the arguments is treated as a tag, except for dry_run=True.
+        The events are streamed over the same connection after the response is sent, until it is closed. Use
+        make_subscription_client to subscribe.
+
+        :param states:      List of strings that represent the states of a Step. Only the events of the steps in one
+                            of these states are sent. Defaults to all the states.
+        :param events:      List of event types from the EventType namespace. Only these types of events are sent.
+                            Defaults to all the event types.
+        :param queue_size:  The maximum number of events (int) queued for the subscriber. Once the queue is full, new
+                            events are dropped and replaced with an EventType.OVERFLOW event.
+        :param tags:        Any key=value pair provided in the arguments is treated as a tag.
+                            Each step by default gets a tag viz., name=<action_function_name>.
+                            If tags are provided, then only the events of the steps matching the tags are sent.
+        :return:            An APIHandlerResponse object whose 'return_value' is the list of IDs of the steps matching
+                            the tags. Its relay_value is the Subscription to be streamed by the server.
+        """
+        step_ids = list(extract_step_ids(self._find_steps(tags)))
+        subscription = Subscription(queue_size)
+        self._event_publisher.subscribe(subscription, step_ids, states=states, event_types=events)
+        return APIHandlerResponse(step_ids, relay_value=subscription)
+
+    def version(self):
+        """Get the version of the states of the workflow, which is incremented every time the state of any step changes.
+
+        :return:    An APIHandlerResponse object whose 'return_value' is the version (int).
+        """
+        return APIHandlerResponse(self._callback_manager.states_version.value)
+
+    def wait_for_change(self, version, timeout=DEFAULT_WAIT_TIMEOUT):
+        """Wait until the version of the states of the workflow is greater than the given version.
+
+        The wait happens in the API server without blocking other API calls. The client's timeout must be longer than
+        the given timeout to receive the response. The clients made by make_api_client wait for the given timeout in
+        addition to their own (see WorkflowAPIClientWrapper).
+
+        :param version: The version (int) last seen by the caller, e.g., returned by the version API call.
+        :param timeout: The maximum amount of time in seconds to wait.
+        :return:        An APIHandlerResponse object whose 'return_value' is the latest version (int), which is the
+                        same as the given version if there was no change within the timeout.
+        """
+        return APIHandlerResponse(None, relay_value=DeferredResponse(self._wait_for_change, version, timeout))
+
+    def _wait_for_change(self, version, timeout):
+        _, latest_version = self._event_publisher.wait(lambda states, states_version: states_version > version,
+                                                       timeout)
+        return APIHandlerResponse(latest_version)
+
+    def wait_for_states(self, states, timeout=DEFAULT_WAIT_TIMEOUT, **tags):
+        """Wait until all the steps matching the tags are in one of the given states.
+
+        The wait happens in the API server without blocking other API calls. The client's timeout must be longer than
+        the given timeout to receive the response. The clients made by make_api_client wait for the given timeout in
+        addition to their own (see WorkflowAPIClientWrapper).
+
+        :param states:  List of strings that represent the states of a Step.
+        :param timeout: The maximum amount of time in seconds to wait.
+        :param tags:    Any key=value pair provided in the arguments is treated as a tag.
                         Each step by default gets a tag viz., name=<action_function_name>.
-                        If no keyword arguments are provided, this will list the tags of all the steps in the workflow.
-        :return:        An APIHandlerResponse object whose 'return_value' is the list of dictionaries (tags) of the
-                        matching steps.
+                        If no tags are provided, all the steps need to be in one of the given states.
+        :return:        An APIHandlerResponse object whose 'return_value' is True if the steps are in one of the given
+                        states. False if they weren't within the timeout.
+        """
+        step_ids = list(extract_step_ids(self._find_steps(tags)))
+        return APIHandlerResponse(None, relay_value=DeferredResponse(self._wait_for_states, step_ids, states, timeout))
+
+    def _wait_for_states(self, step_ids, states, timeout):
+        in_states, _ = self._event_publisher.wait(
+            lambda step_states, _: all(step_states.get(step_id) in states for step_id in step_ids), timeout)
+        return APIHandlerResponse(in_states)
+
+    def list(self, if_changed_since=None, **tags):
+        """List all the steps' tags in a workflow (in topological order).
+
+        :param if_changed_since:    The version last seen by the caller. See the class docstring.
+        :param tags:                Any key=value pair provided in the arguments is treated as a tag, except for
+                                    dry_run=True.
+                                    Each step by default gets a tag viz., name=<action_function_name>.
+                                    If no keyword arguments are provided, this will list the tags of all the steps in
+                                    the workflow.
+        :return:                    An APIHandlerResponse object whose 'return_value' is the list of dictionaries (tags)
+                                    of the matching steps.
         """
-        return APIHandlerResponse([step.tags for step in self._steps if tags in step])
+        version = self._get_version(uses_states=False, uses_context=False)
+        return self._respond_with_cache(('list', freeze(tags)), version,
+                                        lambda: [step.tags for step in self._find_steps(tags)],
+                                        if_changed_since=if_changed_since)
 
-    def status(self, fields=None, states=None, **tags):
+    def status(self, fields=None, states=None, if_changed_since=None, tail=None, **tags):
         """Get workflow status.
 
         :param fields:  List of field names to return in the results. A list of strings from StatusField class.
@@ -224,8 +895,14 @@ class WorkflowAPIHandler:
                             StatusField.N: <Sequence number of the step>
                             StatusField.NAME: <Name of the step>
                         This is because without these fields, it will be impossible to uniquely identify the steps.
+                        The data that is needed only by the fields not requested is not read, e.g., the serialized
+                        context is not read unless I/O, output, return value or exception is requested.
         :param states:  List of strings that represent the states of a Step.
                         This will limit the status to only the steps that are in the given list of states.
+        :param if_changed_since:
+                        The version last seen by the caller. See the class docstring.
+        :param tail:    The maximum number (int) of the most recent I/O and output messages returned for each step.
+                        None means all of them.
         :param tags:    Any key=value pair provided in the arguments is treated as a tag, except for dry_run=True.
                         Each step by default gets a tag viz., name=<action_function_name>.
         :return:        An APIHandlerResponse object whose 'return_value' is the list of dictionaries, each containing
@@ -235,40 +912,197 @@ class WorkflowAPIHandler:
         """
         states = states or get_class_globals(State)
         fields = fields or get_class_globals(StatusField)
+        version = self._get_version(uses_context=bool(CONTEXT_STATUS_FIELDS.intersection(fields)),
+                                    uses_transitions=StatusField.ACTIONS in fields)
+        return self._respond_with_cache(('status', freeze(fields), freeze(states), tail, freeze(tags)), version,
+                                        lambda: self._make_status(fields, states, tags, tail=tail)[0],
+                                        if_changed_since=if_changed_since)
+
+    def status_page(self, cursor=0, limit=100, fields=None, states=None, if_changed_since=None, tail=None, **tags):
+        """Get a page of the workflow status. Pages are in the topological order of the steps.
+
+        :param cursor:  The position (int) from which the page starts. 0 means the first page. Pass the 'cursor'
+                        returned for a page to get the next page.
+        :param limit:   The maximum number of steps (int) in the page.
+        :param fields:  See status.
+        :param states:  See status.
+        :param if_changed_since:
+                        The version last seen by the caller. See the class docstring.
+        :param tail:    See status.
+        :param tags:    See status.
+        :return:        An APIHandlerResponse object whose 'return_value' is a dictionary of the form:
+                        {
+                            'steps': <The status of the matching steps in the page, as returned by status>,
+                            'cursor': <The cursor of the next page> or None if this is the last page,
+                        }
+                        Only the serialized data of the steps in the page are read from versioned context
+                        serializers (see workflow.helpers.context.IncrementalContextSerializer).
+        """
+        states = states or get_class_globals(State)
+        fields = fields or get_class_globals(StatusField)
+        version = self._get_version(uses_context=bool(CONTEXT_STATUS_FIELDS.intersection(fields)),
+                                    uses_transitions=StatusField.ACTIONS in fields)
+
+        def make_page():
+            statuses, next_cursor = self._make_status(fields, states, tags, tail=tail, cursor=cursor, limit=limit)
+            return {'steps': statuses, 'cursor': next_cursor}
+
+        return self._respond_with_cache(
+            ('status_page', cursor, limit, freeze(fields), freeze(states), tail, freeze(tags)), version, make_page,
+            if_changed_since=if_changed_since)
+
+    def cache_statistics(self, if_changed_since=None, **tags):
+        """Get the number of steps whose return values were found in (hits) or missing from (misses) their step result
+        cache in this run (see workflow.helpers.step.ContextWrapper). Steps without a cache are not counted.
+
+        :param if_changed_since:    The version last seen by the caller. See the class docstring.
+        :param tags:                Any key=value pair provided in the arguments is treated as a tag.
+                                    Each step by default gets a tag viz., name=<action_function_name>.
+        :return:                    An APIHandlerResponse object whose 'return_value' is a dictionary of the form:
+                                    {
+                                        'hits': <Number of steps whose last lookup was a hit (int)>,
+                                        'misses': <Number of steps whose last lookup was a miss (int)>,
+                                        'steps': {<Step ID>: <CacheResult.HIT or CacheResult.MISS>, ...},
+                                    }
+        """
+        version = self._get_version(uses_states=False)
+
+        def make_statistics():
+            steps = self._find_steps(tags)
+            all_step_data = self._get_step_data([step.id for step in steps], ['cache'])
+            outcomes = {step.id: all_step_data[step.id]['cache'] for step in steps
+                        if 'cache' in all_step_data.get(step.id, {})}
+            return {
+                'hits': sum(1 for outcome in outcomes.values() if outcome == CacheResult.HIT),
+                'misses': sum(1 for outcome in outcomes.values() if outcome == CacheResult.MISS),
+                'steps': outcomes,
+            }
+
+        return self._respond_with_cache(('cache_statistics', freeze(tags)), version, make_statistics,
+                                        if_changed_since=if_changed_since)
+
+    def resource_summary(self, sort_by=ResourceSortKey.CPU_TIME, limit=10, if_changed_since=None, **tags):
+        """Get the total resource usage of the steps and the steps that used the most, based on the usage measured for
+        the last run of each step (see the StatusField.RESOURCE_USAGE field of status). Steps that haven't completed
+        a run (or whose usage wasn't measured) are not counted.
+
+        :param sort_by:             The key from the ResourceSortKey namespace by which the steps are ranked.
+        :param limit:               The maximum number of steps (int) returned in 'top_steps'. None means all of them.
+        :param if_changed_since:    The version last seen by the caller. See the class docstring.
+        :param tags:                Any key=value pair provided in the arguments is treated as a tag.
+                                    Each step by default gets a tag viz., name=<action_function_name>.
+        :return:                    An APIHandlerResponse object whose 'return_value' is a dictionary of the form:
+                                    {
+                                        'steps': <Number of steps with a measured resource usage (int)>,
+                                        'wall_time': <Total wall time of the steps in seconds (float)>,
+                                        'cpu_time': <Total CPU time of the steps in seconds (float)>,
+                                        'top_steps': [
+                                            {
+                                                'n': <Step ID>,
+                                                'name': <Name of the step>,
+                                                <sort_by>: <The value by which the step is ranked>,
+                                                'resource_usage': <The resource usage of the step (dict)>,
+                                            },
+                                            ... # In descending order of the value of sort_by.
+                                        ],
+                                    }
+                                    The 'exception' is a ValueError if sort_by is unknown.
+        """
+        if sort_by not in RESOURCE_SORT_KEY_FUNCTIONS:
+            return APIHandlerResponse(None, exception=ValueError('Unknown sort key: {}. Valid keys are: {}.'.format(
+                sort_by, sorted(RESOURCE_SORT_KEY_FUNCTIONS))))
+        key_function = RESOURCE_SORT_KEY_FUNCTIONS[sort_by]
+        version = self._get_version(uses_states=False)
+
+        def make_summary():
+            steps = self._find_steps(tags)
+            all_step_data = self._get_step_data([step.id for step in steps], ['resource_usage'])
+            usages = [(step, all_step_data[step.id]['resource_usage']) for step in steps
+                      if all_step_data.get(step.id, {}).get('resource_usage') is not None]
+            ranked = sorted(usages, key=lambda step_usage: key_function(step_usage[1]), reverse=True)
+            return {
+                'steps': len(usages),
+                'wall_time': sum(usage['wall_time'] for _, usage in usages),
+                'cpu_time': sum(get_cpu_time(usage) for _, usage in usages),
+                'top_steps': [{'n': step.id, 'name': step.tags['name'], sort_by: key_function(usage),
+                               'resource_usage': usage} for step, usage in ranked[:limit]],
+            }
+
+        return self._respond_with_cache(('resource_summary', sort_by, limit, freeze(tags)), version, make_summary,
+                                        if_changed_since=if_changed_since)
+
+    def _get_step_data(self, step_ids, keys):
+        """Get the serialized data of the given steps, reading only their data and the given keys if the context
+        serializer allows it (see workflow.helpers.context.ContextSerializer), or if the serialized context has already
+        been copied for this snapshot. Otherwise, all the serialized context is copied.
+        """
+        context_serializer = self._callback_manager.context_serializer
+        if (self._snapshot is not None and 'context' in self._snapshot) or not hasattr(context_serializer,
+                                                                                        'get_step_data'):
+            return self._context_serialized['step_data']
+        return context_serializer.get_step_data(step_ids, keys=keys)
+
+    def _make_status(self, fields, states, tags, tail=None, cursor=0, limit=None):
+        """Make the status of the matching steps starting at the cursor.
+
+        :return:    A tuple of the form: (<Status of the steps as returned by status>, <The cursor of the next page or
+                    None if there are no more steps>)
+        """
+        self._update_state_index()
+        step_ids = self._state_index.find(states)
+        positions = self._tag_index.find_positions(tags)
+        steps = []
+        next_cursor = None
+        for position in positions[bisect_left(positions, cursor):]:
+            step = self._steps[position]
+            if step.id in step_ids:
+                if limit is not None and len(steps) == limit:
+                    next_cursor = position
+                    break
+                steps.append(step)
+
+        transitions = self._transitions if StatusField.ACTIONS in fields else None
+        all_step_data = {}
+        if CONTEXT_STATUS_FIELDS.intersection(fields):
+            all_step_data = self._get_step_data([step.id for step in steps], [
+                STATUS_FIELD_STEP_DATA_KEYS[field] for field in CONTEXT_STATUS_FIELDS.intersection(fields)])
 
         statuses = {}
-        for step in filter_steps_by_states(filter_steps_by_tags(self._steps, tags), self._states, states):
-            state = self._states[step.id]
-            step_data = self._context_serialized['step_data'].get(step.id, {})
+        for step in steps:
+            step_data = all_step_data.get(step.id, {})
             step_status = {StatusField.NAME: step.tags['name']}
             if StatusField.TAGS in fields:
                 step_status[StatusField.TAGS] = step.tags
             if StatusField.STATE in fields:
-                step_status[StatusField.STATE] = state
+                step_status[StatusField.STATE] = self._state_index.get_state(step.id)
             if StatusField.ACTIONS in fields:
-                step_status[StatusField.ACTIONS] = list(self._transitions[step.id])
+                step_status[StatusField.ACTIONS] = list(transitions[step.id])
             if StatusField.IO in fields:
-                step_status[StatusField.IO] = step_data.get('io', None)
+                step_status[StatusField.IO] = get_tail(step_data.get('io', None), tail)
             if StatusField.OUTPUT in fields:
-                step_status[StatusField.OUTPUT] = step_data.get('output', None)
+                step_status[StatusField.OUTPUT] = get_tail(step_data.get('output', None), tail)
             if StatusField.RETURN_VALUE in fields:
                 step_status[StatusField.RETURN_VALUE] = step_data.get('return_value', None)
             if StatusField.EXCEPTION in fields:
                 step_status[StatusField.EXCEPTION] = step_data.get('exception', None)
+            if StatusField.RESOURCE_USAGE in fields:
+                step_status[StatusField.RESOURCE_USAGE] = step_data.get('resource_usage', None)
             statuses[step.id] = step_status
-        return APIHandlerResponse(statuses)
+        return statuses, next_cursor
 
-    def steps_waiting_for_user_input(self, **tags):
+    def steps_waiting_for_user_input(self, if_changed_since=None, **tags):
         """Get status of steps that are waiting for user input.
         Limits the fields to only include the UNREPLIED_PROMPT_MESSAGE.
         Excludes steps that do not have any UNREPLIED_PROMPT_MESSAGE.
 
-        :param tags:    Any key=value pair provided in the arguments is treated as a tag, except for dry_run=True.
-                        Each step by default gets a tag viz., name=<action_function_name>.
-        :return:        An APIHandlerResponse object whose 'return_value' is the list of step IDs that are waiting for
-                        user input.
+        :param if_changed_since:    The version last seen by the caller. See the class docstring.
+        :param tags:                Any key=value pair provided in the arguments is treated as a tag, except for
+                                    dry_run=True.
+                                    Each step by default gets a tag viz., name=<action_function_name>.
+        :return:                    An APIHandlerResponse object whose 'return_value' is the list of step IDs that are
+                                    waiting for user input.
         """
-        return self.status(states=[State.RUNNING], fields=[StatusField.IO],  **tags)
+        return self.status(states=[State.RUNNING], fields=[StatusField.IO], if_changed_since=if_changed_since, **tags)
 
     def pause(self, dry_run=True, **tags):
         """Send message to pause steps.
@@ -282,8 +1116,8 @@ class WorkflowAPIHandler:
                         If no tags are provided, all possible steps will be marked to be paused.
         :return:        An APIHandlerResponse object whose 'return_value' is the list of step IDs that were paused.
         """
-        step_ids = list(extract_step_ids(filter_steps_by_action(filter_steps_by_tags(
-            self._steps, tags), self._transitions, Action.PAUSE)))
+        step_ids = list(extract_step_ids(filter_steps_by_action(
+            self._find_steps(tags), self._transitions, Action.PAUSE)))
         if not dry_run:
             self._callback_manager.actions_writer.send({step_id: Action.PAUSE for step_id in step_ids})
         return APIHandlerResponse(step_ids)
@@ -299,8 +1133,8 @@ class WorkflowAPIHandler:
                         If no tags are provided, all possible steps will be marked to be interrupted.
         :return:        An APIHandlerResponse object whose 'return_value' is the list of step IDs that were interrupted.
         """
-        step_ids = list(extract_step_ids(filter_steps_by_action(filter_steps_by_tags(
-            self._steps, tags), self._transitions, Action.INTERRUPT)))
+        step_ids = list(extract_step_ids(filter_steps_by_action(
+            self._find_steps(tags), self._transitions, Action.INTERRUPT)))
         if not dry_run:
             self._machine_api_client.interrupt(step_ids)
         return APIHandlerResponse(step_ids)
@@ -317,8 +1151,8 @@ class WorkflowAPIHandler:
                         If no tags are provided, all possible steps will be marked to be resumed.
         :return:        An APIHandlerResponse object whose 'return_value' is the list of step IDs that were resumed.
         """
-        step_ids = list(extract_step_ids(filter_steps_by_action(filter_steps_by_tags(
-            self._steps, tags), self._transitions, Action.RESUME)))
+        step_ids = list(extract_step_ids(filter_steps_by_action(
+            self._find_steps(tags), self._transitions, Action.RESUME)))
         if not dry_run:
             self._callback_manager.actions_writer.send({step_id: Action.RESUME for step_id in step_ids})
         return APIHandlerResponse(step_ids)
@@ -335,8 +1169,8 @@ class WorkflowAPIHandler:
                         If no tags are provided, all possible steps will be marked to be re-run.
         :return:        An APIHandlerResponse object whose 'return_value' is the list of step IDs that were re-run.
         """
-        step_ids = list(extract_step_ids(filter_steps_by_action(filter_steps_by_tags(
-            self._steps, tags), self._transitions, Action.RERUN)))
+        step_ids = list(extract_step_ids(filter_steps_by_action(
+            self._find_steps(tags), self._transitions, Action.RERUN)))
         if not dry_run:
             self._callback_manager.actions_writer.send({step_id: Action.RERUN for step_id in step_ids})
         return APIHandlerResponse(step_ids)
@@ -354,8 +1188,8 @@ class WorkflowAPIHandler:
         :return:        An APIHandlerResponse object whose 'return_value' is the list of step IDs that were marked to
                         be skipped.
         """
-        step_ids = list(extract_step_ids(filter_steps_by_action(filter_steps_by_tags(
-            self._steps, tags), self._transitions, Action.MARKSKIP)))
+        step_ids = list(extract_step_ids(filter_steps_by_action(
+            self._find_steps(tags), self._transitions, Action.MARKSKIP)))
         if not dry_run:
             self._callback_manager.actions_writer.send({step_id: Action.MARKSKIP for step_id in step_ids})
         return APIHandlerResponse(step_ids)
@@ -373,18 +1207,75 @@ class WorkflowAPIHandler:
         :return:        An APIHandlerResponse object whose 'return_value' is the list of step IDs that were unmarked
                         from being skipped.
         """
-        step_ids = list(extract_step_ids(filter_steps_by_action(filter_steps_by_tags(
-            self._steps, tags), self._transitions, Action.UNSKIP)))
+        step_ids = list(extract_step_ids(filter_steps_by_action(
+            self._find_steps(tags), self._transitions, Action.UNSKIP)))
         if not dry_run:
             self._callback_manager.actions_writer.send({step_id: Action.UNSKIP for step_id in step_ids})
         return APIHandlerResponse(step_ids)
 
 
-def make_api_client(socket_file, timeout=5):
+class WorkflowAPIClientWrapper(MethodAPIClientWrapper):
+    """A MethodAPIClientWrapper for the WorkflowAPIHandler.
+
+    The API calls that wait in the server (see WAITING_API_CALLS) are given the time they wait (their 'timeout'
+    argument, including its default) in addition to the client's timeout. Otherwise, a call like
+    wait_for_change(version) would time out in the client (returning None) while the server is still waiting.
+    API calls in batches (see MethodAPIClientWrapper.batch) use the client's timeout only.
+    """
+    def _get_timeout(self, method, args, kwargs):
+        """Get the timeout (in seconds) while waiting for the response to an API call. See the class docstring."""
+        if method not in WAITING_API_CALLS:
+            return self._timeout
+        try:
+            arguments = inspect.signature(getattr(WorkflowAPIHandler, method)).bind(None, *args, **kwargs)
+        except TypeError:
+            # The server responds with the error.
+            return self._timeout
+        arguments.apply_defaults()
+        return self._timeout + arguments.arguments['timeout']
+
+
+def make_api_client(socket_file, timeout=5, pool_size=None, authkey=None, codec=None):
     """Factory to create a MethodAPIClientWrapper that communicates using a SocketClient.
 
-    :param socket_file: A Unix socket file that will be used to communicate.
-    :param timeout:     The timeout (in seconds) while waiting for a response.
-    :return:            A MethodAPIClientWrapper that serves requests at the given Unix socket file.
+    :param socket_file: A Unix socket file that will be used to communicate. Or, a TCP address of the form:
+                        (<host (str)>, <port (int)>).
+    :param timeout:     The timeout (in seconds) while waiting for a response. API calls that wait in the server (e.g.,
+                        wait_for_change) wait for their own timeout in addition to this (see WorkflowAPIClientWrapper).
+    :param pool_size:   When given, a PooledSocketClient is used that keeps up to these many connections open and reuses
+                        them for subsequent API calls. When None, a new connection is made for every API call.
+    :param authkey:     The secret key (bytes) shared with the API server (see WorkflowManager). Required for TCP.
+    :param codec:       The codec used to encode the API calls and decode the responses. E.g.,
+                        core.api.management.CompactCodec(compress=True) to reduce the size of large status responses.
+                        None means they are pickled.
+    :return:            A WorkflowAPIClientWrapper that serves requests at the given Unix socket file.
+    """
+    if pool_size is None:
+        socket_client = SocketClient(socket_file, authkey=authkey, codec=codec)
+    else:
+        socket_client = PooledSocketClient(socket_file, pool_size, authkey=authkey, codec=codec)
+    return WorkflowAPIClientWrapper(socket_client, timeout=timeout)
+
+
+def make_subscription_client(socket_file, states=None, events=None, queue_size=1000, timeout=5, authkey=None,
+                             codec=None, **tags):
+    """Factory to create a SubscriptionClient that receives the events of a workflow (see EventType) as they happen.
+
+    E.g., to print the state changes and output of the steps named 'foo':
+        for event in make_subscription_client(socket_file, events=[EventType.STATE, EventType.OUTPUT], name='foo'):
+            print(event)
+
+    :param socket_file: A Unix socket file that will be used to communicate. Or, a TCP address of the form:
+                        (<host (str)>, <port (int)>).
+    :param states:      See WorkflowAPIHandler.subscribe.
+    :param events:      See WorkflowAPIHandler.subscribe.
+    :param queue_size:  See WorkflowAPIHandler.subscribe.
+    :param timeout:     The timeout (in seconds) while waiting for the response to the subscription request.
+    :param authkey:     The secret key (bytes) shared with the API server (see WorkflowManager). Required for TCP.
+    :param codec:       The codec used to encode the request and decode the events. None means they are pickled.
+    :param tags:        See WorkflowAPIHandler.subscribe.
+    :return:            A SubscriptionClient object.
     """
-    return MethodAPIClientWrapper(SocketClient(socket_file), timeout=timeout)
+    kwargs = dict(tags, states=states, events=events, queue_size=queue_size)
+    return SubscriptionClient(socket_file, APIRequest('subscribe', (), kwargs), timeout=timeout, authkey=authkey,
+                              codec=codec)
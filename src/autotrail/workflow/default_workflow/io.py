@@ -22,7 +22,24 @@ import sys
 
 from operator import itemgetter
 
-from autotrail.workflow.default_workflow.api import StatusField
+from autotrail.workflow.default_workflow.api import StatusField, get_cpu_time
+
+
+def format_resource_usage(resource_usage):
+    """Format the resource usage of a step as a single line, e.g., 'wall 1.52s, cpu 0.98s, max RSS 20480 KiB'.
+
+    :param resource_usage:  The resource usage of a step (see workflow.helpers.execution.get_resource_usage) or None.
+    :return:                A string. 'None' if the resource usage is None.
+    """
+    if resource_usage is None:
+        return str(None)
+    parts = ['wall {:.2f}s'.format(resource_usage['wall_time'])]
+    if 'user_time' in resource_usage:
+        parts.append('cpu {:.2f}s'.format(get_cpu_time(resource_usage)))
+        max_rss = max(resource_usage['max_rss'], resource_usage.get('children_max_rss', 0))
+        parts.append('max RSS {} KiB'.format(max_rss))
+        parts.append('block I/O {}/{}'.format(resource_usage['block_input'], resource_usage['block_output']))
+    return ', '.join(parts)
 
 
 def print_step_statuses(step_statuses, to):
@@ -41,7 +58,7 @@ def print_step_statuses(step_statuses, to):
     :return:                None
     """
     all_fields = {StatusField.NAME, StatusField.TAGS, StatusField.STATE, StatusField.ACTIONS, StatusField.IO,
-                  StatusField.RETURN_VALUE, StatusField.EXCEPTION}
+                  StatusField.RETURN_VALUE, StatusField.EXCEPTION, StatusField.RESOURCE_USAGE}
     single_value_fields = [StatusField.STATE, StatusField.RETURN_VALUE, StatusField.EXCEPTION]
     multi_value_fields = [StatusField.IO, StatusField.OUTPUT, StatusField.ACTIONS]
 
@@ -62,6 +79,8 @@ def print_step_statuses(step_statuses, to):
                         print(body.format(field=field, value=str(message)), file=to)
                 else:
                     print(body.format(field=field, value=step_status[field]), file=to)
+            elif field == StatusField.RESOURCE_USAGE:
+                print(body.format(field=field, value=format_resource_usage(step_status[field])), file=to)
             elif field == StatusField.TAGS:
                 for key, value in step_status[StatusField.TAGS].items():
                     print(body.format(field=field, value='{} = {}'.format(key, value)), file=to)
@@ -287,7 +306,7 @@ class InteractiveClientWrapper:
         printer = lambda result: self.step_list_printer(result, self.stdout)
         self._call_client_method('list', printer, **tags)
 
-    def status(self, fields=None, states=None, **tags):
+    def status(self, fields=None, states=None, tail=None, **tags):
         """Get trail status.
 
         :param fields:  List of field names to return in the results. A list of strings from StatusField class.
@@ -299,6 +318,8 @@ class InteractiveClientWrapper:
                         This is because without these fields, it will be impossible to uniquely identify the steps.
         :param states:  List of strings that represent the states of a Step.
                         This will limit the status to only the steps that are in the given list of states.
+        :param tail:    The maximum number (int) of the most recent I/O and output messages printed for each step.
+                        None means all of them.
         :param tags:    Any key=value pair provided in the arguments is treated as a tag, except for dry_run=True.
                         Each step by default gets a tag viz., name=<action_function_name>.
         :return:        None. Prints the status of each step that matches the given tags and states.
@@ -306,6 +327,8 @@ class InteractiveClientWrapper:
                         fields explained above.
         """
         printer = lambda result: self.status_printer(result, self.stdout)
+        if tail is not None:
+            tags['tail'] = tail
         self._call_client_method('status', printer, fields=fields, states=states, **tags)
 
     def steps_waiting_for_user_input(self, **tags):
@@ -20,10 +20,11 @@ from multiprocessing import Process
 
 from autotrail.core.state_machine import run_state_machine_evaluator
 from autotrail.core.api.management import MethodAPIHandlerWrapper, SocketServer
-from autotrail.core.api.callbacks import ManagedCallback
+from autotrail.core.api.callbacks import ManagedCallback, ObserverMode
 from autotrail.workflow.default_workflow.state_machine import (make_state_machine_definitions, APIHandlers, State,
                                                                ACTION_EVALUATIONS)
 from autotrail.workflow.default_workflow.api import WorkflowAPIHandler
+from autotrail.workflow.helpers.execution import start_process
 
 
 class WorkflowManager:
@@ -38,7 +39,8 @@ class WorkflowManager:
     """
     def __init__(self, success_pairs, failure_pairs, context, context_serializer, socket_file, workflow_delay=1,
                  api_delay=1, transition_rules=None, initial_state=State.READY, action_evaluations=None,
-                 final_callback_function=None, machine_serializer=None, api_handlers=None):
+                 final_callback_function=None, machine_serializer=None, api_handlers=None, adaptive_delay=False,
+                 observer_mode=ObserverMode.SERIAL, authkey=None):
         """Initialize the workflow manager.
 
         :param success_pairs:           A list of tuples. Each tuple is an ordered pair associating a step with its
@@ -51,10 +53,13 @@ class WorkflowManager:
         :param context_serializer:      A core.api.serializers.Serializer like callable that can be used to serialize
                                         the context object.
         :param socket_file:             The socket file name to be used for communicating with the workflow API server.
+                                        Or, a TCP address of the form: (<host (str)>, <port (int)>) to manage the
+                                        workflow from other hosts. An authkey is required for a TCP address.
         :param workflow_delay:          Introduce a delay in the loop of the state machine evaluations. This delay
                                         affects how frequently callbacks are called.
-        :param api_delay:               The delay used by the API server. This decides how frequently the server listens
-                                        for API messages.
+                                        When adaptive_delay is True, this is the ceiling of the delay.
+        :param api_delay:               Not used. The API server serves requests as soon as they are received. Accepted
+                                        for backwards compatibility.
         :param transition_rules:        The rules for state transitions as a mapping of the following form:
                                         {
                                             <State 1 (str)>: {
@@ -111,6 +116,15 @@ class WorkflowManager:
                                                                 call.
                                                    <Actions> is a mapping of the form:
                                                              {<Machine name>: <Action to take>}
+        :param adaptive_delay:          Boolean. When True, the state machines are evaluated without delay while steps
+                                        are changing states and the delay backs off up to workflow_delay while the
+                                        workflow is idle (e.g., waiting on long running or paused steps).
+        :param observer_mode:           A value from the core.api.callbacks.ObserverMode namespace deciding how the
+                                        recording of states and transitions and the serialization of the machines and
+                                        context are run. See core.api.callbacks.ManagedCallback.
+        :param authkey:                 The secret key (bytes) that API clients need to authenticate with (see
+                                        workflow.default_workflow.api.make_api_client). None means API clients are not
+                                        authenticated, which is allowed only for socket files.
         """
         steps = list(chain.from_iterable(success_pairs))
         steps.extend(list(chain.from_iterable(failure_pairs)))
@@ -130,15 +144,21 @@ class WorkflowManager:
                                                  context_serializer=context_serializer,
                                                  machine_serializer=machine_serializer,
                                                  delay=workflow_delay,
-                                                 final_callback_function=final_callback_function)
+                                                 final_callback_function=final_callback_function,
+                                                 adaptive_delay=adaptive_delay,
+                                                 observer_mode=observer_mode)
         self._workflow_process = run_state_machine_evaluator(self._state_machine_definitions, self._callback_manager)
         self._api_process = None
         self._api_delay = api_delay
 
         self._socket_file = socket_file
+        self._authkey = authkey
 
     def cleanup(self):
-        """Remove the socket file."""
+        """Remove the socket file (if a socket file is used)."""
+        if not isinstance(self._socket_file, str):
+            return
+
         try:
             os.remove(self._socket_file)
         except OSError:
@@ -146,10 +166,11 @@ class WorkflowManager:
 
     def start(self):
         """Start the workflow and API server processes."""
-        self._workflow_process.start()
+        start_process(self._workflow_process)
         workflow_api_handler = MethodAPIHandlerWrapper(
-            WorkflowAPIHandler(self._steps, self._callback_manager, self._workflow_process))
-        workflow_api_server = SocketServer(self._socket_file, workflow_api_handler, delay=self._api_delay, timeout=1)
+            WorkflowAPIHandler(self._steps, self._callback_manager, self._workflow_process.pid))
+        workflow_api_server = SocketServer(self._socket_file, workflow_api_handler, delay=self._api_delay, timeout=1,
+                                           authkey=self._authkey)
         self._api_process = Process(target=workflow_api_server)
         self._api_process.start()
 
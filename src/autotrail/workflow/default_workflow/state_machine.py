@@ -13,7 +13,14 @@
   limitations under the License.
 
 """
+from heapq import heappop, heappush
+from time import monotonic
+
 from autotrail.core.api.management import APIHandlerResponse
+from autotrail.workflow.helpers.results import discard_replaced_result
+
+
+DEFAULT_TIMEOUT_GRACE_PERIOD = 10   # Seconds a timed out step is given to exit after being terminated.
 
 
 class State:
@@ -51,6 +58,61 @@ class StepFailed(Exception):
     pass
 
 
+class StepTimedOut(Exception):
+    """The exception of a Step that was stopped because it ran for longer than its 'timeout' tag allows."""
+    pass
+
+
+class StepDeadlines:
+    """The deadlines of the running steps, kept in a heap so that checking for expired deadlines doesn't need a scan of
+    all the steps.
+
+    A step has at most one deadline. Setting a new one (or removing it) invalidates the previous one, which is discarded
+    lazily when it reaches the top of the heap.
+    The steps whose deadlines have passed are in the 'expired' instance attribute (set of step IDs) after calling
+    update().
+    Deadlines are in terms of time.monotonic(), so that changes to the system clock don't expire (or postpone) them.
+    """
+    def __init__(self):
+        """Initialize with no deadlines."""
+        self._heap = []
+        self._deadlines = {}
+        self.expired = set()
+
+    def set(self, step_id, deadline):
+        """Set the deadline of a step.
+
+        :param step_id:     The ID of the step.
+        :param deadline:    The time (as returned by time.monotonic) by which the step must have finished.
+        :return:            None
+        """
+        self._deadlines[step_id] = deadline
+        self.expired.discard(step_id)
+        heappush(self._heap, (deadline, step_id))
+
+    def remove(self, step_id):
+        """Remove the deadline of a step (if any).
+
+        :param step_id: The ID of the step.
+        :return:        None
+        """
+        self._deadlines.pop(step_id, None)
+        self.expired.discard(step_id)
+
+    def update(self, now=None):
+        """Move the steps whose deadlines have passed to 'expired'.
+
+        :param now: The current time. Defaults to time.monotonic().
+        :return:    None
+        """
+        now = monotonic() if now is None else now
+        while self._heap and self._heap[0][0] <= now:
+            deadline, step_id = heappop(self._heap)
+            if self._deadlines.get(step_id) == deadline:
+                del self._deadlines[step_id]
+                self.expired.add(step_id)
+
+
 TRANSITION_RULES = {
     # The rules for state transitions as a mapping of the following form:
     #     {
@@ -310,20 +372,37 @@ class AutomaticActions:
                                 <step id>: {
                                     'return_value': <The value returned by the step execution> or None,
                                     'exception': <The exception raised by the step> or None,
+                                    'resource_usage': <The resource usage of the run (dict), if measured (see
+                                                       workflow.helpers.execution.get_resource_usage)>,
                                 }
                             }
 
                         If the step raised the StepFailed exception, the string 'failure' will be returned.
                         If the step raised any other exception, the string 'tempfail' will be returned.
+
+                        A step with a 'timeout' tag (seconds) that runs for longer is terminated. If it doesn't exit
+                        within the grace period (the 'timeout_grace_period' tag, defaulting to
+                        DEFAULT_TIMEOUT_GRACE_PERIOD seconds), it is killed. The reason is recorded in the step data as
+                        'timeout', the exception is StepTimedOut and 'tempfail' is returned.
+                        Timeouts are checked whenever the steps are checked, i.e., as often as the state machines are
+                        evaluated.
         """
         result = step.get_result()
+        if 'timeout' in step.tags and 'step_deadlines' in context:
+            result = AutomaticActions.enforce_timeout(step, context, context['step_deadlines'], result)
         if result is None:
             return 'running'
 
         step_data = context['step_data'].setdefault(step.id, {})
         return_value, exception = result
+        discard_replaced_result(step_data.get('return_value'), return_value)
         step_data['return_value'] = return_value
         step_data['exception'] = exception
+        resource_usage = getattr(step, 'get_resource_usage', lambda: None)()
+        if resource_usage is None:
+            step_data.pop('resource_usage', None)
+        else:
+            step_data['resource_usage'] = resource_usage
 
         if exception is None:
             return 'success'
@@ -332,14 +411,57 @@ class AutomaticActions:
         else:
             return 'tempfail'
 
+    @staticmethod
+    def enforce_timeout(step, context, deadlines, result):
+        """Terminate (and then kill) a running step that has exceeded its timeout. See check_step.
+
+        :param step:        A step object
+        :param context:     The context dictionary.
+        :param deadlines:   The StepDeadlines object of the context.
+        :param result:      The result of the step (None if it hasn't finished). See check_step.
+        :return:            The result of the step. It is of the form (None, <StepTimedOut exception>) if the step has
+                            been stopped because of its timeout. None if it is still running (or being stopped).
+        """
+        step_data = context['step_data'].setdefault(step.id, {})
+        if 'timeout' in step_data:
+            # The step has been terminated and is given the grace period to exit.
+            if result is not None or not step.is_alive():
+                deadlines.remove(step.id)
+                return None, StepTimedOut(step_data['timeout'])
+        elif result is not None:
+            deadlines.remove(step.id)
+            return result
+
+        deadlines.update()
+        if step.id not in deadlines.expired:
+            return None
+
+        deadlines.remove(step.id)
+        if 'timeout' not in step_data:
+            step_data['timeout'] = 'Terminated after running for longer than the timeout of {} seconds.'.format(
+                step.tags['timeout'])
+            step.terminate()
+            deadlines.set(step.id, monotonic() + step.tags.get('timeout_grace_period', DEFAULT_TIMEOUT_GRACE_PERIOD))
+            return None
+
+        step_data['timeout'] = ('Killed after running for longer than the timeout of {} seconds and not exiting '
+                                'within the grace period.'.format(step.tags['timeout']))
+        getattr(step, 'kill', step.terminate)()
+        return None, StepTimedOut(step_data['timeout'])
+
     @staticmethod
     def start(step, context):
         """Execute a step by passing it the context.
 
+        If the step has a 'timeout' tag, its deadline is tracked in the context as 'step_deadlines' (see check_step).
+
         :param step:    A step object
         :param context: The context dictionary.
         :return:        None
         """
+        if 'timeout' in step.tags:
+            context['step_data'].get(step.id, {}).pop('timeout', None)
+            context.setdefault('step_deadlines', StepDeadlines()).set(step.id, monotonic() + step.tags['timeout'])
         step.start(context)
 
     @staticmethod
@@ -13,8 +13,19 @@
   limitations under the License.
 
 """
-from autotrail.core.api.management import read_messages
-from autotrail.core.api.serializers import SerializerCallable, Serializer
+import json
+import os
+
+from collections import deque
+from multiprocessing import Manager
+
+from autotrail.core.api.management import read_ready_messages
+from autotrail.core.api.serializers import Serializer
+
+
+# Optional keys in the data of a step that are recorded about its run (e.g., by workflow.helpers.step.ContextWrapper)
+# and serialized as they are, only if present. Their values must be replaced (not mutated) when they change.
+STEP_INFO_KEYS = ['cache', 'timeout', 'resource_usage']
 
 
 def make_context(**kwargs):
@@ -35,66 +46,451 @@ def make_context(**kwargs):
     return context
 
 
-def serialize_step_data(context, timeout=0.1):
+def make_spill_file_name(run_directory, step_id, key):
+    """Make the path of the file to which the messages of a step are spilled.
+
+    :param run_directory:   The directory to which the messages are spilled.
+    :param step_id:         The ID of the step.
+    :param key:             The key under which the messages are stored, i.e., 'io' or 'output'.
+    :return:                The path of the file (str).
+    """
+    return os.path.join(run_directory, 'step_{}.{}.log'.format(step_id, key))
+
+
+def append_step_messages(step_id, step_data, key, messages, buffer_size=None, run_directory=None):
+    """Append the given messages to the step data under the given key.
+
+    :param step_id:         The ID of the step.
+    :param step_data:       The data of the step in the context (see serialize_step_data).
+    :param key:             The key under which the messages are stored, i.e., 'io' or 'output'.
+    :param messages:        A list of messages.
+    :param buffer_size:     The maximum number of recent messages to keep in memory (int). When given, the messages are
+                            stored in a collections.deque of this size and the total number of messages is counted under
+                            '<key>_count'. None means all the messages are kept in a list.
+    :param run_directory:   The directory to which all the messages are spilled. When given, each message is appended
+                            as a line of JSON to a per-step file (see make_spill_file_name). Messages that can't be
+                            encoded as JSON are written as their repr(). The total number of messages is counted under
+                            '<key>_count'. The file is truncated when the first messages of the step data are spilled,
+                            so that a file left by a previous run (e.g., in a reused run directory) doesn't offset the
+                            messages of this one.
+    :return:                None
+    """
+    if buffer_size is not None and not isinstance(step_data.get(key), deque):
+        step_data[key] = deque(step_data.get(key, []), maxlen=buffer_size)
+    step_data.setdefault(key, []).extend(messages)
+
+    if buffer_size is None and run_directory is None:
+        return
+
+    spilled_count = step_data.get('{}_count'.format(key), 0)
+    step_data['{}_count'.format(key)] = spilled_count + len(messages)
+    if run_directory is not None:
+        file_name = make_spill_file_name(run_directory, step_id, key)
+        with open(file_name, 'a' if spilled_count else 'w') as spill_file:
+            spill_file.writelines(json.dumps(message, default=repr) + '\n' for message in messages)
+
+
+def read_step_messages(file_name, offset=0, limit=None):
+    """Read the messages spilled to the given file starting from the given offset.
+
+    :param file_name:   The path of a file written by append_step_messages.
+    :param offset:      The offset (in bytes) from which to read. Use the offset returned by a previous call to read
+                        subsequent messages.
+    :param limit:       The maximum number of messages to read (int). None means all the available messages.
+    :return:            A tuple of the form: (<List of messages>, <Offset of the next message>)
+    """
+    messages = []
+    with open(file_name, 'rb') as spill_file:
+        spill_file.seek(offset)
+        while limit is None or len(messages) < limit:
+            line = spill_file.readline()
+            if not line.endswith(b'\n'):
+                # Either the end of the file or a line that is still being written.
+                break
+            messages.append(json.loads(line.decode('utf-8')))
+            offset += len(line)
+    return messages, offset
+
+
+def serialize_step_data(context, timeout=0, buffer_size=None, run_directory=None):
     """Serialize the step data in the context dictionary.
 
-    :param context: The context mapping of the following form:
-                    {
-                        'step_data': {
-                            <step id>: {
-                                # All fields are optional in this sub-dictionary
-                                'rw_connection':    The connection used to for two-way communication with a step.
-                                'ro_connection':    The connection used for one-way communication out of a step.
-                                'io':               The I/O messages collected from a step.
-                                'output':           The output messages collected from a step.
-                                'return_value:      The return value of running a step.
-                                'exception':        The exception raised by the step.
-                            },
-                            ...
-                        }
-                        # Other custom fields.
-                        ...
-                    }
-    :param timeout: The timeout in seconds to wait for messages from the step (I/O and output).
-    :return:        A dictionary of the form:
-                    {
-                        <ID of Step 1>: {
-                            'return_value': <The value returned by running the step> or None,
-                            'exception': <Any exception raised by the step> or None,
-                            'io': <List of messages sent to and from the step> or [],
-                            'output': <List of output messages sent from the step> or [],
-                        },
-                        ...
-                    }
+    The connections of all the steps are read with a single wait and only the connections that are ready are drained.
+
+    :param context:         The context mapping of the following form:
+                            {
+                                'step_data': {
+                                    <step id>: {
+                                        # All fields are optional in this sub-dictionary
+                                        'rw_connection':    The connection used to for two-way communication with a
+                                                            step.
+                                        'ro_connection':    The connection used for one-way communication out of a step.
+                                        'io':               The I/O messages collected from a step.
+                                        'output':           The output messages collected from a step.
+                                        'return_value:      The return value of running a step.
+                                        'exception':        The exception raised by the step.
+                                        <Any key in STEP_INFO_KEYS>: Information about the run of the step.
+                                    },
+                                    ...
+                                }
+                                # Other custom fields.
+                                ...
+                            }
+    :param timeout:         The timeout in seconds to wait for messages from any of the steps (I/O and output).
+                            Defaults to 0, i.e., only the messages already available are read.
+    :param buffer_size:     The maximum number of recent I/O and output messages kept in memory per step. None means
+                            all the messages are kept. See append_step_messages.
+    :param run_directory:   The directory to which all the I/O and output messages of each step are spilled. None means
+                            the messages are not spilled. See append_step_messages.
+    :return:                A dictionary of the form:
+                            {
+                                <ID of Step 1>: {
+                                    'return_value': <The value returned by running the step> or None,
+                                    'exception': <Any exception raised by the step> or None,
+                                    'io': <List of messages sent to and from the step> or [],
+                                    'output': <List of output messages sent from the step> or [],
+                                },
+                                ...
+                            }
+                            When either buffer_size or run_directory is given, 'io' and 'output' contain only the
+                            recent messages and the following keys are present as well:
+                                'io_count': <Total number of I/O messages>,
+                                'output_count': <Total number of output messages>,
+                            When run_directory is given, the following keys are present as well:
+                                'io_file': <Path of the file with all the I/O messages>,
+                                'output_file': <Path of the file with all the output messages>,
+                            The keys in STEP_INFO_KEYS are present only if they are in the step data.
     """
-    serialized_step_data = {}
-    for step_id, step_data in context['step_data'].items():
-        io = list(read_messages(step_data['rw_connection'], timeout=timeout)) \
-            if 'rw_connection' in step_data else []
-        output = list(read_messages(step_data['ro_connection'], timeout=timeout)) \
-            if 'ro_connection' in step_data else []
-        step_data.setdefault('io', []).extend(io)
-        step_data.setdefault('output', []).extend(output)
+    # A copy of the items is iterated over since this may be run concurrently with callbacks that add step data.
+    all_step_data = list(context['step_data'].items())
+
+    connection_destinations = {}
+    for step_id, step_data in all_step_data:
+        if 'rw_connection' in step_data:
+            connection_destinations[step_data['rw_connection']] = (step_id, step_data, 'io')
+        if 'ro_connection' in step_data:
+            connection_destinations[step_data['ro_connection']] = (step_id, step_data, 'output')
 
+    for connection, messages in read_ready_messages(connection_destinations, timeout=timeout).items():
+        step_id, step_data, key = connection_destinations[connection]
+        append_step_messages(step_id, step_data, key, messages, buffer_size=buffer_size, run_directory=run_directory)
+
+    serialized_step_data = {}
+    for step_id, step_data in all_step_data:
         serialized_step_data[step_id] = {
             'return_value': step_data.get('return_value'),
             'exception': step_data.get('exception'),
-            'io': step_data['io'],
-            'output': step_data['output']
+            'io': step_data.setdefault('io', []),
+            'output': step_data.setdefault('output', [])
         }
+        for key in STEP_INFO_KEYS:
+            if key in step_data:
+                serialized_step_data[step_id][key] = step_data[key]
+        if buffer_size is not None or run_directory is not None:
+            for key in ['io', 'output']:
+                serialized_step_data[step_id][key] = list(step_data[key])
+                serialized_step_data[step_id]['{}_count'.format(key)] = step_data.get('{}_count'.format(key), 0)
+        if run_directory is not None:
+            for key in ['io', 'output']:
+                serialized_step_data[step_id]['{}_file'.format(key)] = make_spill_file_name(run_directory, step_id,
+                                                                                            key)
     return serialized_step_data
 
 
-def make_context_serializer(context):
+def get_step_data_keys(buffer_size=None, run_directory=None):
+    """Get the keys of the serialized step data (see serialize_step_data).
+
+    :param buffer_size:     The buffer size the step data is serialized with. See serialize_step_data.
+    :param run_directory:   The run directory the step data is serialized with. See serialize_step_data.
+    :return:                A list of keys (str).
+    """
+    keys = ['return_value', 'exception', 'io', 'output'] + STEP_INFO_KEYS
+    if buffer_size is not None or run_directory is not None:
+        keys.extend(['io_count', 'output_count'])
+    if run_directory is not None:
+        keys.extend(['io_file', 'output_file'])
+    return keys
+
+
+class ContextSerializer(Serializer):
+    """A Serializer of the step data in the context that publishes it key by key (e.g., all the return values together),
+    so that readers can copy only the keys they need (see get_step_data) instead of all the step data (e.g., the I/O
+    and output messages).
+
+    The 'serialized' instance attribute is a multiprocessing.Manager dictionary of the form:
+        {
+            <Key of the step data, e.g., 'return_value'>: {<Step ID>: <Value>, ...},
+            ...
+        }
+    The step data in the form returned by serialize_step_data is available with snapshot().
+    """
+    def __init__(self, context, buffer_size=None, run_directory=None):
+        """Setup the context to be serialized.
+
+        :param context:         The context mapping. See serialize_step_data.
+        :param buffer_size:     The maximum number of recent I/O and output messages kept in memory per step.
+                                See serialize_step_data.
+        :param run_directory:   The directory to which all the I/O and output messages of each step are spilled.
+                                See serialize_step_data.
+        """
+        super().__init__([])
+        self._context = context
+        self._buffer_size = buffer_size
+        self._run_directory = run_directory
+        self._keys = get_step_data_keys(buffer_size=buffer_size, run_directory=run_directory)
+
+    def __call__(self):
+        """Serialize the step data in the context and publish it key by key.
+
+        :return: None
+        """
+        # Every key is published (even if no step has it) so that the values of the keys removed from the step data
+        # are removed too.
+        values = {key: {} for key in self._keys}
+        for step_id, serialized_step_data in serialize_step_data(self._context, buffer_size=self._buffer_size,
+                                                                 run_directory=self._run_directory).items():
+            for key, value in serialized_step_data.items():
+                values[key][step_id] = value
+        self.serialized.update(values)
+
+    def snapshot(self):
+        """Get a copy of all the published step data.
+
+        :return: A dictionary of the form: {'step_data': <The step data as returned by serialize_step_data>}
+        """
+        return {'step_data': self._group_by_step(self.serialized.copy())}
+
+    @staticmethod
+    def _group_by_step(values):
+        """Turn {<Key>: {<Step ID>: <Value>, ...}, ...} into {<Step ID>: {<Key>: <Value>, ...}, ...}."""
+        step_data = {}
+        for key, step_values in values.items():
+            for step_id, value in step_values.items():
+                step_data.setdefault(step_id, {})[key] = value
+        return step_data
+
+    def get_step_data(self, step_ids, keys=None):
+        """Get a copy of the published data of the given steps only, copying only the given keys.
+
+        :param step_ids:    An iterable of step IDs.
+        :param keys:        The keys of the step data (list) to get. None means all of them.
+        :return:            A dictionary of the form: {<Step ID>: <Serialized data of the step>, ...}, which excludes
+                            the steps that have no published data. The data of each step has only the given keys.
+        """
+        step_ids = set(step_ids)
+        values = {key: self.serialized.get(key, {}) for key in (self._keys if keys is None else keys)}
+        return self._group_by_step({
+            key: {step_id: value for step_id, value in step_values.items() if step_id in step_ids}
+            for key, step_values in values.items()})
+
+
+def make_context_serializer(context, buffer_size=None, run_directory=None):
     """Factory to make a Serializer object for the step data in the context.
 
-    :param context: A dictionary of the following form:
-                    {
-                        'step_data': {},
-                        # Any custom key-value pairs.
-                        ...
-                    }
-    :return:        A Serializer object that will serialize the 'step_data' attribute in the context. All other
-                    keys will be ignored.
+    :param context:         A dictionary of the following form:
+                            {
+                                'step_data': {},
+                                # Any custom key-value pairs.
+                                ...
+                            }
+    :param buffer_size:     The maximum number of recent I/O and output messages kept in memory per step. None means
+                            all the messages are kept. See serialize_step_data.
+    :param run_directory:   The directory to which all the I/O and output messages of each step are spilled. It is
+                            created if it doesn't exist. None means the messages are not spilled.
+                            See serialize_step_data.
+    :return:                A ContextSerializer object that will serialize the 'step_data' attribute in the context.
+                            All other keys will be ignored.
+    """
+    if run_directory is not None:
+        os.makedirs(run_directory, exist_ok=True)
+    return ContextSerializer(context, buffer_size=buffer_size, run_directory=run_directory)
+
+
+def make_step_data_signature(serialized_step_data):
+    """Make a signature of the serialized data of a step that changes whenever the data changes. Signatures are
+    compared with step_data_signatures_match.
+
+    The signature holds the return value, exception and the values of the keys in STEP_INFO_KEYS themselves (not their
+    ids, which are reused once the objects are freed). They are replaced (not mutated) when a step is run.
+    The I/O and output messages are only ever appended to, so their counts (or lengths) are sufficient.
+
+    :param serialized_step_data:    A dictionary of the form (see serialize_step_data):
+                                    {
+                                        'return_value': <The value returned by running the step> or None,
+                                        'exception': <Any exception raised by the step> or None,
+                                        'io': <List of messages sent to and from the step> or [],
+                                        'output': <List of output messages sent from the step> or [],
+                                    }
+    :return:                        A tuple representing the signature.
+    """
+    return ((serialized_step_data['return_value'], serialized_step_data['exception'],
+             serialized_step_data.get('io_count', len(serialized_step_data['io'])),
+             serialized_step_data.get('output_count', len(serialized_step_data['output'])))
+            + tuple(serialized_step_data.get(key) for key in STEP_INFO_KEYS))
+
+
+def step_data_signatures_match(signature, other_signature):
+    """Check if two signatures made by make_step_data_signature are of the same step data.
+
+    Each value matches if it is the same object or an equal object of the same type. Values that can't be compared
+    (e.g., whose comparison raises an exception) don't match unless they are the same object.
+
+    :param signature:       A signature made by make_step_data_signature.
+    :param other_signature: Another signature made by make_step_data_signature or None.
+    :return:                True if the signatures match. False otherwise.
+    """
+    if other_signature is None or len(signature) != len(other_signature):
+        return False
+    for value, other_value in zip(signature, other_signature):
+        if value is other_value:
+            continue
+        try:
+            if type(value) is not type(other_value) or not bool(value == other_value):
+                return False
+        except Exception:
+            return False
+    return True
+
+
+class IncrementalContextSerializer:
+    """A Serializer like callable that publishes only the data of the steps that changed since the previous call.
+
+    Every call that publishes changes increments a version number. The data of each step is published along with the
+    version in which it was last changed, so that readers can ask for the changes since a version they have seen.
+
+    The following instance attributes are available (all of them are multiprocessing.Manager shared objects):
+    serialized: A dictionary of the form:
+                {
+                    <ID of Step 1>: {
+                        'return_value': <The value returned by running the step> or None,
+                        'exception': <Any exception raised by the step> or None,
+                        'io': <List of messages sent to and from the step> or [],
+                        'output': <List of output messages sent from the step> or [],
+                        'version': <The version in which the data of this step last changed>,
+                        # The message counts and files when buffer_size or run_directory is given.
+                    },
+                    ...
+                }
+    versions:   A dictionary of the form: {<ID of Step 1>: <The version in which its data last changed>, ...}
+    version:    A multiprocessing.Manager Value containing the latest version.
+    """
+    def __init__(self, context, timeout=0, buffer_size=None, run_directory=None):
+        """Setup the context to be serialized and the shared objects to publish it.
+
+        :param context:         The context mapping. See serialize_step_data.
+        :param timeout:         The timeout in seconds to wait for messages from any of the steps.
+                                See serialize_step_data.
+        :param buffer_size:     The maximum number of recent I/O and output messages kept in memory per step.
+                                See serialize_step_data.
+        :param run_directory:   The directory to which all the I/O and output messages of each step are spilled. It is
+                                created if it doesn't exist. See serialize_step_data.
+        """
+        self._context = context
+        self._timeout = timeout
+        self._buffer_size = buffer_size
+        self._run_directory = run_directory
+        if run_directory is not None:
+            os.makedirs(run_directory, exist_ok=True)
+        self._signatures = {}
+        self._version = 0
+
+        manager = Manager()
+        self.serialized = manager.dict()
+        self.versions = manager.dict()
+        self.version = manager.Value('i', 0)
+
+    def __call__(self):
+        """Serialize the step data in the context and publish the data of the steps that changed.
+
+        :return: None
+        """
+        changed_step_data = {}
+        for step_id, serialized_step_data in serialize_step_data(self._context, timeout=self._timeout,
+                                                                 buffer_size=self._buffer_size,
+                                                                 run_directory=self._run_directory).items():
+            signature = make_step_data_signature(serialized_step_data)
+            if not step_data_signatures_match(signature, self._signatures.get(step_id)):
+                self._signatures[step_id] = signature
+                changed_step_data[step_id] = serialized_step_data
+
+        if not changed_step_data:
+            return
+
+        self._version += 1
+        for serialized_step_data in changed_step_data.values():
+            serialized_step_data['version'] = self._version
+        self.serialized.update(changed_step_data)
+        self.versions.update({step_id: self._version for step_id in changed_step_data})
+        self.version.value = self._version
+
+    def snapshot(self):
+        """Get a copy of all the published step data.
+
+        :return: A dictionary of the form: {'step_data': <A copy of the 'serialized' instance attribute>}
+        """
+        return {'step_data': dict(self.serialized)}
+
+    def get_step_data(self, step_ids, keys=None):
+        """Get a copy of the published data of the given steps only.
+
+        :param step_ids:    An iterable of step IDs.
+        :param keys:        The keys of the step data (list) to return. None means all of them. The data of each step is
+                            published (and copied) as a whole, so use ContextSerializer to copy only some keys.
+        :return:            A dictionary of the form: {<Step ID>: <Serialized data of the step>, ...}, which excludes
+                            the steps that have no published data.
+        """
+        step_ids = list(step_ids)
+        # Fetching each step is a round trip to the manager. When most steps are needed, one copy of all is cheaper.
+        if len(step_ids) > len(self.serialized) // 2:
+            all_step_data = dict(self.serialized)
+            step_data = {step_id: all_step_data[step_id] for step_id in step_ids if step_id in all_step_data}
+        else:
+            step_data = {step_id: self.serialized.get(step_id) for step_id in step_ids}
+            step_data = {step_id: data for step_id, data in step_data.items() if data is not None}
+        if keys is None:
+            return step_data
+        return {step_id: {key: data[key] for key in keys if key in data} for step_id, data in step_data.items()}
+
+    def changes(self, since_version=0):
+        """Get the data of the steps that changed after the given version.
+
+        :param since_version:   The version (int) last seen by the reader. 0 means all the step data.
+        :return:                A dictionary of the form:
+                                {
+                                    'version': <The latest version (int)>,
+                                    'step_data': {<Step ID>: <Serialized data of the step>, ...}
+                                }
+                                Where 'step_data' has only the steps that changed after since_version.
+        """
+        version = self.version.value
+        versions = dict(self.versions)
+        changed_step_ids = [step_id for step_id, step_version in versions.items() if step_version > since_version]
+
+        # Fetching each step is a round trip to the manager. When most steps changed, one copy of all is cheaper.
+        if len(changed_step_ids) > len(versions) // 2:
+            step_data = dict(self.serialized)
+            step_data = {step_id: step_data[step_id] for step_id in changed_step_ids if step_id in step_data}
+        else:
+            step_data = {step_id: self.serialized[step_id] for step_id in changed_step_ids}
+
+        return {'version': max([version] + [data['version'] for data in step_data.values()]),
+                'step_data': step_data}
+
+
+def make_incremental_context_serializer(context, buffer_size=None, run_directory=None):
+    """Factory to make an IncrementalContextSerializer object for the step data in the context.
+
+    :param context:         A dictionary of the following form:
+                            {
+                                'step_data': {},
+                                # Any custom key-value pairs.
+                                ...
+                            }
+    :param buffer_size:     The maximum number of recent I/O and output messages kept in memory per step.
+                            See serialize_step_data.
+    :param run_directory:   The directory to which all the I/O and output messages of each step are spilled.
+                            See serialize_step_data.
+    :return:                An IncrementalContextSerializer object that will serialize the 'step_data' attribute in the
+                            context and publish only the steps that changed. All other keys will be ignored.
     """
-    return Serializer([SerializerCallable(context, key='step_data', serializer_function=serialize_step_data)])
+    return IncrementalContextSerializer(context, buffer_size=buffer_size, run_directory=run_directory)
@@ -13,14 +13,36 @@
   limitations under the License.
 
 """
+import asyncio
+import gc
+import inspect
 import logging
+import os
+import resource
 
+from concurrent.futures import ThreadPoolExecutor, wait as wait_for_futures
 from functools import wraps
-from multiprocessing import Process, Queue
+from itertools import count
+from multiprocessing import Pipe, Process, Queue, get_start_method, parent_process, set_forkserver_preload
+from multiprocessing import set_start_method as set_multiprocessing_start_method
+from multiprocessing.connection import wait
+from multiprocessing.reduction import ForkingPickler
+from multiprocessing.util import Finalize
 from queue import Empty
+from threading import Event, local
+from time import monotonic
+from weakref import WeakKeyDictionary, WeakValueDictionary, ref as weak_reference
+
+from autotrail.workflow.helpers.results import StoreLargeResult, get_default_result_store
 
 
 logger = logging.getLogger(__name__)
+_thread_state = local()
+_freeze_gc = False
+_runners = WeakValueDictionary()
+
+# The time in seconds that a terminated worker of a WorkerPool is waited for before it is left to exit on its own.
+WORKER_STOP_TIMEOUT = 0.1
 
 
 def exception_safe_call(function, *args, **kwargs):
@@ -45,6 +67,139 @@ def exception_safe_call(function, *args, **kwargs):
     return (return_value, exception)
 
 
+class UsageScope:
+    """Namespace for what the resource usage of a run can be attributed to, depending on how it is run."""
+    PROCESS = 'process'     # The process (and its children) runs only this function at a time.
+    THREAD = 'thread'       # The thread runs only this function at a time, in a process shared with others.
+    WALL_TIME = 'wall time' # Only the wall time can be attributed, e.g., coroutines sharing an event loop.
+
+
+def get_resource_usage(start, scope=UsageScope.PROCESS):
+    """Get the resource usage since the given start.
+
+    :param start:   The value returned by this function when the measurement started. None to start a measurement.
+    :param scope:   A value from the UsageScope namespace.
+    :return:        When start is None, an opaque value to pass as the start. Otherwise, a dictionary of the form:
+                    {
+                        'wall_time': <Seconds (float)>,
+                        'user_time': <User CPU seconds (float)>,
+                        'system_time': <System CPU seconds (float)>,
+                        'max_rss': <Maximum resident set size of the process (int), in kilobytes>,
+                        'block_input': <Number of block input operations (int)>,
+                        'block_output': <Number of block output operations (int)>,
+                        'children_user_time': <User CPU seconds of the terminated child processes (float)>,
+                        'children_system_time': <System CPU seconds of the terminated child processes (float)>,
+                        'children_max_rss': <Maximum resident set size of the largest child process (int)>,
+                    }
+                    Only 'wall_time' is present for UsageScope.WALL_TIME. The child process keys are only present for
+                    UsageScope.PROCESS. The maximum resident set sizes are those of the processes (not of this run).
+    """
+    usage = [monotonic()]
+    if scope == UsageScope.PROCESS:
+        usage.extend([resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)])
+    elif scope == UsageScope.THREAD:
+        usage.append(resource.getrusage(getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)))
+    if start is None:
+        return usage
+
+    resource_usage = {'wall_time': usage[0] - start[0]}
+    if len(usage) > 1:
+        resource_usage.update({
+            'user_time': usage[1].ru_utime - start[1].ru_utime,
+            'system_time': usage[1].ru_stime - start[1].ru_stime,
+            'max_rss': usage[1].ru_maxrss,
+            'block_input': usage[1].ru_inblock - start[1].ru_inblock,
+            'block_output': usage[1].ru_oublock - start[1].ru_oublock,
+        })
+    if len(usage) > 2:
+        resource_usage.update({
+            'children_user_time': usage[2].ru_utime - start[2].ru_utime,
+            'children_system_time': usage[2].ru_stime - start[2].ru_stime,
+            'children_max_rss': usage[2].ru_maxrss,
+        })
+    return resource_usage
+
+
+class MeasuredResult:
+    """The result of a run of a function along with its resource usage. See MeasureResourceUsage."""
+    def __init__(self, return_value, exception, resource_usage):
+        """Define the result.
+
+        :param return_value:    The value returned by the function.
+        :param exception:       The exception raised by the function or None.
+        :param resource_usage:  The resource usage as returned by get_resource_usage.
+        """
+        self.return_value = return_value
+        self.exception = exception
+        self.resource_usage = resource_usage
+
+
+class MeasureResourceUsage:
+    """Wraps a function such that the process running it measures its resource usage.
+
+    Calling the wrapper returns a MeasuredResult (instead of the value returned or the exception raised by the
+    function), which ExceptionSafeSubProcessFunction unpacks. Coroutine functions are supported; the usage is measured
+    until the coroutine returns.
+    """
+    def __init__(self, function, scope=UsageScope.PROCESS):
+        """Define the function.
+
+        :param function:    The callable being wrapped.
+        :param scope:       A value from the UsageScope namespace. See get_resource_usage.
+        """
+        self.function = function
+        self.scope = scope
+
+    def __call__(self, *args, **kwargs):
+        """Call the function and measure its resource usage.
+
+        :param args:    Args for the function.
+        :param kwargs:  Kwargs for the function.
+        :return:        A MeasuredResult. If the function returns an awaitable, a coroutine returning the same.
+        """
+        start = get_resource_usage(None, self.scope)
+        try:
+            return_value = self.function(*args, **kwargs)
+        except Exception as e:
+            logger.exception(e)
+            return MeasuredResult(None, e, get_resource_usage(start, self.scope))
+
+        if inspect.isawaitable(return_value):
+            return self._measure_later(return_value, start)
+        return MeasuredResult(return_value, None, get_resource_usage(start, self.scope))
+
+    async def _measure_later(self, awaitable, start):
+        try:
+            return_value = await awaitable
+        except Exception as e:
+            logger.exception(e)
+            return MeasuredResult(None, e, get_resource_usage(start, self.scope))
+        return MeasuredResult(return_value, None, get_resource_usage(start, self.scope))
+
+
+def make_runner(function, result_store, scope):
+    """Make the callable that runs the function of an ExceptionSafeSubProcessFunction, i.e., the function wrapped to
+    store its large return values (see StoreLargeResult) and measure its resource usage (see MeasureResourceUsage).
+
+    The same runner is returned for the same function, store and scope as long as the runner is in use (e.g., by an
+    ExceptionSafeSubProcessFunction) so that executors that send registered functions by reference (e.g., WorkerPool)
+    keep recognising a function run by several steps. The runners are only weakly referenced here, so they (along with
+    the function and store) are released once they are no longer used.
+
+    :param function:        The callable being wrapped.
+    :param result_store:    A LargeResultStore object or None to not store large return values.
+    :param scope:           A value from the UsageScope namespace.
+    :return:                A MeasureResourceUsage object.
+    """
+    # The runner references the function and store, so their ids can't be reused by other objects while it is cached.
+    key = (id(function), id(result_store), scope)
+    runner = _runners.get(key)
+    if runner is None:
+        wrapped_function = function if result_store is None else StoreLargeResult(function, result_store)
+        runner = _runners[key] = MeasureResourceUsage(wrapped_function, scope)
+    return runner
+
+
 def make_exception_safe(function):
     """Transparently wrap the given function by catching any exceptions it may raise and return the return value and
     exception as a tuple.
@@ -93,38 +248,1121 @@ def run_function_as_execption_safe_subprocess(function, *args, **kwargs):
                                                     If no exception is raised, this will be None.
     """
     result_queue = Queue()
-    process = Process(
-        target=call_with_result_callback,
-        args=(make_exception_safe(function), result_queue.put),
-        kwargs=dict(
-            # Args and kwargs for the function go here.
-            args=args,
-            kwargs=kwargs))
-    process.start()
+    process = Process(target=run_exception_safe, args=(function, result_queue, args, kwargs))
+    start_process(process)
     return process, result_queue
 
 
+def run_exception_safe(function, result_queue, args, kwargs):
+    """Call the function in an exception safe manner and put the result in the queue. This is the target of the
+    sub-processes started by run_function_as_execption_safe_subprocess, which needs to be a module level function for
+    the 'spawn' and 'forkserver' start methods.
+
+    :param function:        The function to be called.
+    :param result_queue:    A multiprocessing.Queue to which the tuple of the form (<return_value>, <exception>) is put.
+                            See exception_safe_call.
+    :param args:            Args for function.
+    :param kwargs:          Kwargs for function.
+    :return:                None
+    """
+    result_queue.put(exception_safe_call(function, *args, **kwargs))
+
+
+def set_start_method(start_method, preload_modules=None):
+    """Set the method used to start all the processes, i.e., the state machine evaluator, the API server and the
+    processes running the steps.
+
+    With the 'forkserver' start method, processes are forked from a small server process instead of the (possibly
+    large) process starting them, so the time to start a step and its memory don't grow with the size of the
+    evaluator. The 'spawn' and 'forkserver' start methods need the steps' functions, pre-processors and
+    post-processors to be picklable (e.g., module level functions instead of lambdas), and the main module to be
+    importable without side effects (i.e., guarded with "if __name__ == '__main__':").
+
+    This must be called before the workflow is created (e.g., before
+    workflow.default_workflow.management.WorkflowManager is instantiated).
+
+    :param start_method:    One of 'fork', 'spawn' or 'forkserver'. See multiprocessing.set_start_method.
+    :param preload_modules: A list of module names (str) imported by the fork server once so that the processes forked
+                            from it don't need to import them, e.g., the modules defining the steps.
+                            Used only with the 'forkserver' start method.
+    :return:                None
+    """
+    set_multiprocessing_start_method(start_method, force=True)
+    if start_method == 'forkserver' and preload_modules:
+        set_forkserver_preload(list(preload_modules))
+
+
+def freeze_gc_on_fork(enabled=True):
+    """Freeze the garbage collector's generations when forking processes (see start_process).
+
+    Forked processes share the memory of their parent until either of them writes to it (copy-on-write). The garbage
+    collector of a forked process writes to the header of every object it inherited when it collects the oldest
+    generation, which copies most of the parent's heap into every process. With this enabled, the inherited objects
+    are moved to the permanent generation (see gc.freeze) in the forked processes, so they are never collected or
+    touched by their garbage collector. The parent process is not affected.
+
+    This is useful when many steps run concurrently from a large evaluator process, and affects only the 'fork' start
+    method.
+
+    :param enabled: True to freeze the garbage collector when forking. False to stop doing so.
+    :return:        None
+    """
+    global _freeze_gc
+    _freeze_gc = enabled
+
+
+def start_process(process):
+    """Start the process, freezing the garbage collector for the forked process if enabled (see freeze_gc_on_fork).
+
+    The generations are frozen just before forking and unfrozen in this process right after, so the objects stay
+    frozen only in the forked process.
+
+    :param process: A multiprocessing.Process object that hasn't been started.
+    :return:        None
+    """
+    if not (_freeze_gc and inherits_memory()):
+        process.start()
+        return
+
+    gc.freeze()
+    try:
+        process.start()
+    finally:
+        gc.unfreeze()
+
+
+def inherits_memory():
+    """Check if the processes started by this process inherit its memory, i.e., if the 'fork' start method is used.
+
+    :return:    True if the processes are forked. False otherwise.
+    """
+    return get_start_method() == 'fork'
+
+
+def reduce_executor(executor, args):
+    """Helper for the __reduce__ methods of executors. The executors' processes and threads are not pickled.
+
+    :param executor:    The executor being pickled.
+    :param args:        The args used to create a new executor like this one.
+    :return:            A tuple as per the __reduce__ specification. If the executor is one of the shared executors
+                        (see get_executor), the shared executor of the process in which it is unpickled is used.
+    """
+    for execution_mode, shared_executor in EXECUTORS.items():
+        if executor is shared_executor:
+            return get_executor, (execution_mode,)
+    return type(executor), args
+
+
+class ExecutionMode:
+    """Namespace for the ways in which a step's function can be run. Use this class instead of plain strings.
+
+    The mode is chosen with the 'execution' tag of a step (see workflow.helpers.step.Step), e.g.,
+    Step(function, execution=ExecutionMode.POOL).
+    """
+    PROCESS = 'process'     # A new process is forked for every run (the default).
+    POOL = 'pool'           # A worker process from a pool of persistent processes is used. See WorkerPool.
+    THREAD = 'thread'       # A thread from a pool of threads is used. See ThreadExecutor.
+    ASYNCIO = 'asyncio'     # The coroutine function is run on a shared event loop. See AsyncioExecutor.
+
+
+class SubProcessExecution:
+    """A run of a function in its own sub-process. See run_function_as_execption_safe_subprocess."""
+    def __init__(self, process, result_queue):
+        """Setup the execution.
+
+        :param process:         The multiprocessing.Process object that is running the function.
+        :param result_queue:    The multiprocessing.Queue to which the result is written.
+        """
+        self._process = process
+        self._result_queue = result_queue
+
+    @property
+    def pid(self):
+        """The PID of the sub-process."""
+        return self._process.pid
+
+    def join(self):
+        """Wait for the subprocess to finish."""
+        self._process.join()
+
+    def is_alive(self):
+        """Check if the subprocess is running.
+
+        :return: True if the process is running. False otherwise.
+        """
+        return self._process.is_alive()
+
+    def get_result(self):
+        """Obtain the result from running the function.
+
+        :return: A tuple of the form: (<return_value>, <exception>) if the function has completed. None otherwise,
+                 including after the result has been obtained.
+        """
+        if self._result_queue is None:
+            return None
+        try:
+            result = self._result_queue.get_nowait()
+        except Empty:
+            return None
+        # The queue is released as soon as it is no longer needed. With the 'spawn' and 'forkserver' start methods,
+        # its semaphores are named system resources that would otherwise leak if the process holding it is
+        # terminated (e.g., the state machine evaluator).
+        self._result_queue.close()
+        self._result_queue = None
+        return result
+
+    def terminate(self):
+        """Terminate the subprocess."""
+        self._process.terminate()
+
+    def kill(self):
+        """Kill the subprocess (with SIGKILL), e.g., when it doesn't exit after being terminated."""
+        self._process.kill()
+
+
+class ProcessExecutor:
+    """An executor that forks a new process for every run of a function."""
+    def __reduce__(self):
+        """Pickle the executor such that the shared executor is used when it is unpickled (see get_executor)."""
+        return reduce_executor(self, ())
+
+    def submit(self, function, args, kwargs):
+        """Run the function as a subprocess by passing the given args and kwargs.
+
+        :param function:    The function to be called.
+        :param args:        Args for function.
+        :param kwargs:      Kwargs for function.
+        :return:            A SubProcessExecution object to manage the run and collect its result.
+        """
+        return SubProcessExecution(*run_function_as_execption_safe_subprocess(function, *args, **kwargs))
+
+
+class PooledExecution:
+    """A run of a function by an executor that keeps track of its runs by task IDs, i.e., WorkerPool or
+    AsyncioExecutor."""
+    def __init__(self, pool, task_id):
+        """Setup the execution.
+
+        :param pool:    The WorkerPool or AsyncioExecutor running the function.
+        :param task_id: The ID of the task given by the executor.
+        """
+        self._pool = pool
+        self._task_id = task_id
+
+    @property
+    def pid(self):
+        """The PID of the process running the function. See the get_pid method of the executor."""
+        return self._pool.get_pid(self._task_id)
+
+    def join(self):
+        """Wait for the function to finish."""
+        self._pool.join(self._task_id)
+
+    def is_alive(self):
+        """Check if the function is queued or running.
+
+        :return: True if the function is queued or running. False otherwise.
+        """
+        return self._pool.is_alive(self._task_id)
+
+    def get_result(self):
+        """Obtain the result from running the function.
+
+        :return: A tuple of the form: (<return_value>, <exception>) if the function has completed. None otherwise.
+        """
+        return self._pool.get_result(self._task_id)
+
+    def terminate(self):
+        """Terminate the run. See the terminate method of the executor."""
+        self._pool.terminate(self._task_id)
+
+    def kill(self):
+        """Kill the run. See the kill method of the executor (if any). Otherwise, the same as terminate."""
+        getattr(self._pool, 'kill', self._pool.terminate)(self._task_id)
+
+
+class FunctionRegistry:
+    """A registry of functions that lets processes forked after a function is registered refer to it by its index.
+
+    This allows sending functions that can't be pickled (e.g., lambdas) to such processes.
+    The functions are weakly referenced, so registering a function doesn't keep it alive. Functions that can't be
+    weakly referenced (or hashed) are kept for the lifetime of the registry.
+    """
+    def __init__(self):
+        """Initialize an empty registry."""
+        self._references = []
+        self._indices = WeakKeyDictionary()
+        self._retained_indices = {}
+
+    def _get_index(self, function):
+        """Get the index of the function or None if it isn't registered."""
+        try:
+            return self._indices.get(function)
+        except TypeError:
+            retained = self._retained_indices.get(id(function))
+            return None if retained is None else retained[1]
+
+    def register(self, function):
+        """Register a function.
+
+        :param function:    A callable.
+        :return:            None
+        """
+        if self._get_index(function) is not None:
+            return
+
+        index = len(self._references)
+        try:
+            self._indices[function] = index
+            reference = weak_reference(function)
+        except TypeError:
+            # The function is retained so that its id isn't reused by another object.
+            self._retained_indices[id(function)] = (function, index)
+
+            def reference():
+                return function
+        self._references.append(reference)
+
+    def get_functions(self):
+        """Get the registered functions, to be passed to a process being forked.
+
+        :return:    A new list of the registered functions in the order of their indices. The functions that are no
+                    longer alive are None.
+        """
+        return [reference() for reference in self._references]
+
+    def get_reference(self, function, known_functions):
+        """Get what can be sent to a process to refer to the function, i.e., its index or the pickled function.
+
+        :param function:        A callable.
+        :param known_functions: The number of functions (int) that were registered when the process was forked.
+                                None if the process didn't inherit the registry (i.e., it wasn't forked).
+        :return:                The index of the function (int) if the process knows it. Otherwise (e.g., if it was
+                                registered after the process was forked), the pickled function (bytes) or None if it
+                                can't be pickled.
+        """
+        index = self._get_index(function)
+        if index is not None and known_functions is not None and index < known_functions:
+            return index
+        try:
+            return bytes(ForkingPickler.dumps(function))
+        except Exception:
+            return None
+
+
+def load_task(function_reference, arguments, functions):
+    """Load the function and arguments of a task sent by an executor.
+
+    :param function_reference:  The index of the function in functions or the pickled function (bytes).
+    :param arguments:           The pickled tuple of the form: (<args>, <kwargs>).
+    :param functions:           The list of functions registered with the executor when the process was forked.
+    :return:                    A tuple of the form: (<function>, <args>, <kwargs>).
+    """
+    if isinstance(function_reference, int):
+        function = functions[function_reference]
+    else:
+        function = ForkingPickler.loads(function_reference)
+    args, kwargs = ForkingPickler.loads(arguments)
+    return function, args, kwargs
+
+
+def dump_result(task_id, result):
+    """Pickle the result of a task to be sent to the process that submitted it.
+
+    :param task_id: The ID of the task.
+    :param result:  A tuple of the form: (<return_value>, <exception>).
+    :return:        The pickled tuple (bytes) of the form: (<task ID>, <result>). If the result can't be pickled, it
+                    is replaced by (None, RuntimeError(<reason>)).
+    """
+    try:
+        return ForkingPickler.dumps((task_id, result))
+    except Exception as e:
+        logger.exception('Unable to send the result of task {} due to error: {}'.format(task_id, e))
+        return ForkingPickler.dumps((task_id, (None, RuntimeError('Unable to send the result: {}'.format(e)))))
+
+
+def run_worker(connection, functions, delay=1):
+    """Run the functions sent by a WorkerPool over the connection and send back their results until asked to stop.
+
+    :param connection:  A duplex multiprocessing.Connection. Each task received is a tuple of the form:
+                        (<task ID>, <function reference>, <pickled args and kwargs>). See load_task.
+                        The result sent for a task is a tuple of the form:
+                        (<task ID>, (<return_value>, <exception>)).
+                        None means the worker must stop.
+    :param functions:   The list of functions registered with the pool when this worker was forked.
+    :param delay:       The interval in seconds at which the process owning the pool is checked. The worker stops if
+                        it exits.
+    :return:            None
+    """
+    parent = parent_process()
+    while parent is None or parent.is_alive():
+        try:
+            if not connection.poll(delay):
+                continue
+            task = connection.recv()
+        except (EOFError, OSError):
+            break
+        if task is None:
+            break
+
+        task_id, function_reference, arguments = task
+        try:
+            function, args, kwargs = load_task(function_reference, arguments, functions)
+        except Exception as e:
+            logger.exception('Unable to load task {} due to error: {}'.format(task_id, e))
+            result = (None, e)
+        else:
+            result = exception_safe_call(function, *args, **kwargs)
+        connection.send_bytes(dump_result(task_id, result))
+
+
+class Worker:
+    """A worker process of a WorkerPool."""
+    def __init__(self, functions):
+        """Start the worker process.
+
+        :param functions:   The list of functions registered with the pool (see FunctionRegistry.get_functions). If
+                            the worker is forked, it can run these by their index. The list is cleared once the worker
+                            is started.
+        """
+        self.connection, worker_connection = Pipe(duplex=True)
+        self.known_functions = len(functions) if inherits_memory() else None
+        self.tasks_run = 0
+        self.task_id = None
+        self.process = Process(target=run_worker, args=(worker_connection, functions if inherits_memory() else []))
+        start_process(self.process)
+        worker_connection.close()
+        # The forked process has its own copy. This one would keep the functions alive for the lifetime of the worker.
+        functions.clear()
+
+    def stop(self, timeout=1):
+        """Ask the worker to stop and terminate it if it doesn't stop within the timeout."""
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+        self.connection.close()
+
+
+class WorkerPool:
+    """An executor that runs functions in a bounded pool of persistent worker processes instead of a new process per
+    run, which avoids the cost of creating a process, queue and its feeder thread for every run.
+
+    Workers are forked lazily (up to the size of the pool) by the process that submits the functions. Functions are
+    sent to the workers by reference when they are registered (see register) before the worker was forked, or are
+    pickled otherwise. If a function is neither, an idle worker is replaced with a new one that inherits it.
+    The args and kwargs must be picklable (multiprocessing connections are); runs whose args can't be pickled are
+    forked as new processes like ProcessExecutor does.
+
+    Each worker has its own pipe over which tasks are sent and results are received. Terminating a run terminates its
+    worker (preserving the semantics of terminating a process per run), which is replaced when needed.
+    """
+    def __init__(self, size=None, max_tasks_per_worker=None):
+        """Define the pool.
+
+        :param size:                    The maximum number of worker processes (int). Defaults to the number of CPUs.
+        :param max_tasks_per_worker:    The number of runs (int) after which a worker is replaced with a new one to
+                                        release any resources it might be holding. None means workers are not replaced.
+        """
+        self._size = size or os.cpu_count() or 1
+        self._max_tasks_per_worker = max_tasks_per_worker
+        self._registry = FunctionRegistry()
+        self._task_ids = count()
+        self._pid = None
+        self._process_executor = ProcessExecutor()
+
+    def __reduce__(self):
+        """Pickle the pool's configuration only. The workers belong to the process that started them."""
+        return reduce_executor(self, (self._size, self._max_tasks_per_worker))
+
+    def _reset(self):
+        """Forget the workers and tasks of the parent process (if any) when used in a new process."""
+        self._pid = os.getpid()
+        self._idle_workers = []
+        self._busy_workers = {}
+        self._pending_tasks = []
+        self._results = {}
+        self._stopping_workers = {}
+        self._finalizer = Finalize(self, self.close, exitpriority=10)
+
+    def register(self, function):
+        """Register a function so that it can be sent by reference to the workers forked afterwards.
+
+        :param function:    A callable.
+        :return:            None
+        """
+        self._registry.register(function)
+
+    def submit(self, function, args, kwargs):
+        """Run the function in a worker by passing the given args and kwargs.
+
+        :param function:    The function to be called.
+        :param args:        Args for function.
+        :param kwargs:      Kwargs for function.
+        :return:            A PooledExecution object to manage the run and collect its result. Or, a SubProcessExecution
+                            object if the args or kwargs can't be pickled.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+        try:
+            arguments = bytes(ForkingPickler.dumps((args, kwargs)))
+        except Exception as e:
+            logger.debug('Running {} in a new process since its arguments cannot be pickled: {}'.format(function, e))
+            arguments = None
+        if arguments is None:
+            return self._process_executor.submit(function, args, kwargs)
+
+        task_id = next(self._task_ids)
+        self._pending_tasks.append((task_id, function, arguments))
+        self._dispatch()
+        return PooledExecution(self, task_id)
+
+    def _dispatch(self):
+        """Send the pending tasks to idle workers, forking new workers as needed."""
+        while self._pending_tasks:
+            if self._idle_workers:
+                worker = self._idle_workers.pop()
+            elif len(self._busy_workers) < self._size:
+                worker = Worker(self._registry.get_functions())
+            else:
+                break
+
+            task_id, function, arguments = self._pending_tasks[0]
+            function_reference = self._registry.get_reference(function, worker.known_functions)
+            if function_reference is None:
+                # The function isn't known by this worker and can't be sent. A new worker will inherit it.
+                self.register(function)
+                worker.stop()
+                worker = Worker(self._registry.get_functions())
+                function_reference = self._registry.get_reference(function, worker.known_functions)
+
+            self._pending_tasks.pop(0)
+            worker.task_id = task_id
+            self._busy_workers[task_id] = worker
+            try:
+                worker.connection.send((task_id, function_reference, arguments))
+            except Exception as e:
+                logger.exception('Unable to send task {} to worker {} due to error: {}'.format(
+                    task_id, worker.process.pid, e))
+                self._results[task_id] = (None, e)
+                self._release(worker)
+
+    def _release(self, worker):
+        """Mark the worker as idle (or replace it) once it has finished its task."""
+        del self._busy_workers[worker.task_id]
+        worker.task_id = None
+        worker.tasks_run += 1
+        if self._max_tasks_per_worker is not None and worker.tasks_run >= self._max_tasks_per_worker:
+            worker.stop()
+        else:
+            self._idle_workers.append(worker)
+
+    def _reap(self):
+        """Release the resources of the stopped workers (see _stop_task) that have exited, without waiting for the
+        others."""
+        for task_id, worker in list(self._stopping_workers.items()):
+            if not worker.process.is_alive():
+                worker.process.join()
+                worker.connection.close()
+                del self._stopping_workers[task_id]
+
+    def _collect(self, timeout=0):
+        """Collect the results sent by the workers and dispatch the pending tasks to the workers freed up.
+
+        :param timeout: The time in seconds to wait for a result.
+        :return:        None
+        """
+        self._reap()
+        workers = {worker.connection: worker for worker in self._busy_workers.values()}
+        for connection in wait(list(workers), timeout):
+            worker = workers[connection]
+            try:
+                task_id, result = connection.recv()
+            except (EOFError, OSError):
+                # The worker died without sending a result, like a process that was killed.
+                del self._busy_workers[worker.task_id]
+                worker.stop()
+                continue
+            self._results[task_id] = result
+            self._release(worker)
+        self._dispatch()
+
+    def get_result(self, task_id):
+        """Obtain the result of a task.
+
+        :param task_id: The ID of the task.
+        :return:        A tuple of the form: (<return_value>, <exception>) if the task has completed. None otherwise.
+        """
+        self._collect()
+        return self._results.pop(task_id, None)
+
+    def get_pid(self, task_id):
+        """Get the PID of the worker running the task.
+
+        :param task_id: The ID of the task.
+        :return:        The PID (int) or None if the task isn't running (e.g., it is queued or has completed).
+        """
+        worker = self._busy_workers.get(task_id) or self._stopping_workers.get(task_id)
+        return None if worker is None else worker.process.pid
+
+    def is_alive(self, task_id):
+        """Check if the task is queued or running.
+
+        :param task_id: The ID of the task.
+        :return:        True if the task is queued or running. False otherwise.
+        """
+        self._collect()
+        if task_id in self._busy_workers:
+            return self._busy_workers[task_id].process.is_alive()
+        if task_id in self._stopping_workers:
+            # The task's worker has been terminated, but hasn't exited yet (e.g., it is ignoring SIGTERM).
+            return True
+        return any(task[0] == task_id for task in self._pending_tasks)
+
+    def join(self, task_id):
+        """Wait for the task to finish.
+
+        :param task_id: The ID of the task.
+        :return:        None
+        """
+        while self.is_alive(task_id) and task_id not in self._results:
+            self._collect(timeout=0.1)
+
+    def terminate(self, task_id):
+        """Terminate the task. If it is running, its worker is terminated and replaced by a new one when needed.
+        The worker is given WORKER_STOP_TIMEOUT seconds to exit, after which the task is reported alive (see is_alive)
+        until it does. It can be killed meanwhile (see kill).
+
+        :param task_id: The ID of the task.
+        :return:        None
+        """
+        self._stop_task(task_id, kill=False)
+
+    def kill(self, task_id):
+        """Kill the task. Like terminate, but the worker is killed (with SIGKILL).
+
+        :param task_id: The ID of the task.
+        :return:        None
+        """
+        self._stop_task(task_id, kill=True)
+
+    def _stop_task(self, task_id, kill):
+        """Cancel a pending task or stop the worker running it (see terminate)."""
+        self._pending_tasks = [task for task in self._pending_tasks if task[0] != task_id]
+        worker = self._busy_workers.pop(task_id, None) or self._stopping_workers.get(task_id)
+        if worker is not None:
+            if kill:
+                worker.process.kill()
+            else:
+                worker.process.terminate()
+            # The worker isn't waited for indefinitely since it may ignore (or block) SIGTERM. If it doesn't exit in
+            # time, it is reaped once it does (see _reap).
+            worker.process.join(WORKER_STOP_TIMEOUT)
+            self._stopping_workers[task_id] = worker
+        self._reap()
+        self._dispatch()
+
+    def close(self):
+        """Stop all the workers. Called automatically when the process owning the pool exits."""
+        if self._pid != os.getpid():
+            return
+        for worker in self._idle_workers + list(self._busy_workers.values()):
+            worker.stop()
+        for worker in self._stopping_workers.values():
+            worker.process.kill()
+            worker.process.join()
+            worker.connection.close()
+        self._idle_workers = []
+        self._busy_workers = {}
+        self._pending_tasks = []
+        self._stopping_workers = {}
+
+
+def cancelled():
+    """Check if the run of the calling function has been terminated (e.g., the step has been interrupted).
+
+    Functions run by ThreadExecutor can't be terminated forcibly. They need to call this periodically (e.g., between
+    requests or while waiting) and return when it is True. In other execution modes, this is always False since the
+    run is terminated forcibly.
+
+    :return:    True if the run has been terminated. False otherwise.
+    """
+    cancel_event = getattr(_thread_state, 'cancel_event', None)
+    return cancel_event is not None and cancel_event.is_set()
+
+
+def call_cancellable(function, cancel_event, args, kwargs):
+    """Call the function in an exception safe manner such that it can check the cancel_event using cancelled().
+
+    :param function:        The function to be called.
+    :param cancel_event:    A threading.Event that is set when the run is terminated.
+    :param args:            Args for function.
+    :param kwargs:          Kwargs for function.
+    :return:                A tuple of the form (<return_value>, <exception>). See exception_safe_call.
+    """
+    _thread_state.cancel_event = cancel_event
+    try:
+        return exception_safe_call(function, *args, **kwargs)
+    finally:
+        _thread_state.cancel_event = None
+
+
+class ThreadExecution:
+    """A run of a function in a thread of a ThreadExecutor."""
+    def __init__(self, future, cancel_event):
+        """Setup the execution.
+
+        :param future:          The concurrent.futures.Future of the run.
+        :param cancel_event:    The threading.Event that is set when the run is terminated.
+        """
+        self._future = future
+        self._cancel_event = cancel_event
+
+    @property
+    def pid(self):
+        """The PID of the process running the function, i.e., this process."""
+        return os.getpid()
+
+    def join(self):
+        """Wait for the function to finish."""
+        # A cancelled future is done but concurrent.futures.wait waits until a thread would have picked it up.
+        if not self._future.done():
+            wait_for_futures([self._future])
+
+    def is_alive(self):
+        """Check if the function is queued or running.
+
+        A terminated function remains alive until it returns (see cancelled).
+
+        :return: True if the function is queued or running. False otherwise.
+        """
+        return not self._future.done()
+
+    def get_result(self):
+        """Obtain the result from running the function.
+
+        :return: A tuple of the form: (<return_value>, <exception>) if the function has completed. None otherwise.
+                 None if the run has been terminated, like a terminated process.
+        """
+        if self._cancel_event.is_set() or not self._future.done() or self._future.cancelled():
+            return None
+        return self._future.result()
+
+    def terminate(self):
+        """Terminate the run. A queued run is cancelled. A running function is asked to return (see cancelled)."""
+        self._cancel_event.set()
+        self._future.cancel()
+
+
+class ThreadExecutor:
+    """An executor that runs functions in a pool of threads in the calling process.
+
+    This suits I/O bound functions (e.g., waiting for network calls or files) since no process is forked. Unlike the
+    other executors, the function shares the memory of the calling process, i.e., it must be thread-safe, and any
+    changes it makes to its arguments (e.g., the context) are visible to the caller.
+    Terminating a run is cooperative. See cancelled.
+    """
+    shares_memory = True    # Return values are not sent between processes.
+    usage_scope = UsageScope.THREAD
+
+    def __init__(self, size=None):
+        """Define the pool of threads.
+
+        :param size:    The maximum number of threads (int). Defaults to that of concurrent.futures.ThreadPoolExecutor.
+        """
+        self._size = size
+        self._pid = None
+        self._executor = None
+        self._cancel_events = set()
+
+    def __reduce__(self):
+        """Pickle the executor's configuration only. The threads belong to the process that started them."""
+        return reduce_executor(self, (self._size,))
+
+    def submit(self, function, args, kwargs):
+        """Run the function in a thread by passing the given args and kwargs.
+
+        :param function:    The function to be called.
+        :param args:        Args for function.
+        :param kwargs:      Kwargs for function.
+        :return:            A ThreadExecution object to manage the run and collect its result.
+        """
+        if self._pid != os.getpid():
+            # Threads aren't inherited by forked processes.
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max_workers=self._size, thread_name_prefix='autotrail-step')
+            self._cancel_events = set()
+            Finalize(self, self.close, exitpriority=10)
+
+        cancel_event = Event()
+        self._cancel_events.add(cancel_event)
+        future = self._executor.submit(call_cancellable, function, cancel_event, args, kwargs)
+        future.add_done_callback(lambda _: self._cancel_events.discard(cancel_event))
+        return ThreadExecution(future, cancel_event)
+
+    def close(self):
+        """Terminate all the runs and stop the threads once they return. Called automatically when the process owning
+        the threads exits."""
+        if self._pid != os.getpid():
+            return
+        for cancel_event in list(self._cancel_events):
+            cancel_event.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._pid = None
+
+
+def run_coroutine_function(function, *args, **kwargs):
+    """Call the function and run the coroutine it returns (if any) to completion in a new event loop.
+
+    :param function:    A coroutine function or a callable.
+    :param args:        Args for function.
+    :param kwargs:      Kwargs for function.
+    :return:            The return value of the coroutine or that of the callable if it doesn't return an awaitable.
+    """
+    return_value = function(*args, **kwargs)
+    if inspect.isawaitable(return_value):
+
+        async def wait_for(awaitable):
+            return await awaitable
+
+        return_value = asyncio.run(wait_for(return_value))
+    return return_value
+
+
+async def exception_safe_await(function, *args, **kwargs):
+    """The coroutine equivalent of exception_safe_call, which awaits the value returned by the function if needed.
+
+    :param function:    A coroutine function or a callable.
+    :param args:        Args for function.
+    :param kwargs:      Kwargs for function.
+    :return:            A tuple of the form (<return_value>, <exception>). See exception_safe_call.
+    """
+    return_value = None
+    exception = None
+    try:
+        awaitable = function(*args, **kwargs)
+        return_value = (await awaitable) if inspect.isawaitable(awaitable) else awaitable
+    except Exception as e:
+        logger.exception(e)
+        exception = e
+
+    return (return_value, exception)
+
+
+async def serve_coroutines(connection, functions, delay=1):
+    """Run the coroutine functions sent by an AsyncioExecutor as tasks and send back their results until asked to stop.
+
+    :param connection:  A duplex multiprocessing.Connection. The messages received are of the form:
+                        (<task ID>, <function reference>, <pickled args and kwargs>) to run a function (see load_task),
+                        or
+                        (<task ID>,) to cancel a task, or
+                        None to stop.
+                        The result sent for a task is a tuple of the form:
+                        (<task ID>, (<return_value>, <exception>)).
+    :param functions:   The list of functions registered with the executor when this process was forked.
+    :param delay:       The interval in seconds at which the process owning the executor is checked. The tasks are
+                        cancelled if it exits.
+    :return:            None
+    """
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+    tasks = {}
+
+    def send_result(task_id, result):
+        try:
+            connection.send_bytes(dump_result(task_id, result))
+        except OSError:
+            pass
+
+    def finish(task_id, task):
+        del tasks[task_id]
+        send_result(task_id, (None, asyncio.CancelledError()) if task.cancelled() else task.result())
+
+    def receive():
+        try:
+            message = connection.recv()
+        except (EOFError, OSError):
+            message = None
+        if message is None:
+            if not stopped.done():
+                stopped.set_result(None)
+        elif len(message) == 1:
+            if message[0] in tasks:
+                tasks[message[0]].cancel()
+        else:
+            task_id, function_reference, arguments = message
+            try:
+                function, args, kwargs = load_task(function_reference, arguments, functions)
+            except Exception as e:
+                logger.exception('Unable to load task {} due to error: {}'.format(task_id, e))
+                send_result(task_id, (None, e))
+                return
+            task = loop.create_task(exception_safe_await(function, *args, **kwargs))
+            tasks[task_id] = task
+            task.add_done_callback(lambda done_task: finish(task_id, done_task))
+
+    loop.add_reader(connection.fileno(), receive)
+    parent = parent_process()
+    while not stopped.done() and (parent is None or parent.is_alive()):
+        await asyncio.wait([stopped], timeout=delay)
+    loop.remove_reader(connection.fileno())
+    for task in list(tasks.values()):
+        task.cancel()
+
+
+def run_event_loop(connection, functions):
+    """Run serve_coroutines in a new event loop. See serve_coroutines."""
+    asyncio.run(serve_coroutines(connection, functions))
+
+
+class AsyncioExecutor:
+    """An executor that runs coroutine functions (async def) as tasks on a single event loop in a process of its own.
+
+    Many concurrent runs that mostly wait (e.g., on the network or sub-processes) cost a single process instead of a
+    process each. The process is forked lazily by the process that submits the functions, and is stopped when the
+    latter exits. Like WorkerPool, functions are sent by reference when they are registered before the process was
+    forked, or are pickled otherwise, and the args and kwargs must be picklable. Runs that can't be sent are run in a
+    new process of their own with a new event loop.
+
+    The results of all the runs are sent over a single pipe. They are all read whenever any result is asked for, so the
+    results of the steps that completed are known without checking each step's run.
+    Terminating a run cancels its task.
+    """
+    usage_scope = UsageScope.WALL_TIME
+
+    def __init__(self):
+        """Define the executor."""
+        self._registry = FunctionRegistry()
+        self._task_ids = count()
+        self._pid = None
+        self._process_executor = ProcessExecutor()
+
+    def __reduce__(self):
+        """Pickle the executor without its event loop process, which belongs to the process that started it."""
+        return reduce_executor(self, ())
+
+    def _reset(self):
+        """Forget the event loop process and tasks of the parent process (if any) when used in a new process."""
+        self._pid = os.getpid()
+        self._process = None
+        self._connection = None
+        self._known_functions = 0
+        self._running_tasks = set()
+        self._results = {}
+        Finalize(self, self.close, exitpriority=10)
+
+    def _start(self):
+        """Start the process running the event loop."""
+        self._connection, loop_connection = Pipe(duplex=True)
+        functions = self._registry.get_functions() if inherits_memory() else []
+        self._known_functions = len(functions) if inherits_memory() else None
+        self._process = Process(target=run_event_loop, args=(loop_connection, functions))
+        start_process(self._process)
+        loop_connection.close()
+        # The forked process has its own copy. This one would keep the functions alive while the process runs.
+        functions.clear()
+        self._running_tasks = set()
+
+    def register(self, function):
+        """Register a function so that it can be sent by reference to the event loop process forked afterwards.
+
+        :param function:    A callable.
+        :return:            None
+        """
+        self._registry.register(function)
+
+    def submit(self, function, args, kwargs):
+        """Run the coroutine function on the event loop by passing the given args and kwargs.
+
+        :param function:    A coroutine function. Other callables are called in the event loop (blocking it).
+        :param args:        Args for function.
+        :param kwargs:      Kwargs for function.
+        :return:            A PooledExecution object to manage the run and collect its result. Or, a SubProcessExecution
+                            object if the function can't be sent to the event loop process.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+        if self._process is None or not self._process.is_alive():
+            self._start()
+
+        function_reference = self._registry.get_reference(function, self._known_functions)
+        arguments = None
+        if function_reference is not None:
+            try:
+                arguments = bytes(ForkingPickler.dumps((args, kwargs)))
+            except Exception as e:
+                logger.debug('The arguments of {} cannot be pickled: {}'.format(function, e))
+        if arguments is None:
+            logger.debug('Running {} in a new process since it cannot be sent to the event loop.'.format(function))
+            return self._process_executor.submit(run_coroutine_function, (function,) + tuple(args), kwargs)
+
+        task_id = next(self._task_ids)
+        self._connection.send((task_id, function_reference, arguments))
+        self._running_tasks.add(task_id)
+        return PooledExecution(self, task_id)
+
+    def _collect(self, timeout=0):
+        """Collect all the results sent by the event loop process.
+
+        :param timeout: The time in seconds to wait for a result.
+        :return:        None
+        """
+        try:
+            ready = self._connection.poll(timeout)
+            while ready:
+                task_id, result = self._connection.recv()
+                # The results of terminated runs are ignored.
+                if task_id in self._running_tasks:
+                    self._running_tasks.discard(task_id)
+                    self._results[task_id] = result
+                ready = self._connection.poll(0)
+        except (EOFError, OSError):
+            # The event loop process died. Like killed processes, its runs will have no results.
+            self._running_tasks = set()
+
+    def get_result(self, task_id):
+        """Obtain the result of a task.
+
+        :param task_id: The ID of the task.
+        :return:        A tuple of the form: (<return_value>, <exception>) if the task has completed. None otherwise.
+        """
+        self._collect()
+        return self._results.pop(task_id, None)
+
+    def get_pid(self, task_id):
+        """Get the PID of the event loop process running the task.
+
+        :param task_id: The ID of the task.
+        :return:        The PID (int) or None if the task isn't running.
+        """
+        return self._process.pid if task_id in self._running_tasks else None
+
+    def is_alive(self, task_id):
+        """Check if the task is running.
+
+        :param task_id: The ID of the task.
+        :return:        True if the task is running. False otherwise.
+        """
+        self._collect()
+        return task_id in self._running_tasks and self._process.is_alive()
+
+    def join(self, task_id):
+        """Wait for the task to finish.
+
+        :param task_id: The ID of the task.
+        :return:        None
+        """
+        while self.is_alive(task_id):
+            self._collect(timeout=0.1)
+
+    def terminate(self, task_id):
+        """Cancel the task.
+
+        :param task_id: The ID of the task.
+        :return:        None
+        """
+        if task_id in self._running_tasks:
+            self._running_tasks.discard(task_id)
+            self._connection.send((task_id,))
+
+    def close(self, timeout=1):
+        """Cancel all the tasks and stop the event loop process. Called automatically when the process owning the
+        executor exits."""
+        if self._pid != os.getpid() or self._process is None:
+            return
+        try:
+            self._connection.send(None)
+        except OSError:
+            pass
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join(timeout)
+        self._connection.close()
+        self._process = None
+
+
+PROCESS_EXECUTOR = ProcessExecutor()
+WORKER_POOL = WorkerPool()
+THREAD_EXECUTOR = ThreadExecutor()
+ASYNCIO_EXECUTOR = AsyncioExecutor()
+EXECUTORS = {
+    ExecutionMode.PROCESS: PROCESS_EXECUTOR,
+    ExecutionMode.POOL: WORKER_POOL,
+    ExecutionMode.THREAD: THREAD_EXECUTOR,
+    ExecutionMode.ASYNCIO: ASYNCIO_EXECUTOR,
+}
+
+
+def get_executor(execution_mode=None):
+    """Get the executor for the given execution mode.
+
+    :param execution_mode:  A value from the ExecutionMode namespace. Defaults to ExecutionMode.PROCESS.
+    :return:                The shared executor object for the mode.
+    :raises:                ValueError if the mode is unknown.
+    """
+    execution_mode = execution_mode or ExecutionMode.PROCESS
+    try:
+        return EXECUTORS[execution_mode]
+    except KeyError:
+        raise ValueError('Unknown execution mode: {}. Must be one of: {}'.format(execution_mode, sorted(EXECUTORS)))
+
+
 class ExceptionSafeSubProcessFunction:
     """Run a function in a sub process, provide mechanisms to manage the process and collect the result.
 
     When a function is run as a sub-process, it may have a return value on successful completion or might raise an
     exception. This class provides a way to collect this from the sub-process and perform other management tasks like
     starting, terminating etc.
+
+    How the function is run is decided by the executor, which by default forks a new process for every run.
+    The resource usage of each run is measured by the process running it. See get_resource_usage.
     """
-    def __init__(self, function):
+    def __init__(self, function, executor=None, result_store=None):
         """Setup the function to run in a subprocess.
 
-        :param function: The callable to run. This should accept the *args and **kwargs that will be passed during
-                         the 'start' method call.
+        :param function:        The callable to run. This should accept the *args and **kwargs that will be passed
+                                during the 'start' method call.
+        :param executor:        An object like ProcessExecutor or WorkerPool that runs the function. See get_executor.
+                                Defaults to PROCESS_EXECUTOR.
+        :param result_store:    A workflow.helpers.results.LargeResultStore in which the process running the function
+                                stores large return values. The result then contains a LargeResult handle instead of
+                                the value. Defaults to the store set with
+                                workflow.helpers.results.set_default_result_store (if any).
+                                Not used with executors sharing the memory of this process (e.g., ThreadExecutor).
         """
         self._function = function
-        self._process = None
-        self._result_queue = None
+        self._executor = executor or PROCESS_EXECUTOR
+        result_store = result_store or get_default_result_store()
+        if getattr(self._executor, 'shares_memory', False):
+            result_store = None
+        self._runner = make_runner(function, result_store, getattr(self._executor, 'usage_scope', UsageScope.PROCESS))
+        if hasattr(self._executor, 'register'):
+            # The runner is registered (not the function), as that is what the executor is asked to run.
+            self._executor.register(self._runner)
+        self._execution = None
         self._result = None
+        self._resource_usage = None
 
     def __str__(self):
         return str(self._function)
 
+    @property
+    def function(self):
+        """The function that is run."""
+        return self._function
+
+    @property
+    def pid(self):
+        """The PID of the process running the function (e.g., to inspect it). None if it hasn't been started or isn't
+        running in a worker process (e.g., it is queued in a WorkerPool)."""
+        return None if self._execution is None else self._execution.pid
+
     def start(self, *args, **kwargs):
         """Run the function as a subprocess by passing the given args and kwargs.
 
@@ -132,11 +1370,11 @@ class ExceptionSafeSubProcessFunction:
         :param kwargs:  Keyword arguments compatible with the function this is initialized with.
         :return:        None
         """
-        self._process, self._result_queue = run_function_as_execption_safe_subprocess(self._function, *args, **kwargs)
+        self._execution = self._executor.submit(self._runner, args, kwargs)
 
     def join(self):
         """Wait for the subprocess to finish."""
-        self._process.join()
+        self._execution.join()
 
     def is_alive(self):
         """Check if the subprocess is running.
@@ -148,7 +1386,7 @@ class ExceptionSafeSubProcessFunction:
 
         :return: True if the process is running. False otherwise.
         """
-        return self._process is not None and self._process.is_alive()
+        return self._execution is not None and self._execution.is_alive()
 
     def get_result(self):
         """Obtain the result from running the function.
@@ -161,13 +1399,29 @@ class ExceptionSafeSubProcessFunction:
                                 None.
                  If the function has not completed, this will return None.
         """
-        if self._result is None and self._result_queue is not None:
-            try:
-                self._result = self._result_queue.get_nowait()
-            except Empty:
-                self._result = None
+        if self._result is None and self._execution is not None:
+            result = self._execution.get_result()
+            if result is not None and isinstance(result[0], MeasuredResult):
+                self._resource_usage = result[0].resource_usage
+                result = (result[0].return_value, result[0].exception)
+            self._result = result
         return self._result
 
+    def get_resource_usage(self):
+        """Obtain the resource usage of the run of the function.
+
+        :return:    A dictionary as returned by get_resource_usage for the run whose result is returned by get_result.
+                    None if it hasn't completed or the usage wasn't measured (e.g., the process running it was
+                    terminated).
+        """
+        self.get_result()
+        return self._resource_usage
+
     def terminate(self):
         """Terminate the subprocess."""
-        self._process.terminate()
+        self._execution.terminate()
+
+    def kill(self):
+        """Kill the subprocess, e.g., when it doesn't exit after being terminated. Executions that can't be killed
+        (e.g., of ThreadExecutor) are terminated instead."""
+        getattr(self._execution, 'kill', self._execution.terminate)()
@@ -0,0 +1,460 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+
+"""
+import functools
+import hashlib
+import inspect
+import logging
+import mmap
+import os
+import pickle
+
+from collections import OrderedDict
+from io import BytesIO
+from multiprocessing.connection import Connection
+from uuid import uuid4
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_LARGE_RESULT_THRESHOLD = 1024 * 1024
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+_default_result_store = None
+
+
+class LargeResult:
+    """A handle to a return value stored in a file by a LargeResultStore.
+
+    Only the handle is sent back from the process running the step and stored in the context. The value is read only
+    when load() is called, by memory-mapping the file. The buffers of objects supporting pickle protocol 5 out-of-band
+    data (e.g., bytearray, numpy arrays) are not copied; they refer to the mapped file directly (copy-on-write).
+    """
+    def __init__(self, file_name, pickle_size, buffer_sizes):
+        """Define the handle.
+
+        :param file_name:       The path of the file containing the value.
+        :param pickle_size:     The size (int) of the pickled value at the start of the file.
+        :param buffer_sizes:    The sizes (list of int) of the out-of-band buffers following the pickled value.
+        """
+        self.file_name = file_name
+        self.pickle_size = pickle_size
+        self.buffer_sizes = buffer_sizes
+
+    def __repr__(self):
+        return '<LargeResult of {} bytes in {}>'.format(self.size, self.file_name)
+
+    @property
+    def size(self):
+        """The size (int) of the stored value in bytes."""
+        return self.pickle_size + sum(self.buffer_sizes)
+
+    def load(self):
+        """Read the stored value.
+
+        :return:    The value returned by the step.
+        """
+        with open(self.file_name, 'rb') as value_file:
+            data = memoryview(mmap.mmap(value_file.fileno(), 0, access=mmap.ACCESS_COPY))
+
+        buffers = []
+        offset = self.pickle_size
+        for buffer_size in self.buffer_sizes:
+            buffers.append(data[offset:offset + buffer_size])
+            offset += buffer_size
+        return pickle.loads(data[:self.pickle_size], buffers=buffers)
+
+    def delete(self):
+        """Delete the file containing the value. The value can't be loaded afterwards."""
+        try:
+            os.remove(self.file_name)
+        except OSError:
+            pass
+
+
+def discard_replaced_result(previous_value, value):
+    """Delete the file of a LargeResult that is being replaced, e.g., when a step is rerun and its new return value
+    replaces the previous one in the context. See LargeResultStore for who owns the files.
+
+    :param previous_value:  The value being replaced, a LargeResult or any other object.
+    :param value:           The value replacing it.
+    :return:                None
+    """
+    if not isinstance(previous_value, LargeResult):
+        return
+    if isinstance(value, LargeResult) and value.file_name == previous_value.file_name:
+        return
+    previous_value.delete()
+
+
+def load_result(value):
+    """Load the value if it is a LargeResult. This is useful for post-processors and other consumers of the context.
+
+    :param value:   A LargeResult or any other object.
+    :return:        The stored value for a LargeResult. The given value otherwise.
+    """
+    return value.load() if isinstance(value, LargeResult) else value
+
+
+class LargeResultStore:
+    """Stores large return values in files so that only a small LargeResult handle needs to be sent and stored.
+
+    Return values are normally pickled by the process running the step, unpickled by the evaluator, and pickled
+    again for the context and the API responses. Values whose pickled size (including out-of-band buffers) is at
+    least the threshold are instead written once to a file in the directory.
+
+    The files are owned by the store. The state machine evaluator deletes the file of a step's return value when it is
+    replaced by that of another run of the step (see discard_replaced_result). The files of the latest return values
+    are kept after the workflow finishes so that they can be loaded; call clear() once they are no longer needed.
+    """
+    def __init__(self, directory, threshold=DEFAULT_LARGE_RESULT_THRESHOLD):
+        """Define the store. The directory is created if it doesn't exist.
+
+        :param directory:   The directory (e.g., the run directory of the workflow) where the values are stored.
+        :param threshold:   The minimum size in bytes (int) of the values that are stored.
+        """
+        self.directory = directory
+        self.threshold = threshold
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, value):
+        """Store the value if it is large.
+
+        :param value:   Any picklable object.
+        :return:        A LargeResult if the value was stored. The given value otherwise (including when it can't be
+                        stored, e.g., if it can't be pickled, in which case sending it will fail as usual).
+        """
+        buffers = []
+        try:
+            data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+        except Exception:
+            return value
+
+        buffers = [buffer.raw() for buffer in buffers]
+        buffer_sizes = [buffer.nbytes for buffer in buffers]
+        if len(data) + sum(buffer_sizes) < self.threshold:
+            return value
+
+        file_name = os.path.join(self.directory, 'result_{}.pickle'.format(uuid4().hex))
+        try:
+            with open(file_name, 'wb') as value_file:
+                value_file.write(data)
+                for buffer in buffers:
+                    value_file.write(buffer)
+        except OSError as e:
+            logger.exception('Unable to store the result in {} due to error: {}'.format(file_name, e))
+            return value
+        return LargeResult(file_name, len(data), buffer_sizes)
+
+    def clear(self):
+        """Delete all the stored values, e.g., at the end of a run once the return values are no longer needed.
+
+        :return:    None
+        """
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('result_') and entry.name.endswith('.pickle') and entry.is_file():
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+class StoreLargeResult:
+    """Wraps a function such that its large return values are stored in a LargeResultStore by the process running it.
+
+    Coroutine functions are supported; the value is stored once the coroutine returns.
+    """
+    def __init__(self, function, store):
+        """Define the function and store.
+
+        :param function:    The callable being wrapped.
+        :param store:       A LargeResultStore object.
+        """
+        self.function = function
+        self.store = store
+
+    def __call__(self, *args, **kwargs):
+        """Call the function and store its return value if it is large.
+
+        :param args:    Args for the function.
+        :param kwargs:  Kwargs for the function.
+        :return:        A LargeResult or the return value of the function (see LargeResultStore.put). If the function
+                        returns an awaitable, a coroutine returning the same.
+        """
+        return_value = self.function(*args, **kwargs)
+        if inspect.isawaitable(return_value):
+            return self._store_later(return_value)
+        return self.store.put(return_value)
+
+    async def _store_later(self, awaitable):
+        return self.store.put(await awaitable)
+
+
+def set_default_result_store(store):
+    """Set the LargeResultStore used by the steps created afterwards (see
+    workflow.helpers.execution.ExceptionSafeSubProcessFunction). E.g.,
+        set_default_result_store(LargeResultStore('/path/to/run/directory'))
+
+    :param store:   A LargeResultStore object or None to stop storing large return values.
+    :return:        None
+    """
+    global _default_result_store
+    _default_result_store = store
+
+
+def get_default_result_store():
+    """Get the LargeResultStore set with set_default_result_store.
+
+    :return:    A LargeResultStore object or None.
+    """
+    return _default_result_store
+
+
+class CacheResult:
+    """Namespace for the outcomes of looking up a step in a StepResultCache, recorded in the step data as 'cache'."""
+    HIT = 'hit'
+    MISS = 'miss'
+
+
+def make_code_identity(code):
+    """Make a value identifying a code object, i.e., its bytecode, constants (including nested code objects, e.g., of
+    nested functions and comprehensions) and the names it refers to.
+
+    :param code:    A code object.
+    :return:        A tuple.
+    """
+    constants = tuple(make_code_identity(constant) if inspect.iscode(constant) else constant
+                      for constant in code.co_consts)
+    return code.co_code, constants, code.co_names
+
+
+def make_function_identity(function, _seen=None):
+    """Make a value identifying a function and its code, such that changing the function changes the value.
+
+    The value is made of the reference to the function (the pickled function or its qualified name), the identity of
+    its code (see make_code_identity), its defaults and the values it has captured in closures (recursively for
+    captured functions). The values of the globals it refers to are not part of it. For functools.partial objects, it
+    is the identity of the wrapped function along with the arguments. For other callable objects, the code of their
+    __call__ method is used.
+
+    :param function:    Any callable.
+    :return:            A tuple of bytes or None if no reliable identity can be made, e.g., if a captured value can't
+                        be pickled. Such functions must not be cached.
+    """
+    seen = _seen or set()
+    if id(function) in seen:
+        # A recursive reference, e.g., a nested function calling itself.
+        return b'recursive'
+    seen.add(id(function))
+
+    if isinstance(function, functools.partial):
+        function_identity = make_function_identity(function.func, seen)
+        try:
+            arguments = pickle.dumps((function.args, sorted(function.keywords.items())), protocol=4)
+        except Exception:
+            return None
+        return None if function_identity is None else (function_identity, arguments)
+
+    try:
+        reference = pickle.dumps(function, protocol=4)
+    except Exception:
+        reference = '{}.{}'.format(getattr(function, '__module__', None),
+                                   getattr(function, '__qualname__', type(function).__qualname__)).encode('utf-8')
+
+    code_function = getattr(function, '__func__', function)
+    if getattr(code_function, '__code__', None) is None:
+        code_function = getattr(getattr(type(function), '__call__', None), '__func__',
+                                getattr(type(function), '__call__', None))
+    code = getattr(code_function, '__code__', None)
+    if code is None:
+        # E.g., a builtin function, which is identified by its reference.
+        return reference, b''
+
+    captured_values = []
+    for cell in getattr(code_function, '__closure__', None) or ():
+        try:
+            value = cell.cell_contents
+        except ValueError:
+            value = None    # The cell is empty, i.e., the variable hasn't been assigned yet.
+        if inspect.isfunction(value) or inspect.ismethod(value) or isinstance(value, functools.partial):
+            value = make_function_identity(value, seen)
+            if value is None:
+                return None
+        captured_values.append(value)
+
+    try:
+        return reference, pickle.dumps((make_code_identity(code), getattr(code_function, '__defaults__', None),
+                                        getattr(code_function, '__kwdefaults__', None), captured_values), protocol=4)
+    except Exception as e:
+        logger.debug('Unable to identify the function {} due to error: {}'.format(function, e))
+        return None
+
+
+class CacheKeyPickler(pickle.Pickler):
+    """Pickles the data of a cache key, refusing the values that don't identify the data they carry, i.e.,
+    multiprocessing connections (e.g., from workflow.helpers.step.output_preprocessor), which are pickled as their
+    file descriptors and are new for each run.
+    """
+    def reducer_override(self, obj):
+        if isinstance(obj, Connection):
+            raise TypeError('A connection ({}) cannot be part of a cache key.'.format(obj))
+        return NotImplemented
+
+
+def dumps_cache_key_data(data):
+    """Pickle the given data of a cache key (see CacheKeyPickler).
+
+    :param data:    The data to pickle.
+    :return:        Bytes.
+    :raises:        TypeError if the data contains a connection. Any exception raised by pickling otherwise.
+    """
+    buffer = BytesIO()
+    CacheKeyPickler(buffer, protocol=4).dump(data)
+    return buffer.getvalue()
+
+
+class StepResultCache:
+    """A content-addressed cache of the return values of steps, stored on the local disk.
+
+    A return value is stored under a key made of the identity (and code) of the step's function, the arguments it was
+    called with and any other values it depends on (e.g., selected values from the context). Running a step whose key
+    is found can be skipped by using the stored return value instead.
+
+    Each value is a file in the directory named after its key. When the files exceed the maximum size, the least
+    recently used ones are deleted. The cache can be shared by the successive runs of a workflow.
+    """
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        """Define the cache. The directory is created if it doesn't exist.
+
+        :param directory:   The directory where the return values are stored.
+        :param max_size:    The maximum total size in bytes (int) of the stored return values.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = None
+        self._total_size = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_sizes'] = None
+        state['_total_size'] = 0
+        return state
+
+    def _load_index(self):
+        """Index the stored files in the order they were last used (on first use in each process)."""
+        if self._sizes is not None:
+            return
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pickle') and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len('.pickle')], stat.st_size))
+        self._sizes = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self._total_size = sum(self._sizes.values())
+
+    def _make_file_name(self, key):
+        return os.path.join(self.directory, '{}.pickle'.format(key))
+
+    def make_key(self, function, args=tuple(), kwargs=None, values=tuple()):
+        """Make the key for a run of the function.
+
+        :param function:    The step's function.
+        :param args:        The args the function is called with.
+        :param kwargs:      The kwargs the function is called with.
+        :param values:      Any other values the return value depends on.
+        :return:            The key (str) or None if the function can't be identified (see make_function_identity) or
+                            the arguments or values can't be pickled or contain multiprocessing connections (like the
+                            ones passed by workflow.helpers.step.io_preprocessor and output_preprocessor), i.e., the
+                            run can't be cached.
+        """
+        function_identity = make_function_identity(function)
+        if function_identity is None:
+            logger.debug('Unable to make a cache key for {} since it cannot be identified.'.format(function))
+            return None
+        try:
+            data = dumps_cache_key_data((function_identity, tuple(args), sorted((kwargs or {}).items()),
+                                         tuple(values)))
+        except Exception as e:
+            logger.debug('Unable to make a cache key for {} due to error: {}'.format(function, e))
+            return None
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, key):
+        """Look up a return value.
+
+        :param key:     A key made with make_key.
+        :return:        A tuple of the form (<CacheResult.HIT or CacheResult.MISS>, <The stored return value or None>).
+        """
+        self._load_index()
+        if key in self._sizes:
+            file_name = self._make_file_name(key)
+            try:
+                with open(file_name, 'rb') as value_file:
+                    return_value = pickle.load(value_file)
+                os.utime(file_name)
+            except Exception as e:
+                logger.warning('Unable to read the cached result {} due to error: {}'.format(file_name, e))
+                self._discard(key)
+            else:
+                self._sizes.move_to_end(key)
+                self.hits += 1
+                return CacheResult.HIT, return_value
+
+        self.misses += 1
+        return CacheResult.MISS, None
+
+    def put(self, key, return_value):
+        """Store a return value and evict the least recently used values if the cache is full.
+
+        :param key:             A key made with make_key.
+        :param return_value:    The return value to be stored. Values that can't be pickled or are larger than the
+                                cache are not stored. Neither are LargeResult handles, whose files may be deleted.
+        :return:                None
+        """
+        if isinstance(return_value, LargeResult):
+            return
+
+        try:
+            data = pickle.dumps(return_value, protocol=4)
+        except Exception as e:
+            logger.debug('Unable to cache the return value {} due to error: {}'.format(return_value, e))
+            return
+        if len(data) > self.max_size:
+            return
+
+        self._load_index()
+        file_name = self._make_file_name(key)
+        temporary_file_name = '{}.{}.tmp'.format(file_name, uuid4().hex)
+        try:
+            with open(temporary_file_name, 'wb') as value_file:
+                value_file.write(data)
+            os.replace(temporary_file_name, file_name)
+        except OSError as e:
+            logger.warning('Unable to cache the result in {} due to error: {}'.format(file_name, e))
+            return
+
+        self._total_size += len(data) - self._sizes.pop(key, 0)
+        self._sizes[key] = len(data)
+        while self._total_size > self.max_size:
+            self._discard(next(iter(self._sizes)))
+
+    def _discard(self, key):
+        """Delete a stored return value."""
+        self._total_size -= self._sizes.pop(key, 0)
+        try:
+            os.remove(self._make_file_name(key))
+        except OSError:
+            pass
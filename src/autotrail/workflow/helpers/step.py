@@ -16,12 +16,15 @@
 import logging
 import shlex
 
+from inspect import iscoroutinefunction
+
 from multiprocessing import Process, Pipe
 from subprocess import Popen, PIPE
 from time import sleep
 
 from autotrail.core.api.management import read_message, read_messages, send_messages
-from autotrail.workflow.helpers.execution import ExceptionSafeSubProcessFunction
+from autotrail.workflow.helpers.execution import ExceptionSafeSubProcessFunction, ExecutionMode, get_executor
+from autotrail.workflow.helpers.results import CacheResult
 
 
 logger = logging.getLogger(__name__)
@@ -64,6 +67,16 @@ class Step(ExceptionSafeSubProcessFunction):
     A step can be checked for a matching tag with the 'in' operator. E.g.,
         {'key1': 'value1'} in step_1 -> True
         {'key3': 'value3'} in step_2 -> True
+
+    The optional 'execution' tag decides how the function is run. Its value is one from the
+    workflow.helpers.execution.ExecutionMode namespace. E.g.,
+        Step(function, execution=ExecutionMode.POOL) runs the function in a pool of persistent worker processes.
+    By default, coroutine functions (async def) are run on a shared event loop (ExecutionMode.ASYNCIO) and a new
+    process is forked for every run of other functions.
+
+    The optional 'timeout' tag is the number of seconds a run may take. A step running for longer is terminated (and
+    killed if it doesn't exit within the number of seconds in the optional 'timeout_grace_period' tag) by the default
+    workflow and moved to the Error state. See workflow.default_workflow.state_machine.AutomaticActions.check_step.
     """
     unique_id = 0
 
@@ -74,8 +87,12 @@ class Step(ExceptionSafeSubProcessFunction):
 
         :param function:    A callable.
         :param tags:        Arbitrary key-value pairs to be associated with this step. See class documentation.
+        :raises:            ValueError if the 'execution' tag is not a valid execution mode.
         """
-        super(Step, self).__init__(function)
+        execution_mode = tags.get('execution')
+        if execution_mode is None and iscoroutinefunction(function):
+            execution_mode = ExecutionMode.ASYNCIO
+        super(Step, self).__init__(function, executor=get_executor(execution_mode))
 
         self.id = Step.unique_id
         Step.unique_id += 1
@@ -111,8 +128,14 @@ class ContextWrapper:
     shared context.
 
     If either the pre_processor or post_processor raise an exception, it will become the exception of the step.
+
+    With a cache (see workflow.helpers.results.StepResultCache), the step is not run if a return value is stored for
+    its function, the args and kwargs from the pre_processor and the values of the cache_context_keys in the context.
+    The stored return value is used instead (the post_processor is still called). The return values of successful
+    runs are stored. Whether the lookup was a hit or miss is recorded in the step data of the context as:
+        {'cache': <workflow.helpers.results.CacheResult.HIT or CacheResult.MISS>}
     """
-    def __init__(self, step, pre_processor=None, post_processor=None):
+    def __init__(self, step, pre_processor=None, post_processor=None, cache=None, cache_context_keys=None):
         """Setup the pre and post processors.
 
         :param step:                A Step like object.
@@ -130,10 +153,20 @@ class ContextWrapper:
                                     If no post_processor is provided:
                                     1. The step's return_value will be passed as-is.
                                     2. The step's exception will be passed as-is.
+        :param cache:               A workflow.helpers.results.StepResultCache like object. None means the step is
+                                    always run. Steps that are passed connections (e.g., by io_preprocessor or
+                                    output_preprocessor) are always run too.
+        :param cache_context_keys:  The keys (list) of the values in the context that the return value depends on.
+                                    They are part of the cache key. When no pre_processor is provided, these are the
+                                    only arguments in the cache key.
         """
         self._step = step
         self._pre_processor = pre_processor
         self._post_processor = post_processor
+        self._cache = cache
+        self._cache_context_keys = cache_context_keys or []
+        self._cache_key = None
+        self._cached_result = None
 
         self.tags = self._step.tags
         self.id = self._step.id
@@ -154,6 +187,8 @@ class ContextWrapper:
         :return:        None
         """
         self._context = context
+        self._cache_key = None
+        self._cached_result = None
         if self._pre_processor:
             try:
                 args, kwargs = self._pre_processor(self._step, self._context)
@@ -163,28 +198,55 @@ class ContextWrapper:
                 self._exception = e
                 return
 
+            if self._cache is not None and self._use_cache(args, kwargs):
+                return
+
             try:
                 self._step.start(*args, **kwargs)
             except Exception as e:
                 logger.exception('Failed to start step: {} due to error: {}'.format(str(self._step), e))
                 self._exception = e
         else:
+            if self._cache is not None and self._use_cache(tuple(), {}):
+                return
+
             try:
                 self._step.start(self._context)
             except Exception as e:
                 logger.exception('Failed to start step: {} due to error: {}'.format(str(self._step), e))
                 self._exception = e
 
+    def _use_cache(self, args, kwargs):
+        """Look up the cache and record whether it was a hit or miss in the step data.
+
+        :param args:    The args for the step's function.
+        :param kwargs:  The kwargs for the step's function.
+        :return:        True if the return value was found (i.e., the step needn't be run). False otherwise.
+        """
+        values = [self._context.get(key) for key in self._cache_context_keys]
+        key = self._cache.make_key(getattr(self._step, 'function', self._step), args, kwargs, values)
+        if key is None:
+            return False
+
+        outcome, return_value = self._cache.get(key)
+        self._context['step_data'].setdefault(self.id, {})['cache'] = outcome
+        if outcome == CacheResult.HIT:
+            self._cached_result = (return_value, None)
+            return True
+        self._cache_key = key
+        return False
+
     def join(self):
         """Wait for the subprocess to finish."""
-        self._step.join()
+        if self._cached_result is None:
+            self._step.join()
 
     def is_alive(self):
         """Check if the subprocess is running.
 
         :return: True if the process is running. False otherwise.
         """
-        return self._step.is_alive()
+        return self._cached_result is None and self._step.is_alive()
 
     def get_result(self):
         """Obtain the result from the function run.
@@ -203,7 +265,7 @@ class ContextWrapper:
             return_value = None
             exception = self._exception
         else:
-            result = self._step.get_result()
+            result = self._cached_result or self._step.get_result()
             if result:
                 try:
                     return_value, exception = result
@@ -214,6 +276,10 @@ class ContextWrapper:
             else:
                 return result
 
+            if self._cache_key is not None and exception is None:
+                self._cache.put(self._cache_key, return_value)
+                self._cache_key = None
+
         if self._post_processor:
             try:
                 return_value, exception = self._post_processor(self._step, self._context, return_value, exception)
@@ -223,9 +289,25 @@ class ContextWrapper:
                 return_value, exception = None, e
         return return_value, exception
 
+    def get_resource_usage(self):
+        """Obtain the resource usage of the function run (see ExceptionSafeSubProcessFunction.get_resource_usage).
+
+        :return:    A dictionary of the resource usage or None if the function wasn't run (e.g., the pre-processor
+                    failed or the result was cached) or it hasn't completed.
+        """
+        if self._exception or self._cached_result is not None:
+            return None
+        return getattr(self._step, 'get_resource_usage', lambda: None)()
+
     def terminate(self):
         """Terminate the subprocess."""
-        self._step.terminate()
+        if self._cached_result is None:
+            self._step.terminate()
+
+    def kill(self):
+        """Kill the subprocess."""
+        if self._cached_result is None:
+            getattr(self._step, 'kill', self._step.terminate)()
 
 
 class ChainPreProcessors:
@@ -273,7 +355,17 @@ def make_contextless_step(function, **tags):
                         3. Upon being called, calls the given function and returns its returned value or raised
                            exception.
     """
-    return ContextWrapper(Step(function, **tags), pre_processor=lambda step, context: (tuple(), dict()))
+    return ContextWrapper(Step(function, **tags), pre_processor=no_arguments_preprocessor)
+
+
+def no_arguments_preprocessor(step, context):
+    """Pre-processor that passes no arguments to the step's function.
+
+    :param step:    The step object (ignored).
+    :param context: The context object (ignored).
+    :return:        A tuple of the form (args, kwargs) with no args and no kwargs.
+    """
+    return tuple(), dict()
 
 
 def instruction(connection, message, timeout=None):
@@ -390,14 +482,47 @@ def make_simple_preprocessor(obj):
     """Factory that makes a function that accepts (step, context) and returns the given obj as *args and no kwargs.
 
     :param obj: Any object.
-    :return:    A function that accepts (step, context) paramteres and returns a tuple (*args, **kwargs) in the
+    :return:    A callable that accepts (step, context) paramteres and returns a tuple (*args, **kwargs) in the
                 following form:
                 (
                     (obj,),
                     {}
                 )
     """
-    return lambda step, context: ((obj,), {})
+    return SimplePreProcessor(obj)
+
+
+class SimplePreProcessor:
+    """Pre-processor that passes the given obj as the only argument to the step's function.
+
+    Unlike a closure, this can be pickled (as long as obj can be) and hence used with the 'spawn' and 'forkserver'
+    start methods. See make_simple_preprocessor.
+    """
+    def __init__(self, obj):
+        """Setup the object to be passed.
+
+        :param obj: Any object.
+        """
+        self.obj = obj
+
+    def __call__(self, step, context):
+        """Return the object as *args and no kwargs.
+
+        :param step:    The step object (ignored).
+        :param context: The context object (ignored).
+        :return:        A tuple of the form ((obj,), {}).
+        """
+        return (self.obj,), {}
+
+
+def pass_through(message):
+    """Filter that keeps the message as is. The default STDOUT, STDERR and exit code filter of ShellCommand."""
+    return message
+
+
+def ignore(message):
+    """Filter that drops every message. The default error filter of ShellCommand."""
+    return None
 
 
 class ShellCommandFailedError(RuntimeError):
@@ -410,8 +535,8 @@ class ShellCommand:
 
     Raises ShellCommandFailedError when either the error_filter or the exit_code_filter returns a True value.
     """
-    def __init__(self, stdout_filter=lambda x: x, stderr_filter=lambda x: x, error_filter=lambda x: None,
-                 exit_code_filter=lambda x: x, delay=1):
+    def __init__(self, stdout_filter=pass_through, stderr_filter=pass_through, error_filter=ignore,
+                 exit_code_filter=pass_through, delay=1):
         """Setup the filters and delay to be used when running the system command.
 
         :param stdout_filter:       Filter function for STDOUT messages. This function should accept a string and
@@ -0,0 +1,379 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+
+"""
+import threading
+import unittest
+
+from multiprocessing import Pipe
+from time import monotonic, sleep
+from unittest import mock
+
+from autotrail.core.api.management import APIRequest, MethodAPIHandlerWrapper
+from autotrail.workflow.default_workflow.api import (DEFAULT_WAIT_TIMEOUT, LRUCache, StateIndex, StatusField, TagIndex,
+                                                     WorkflowAPIClientWrapper, WorkflowAPIHandler,
+                                                     WorkflowEventPublisher, filter_steps_by_tags)
+from autotrail.workflow.helpers.step import Step
+
+
+class CountingMapping:
+    """A read-only mapping that counts the number of times it is copied, like a multiprocessing.Manager dictionary."""
+    def __init__(self, data):
+        self._data = data
+        self.copies = 0
+
+    def keys(self):
+        self.copies += 1
+        return self._data.keys()
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+
+class CountingChanges(list):
+    """A list of state changes that counts the number of times it is read, like a multiprocessing.Manager list."""
+    def __init__(self, changes):
+        super().__init__(changes)
+        self.reads = 0
+
+    def __getitem__(self, key):
+        self.reads += 1
+        return super().__getitem__(key)
+
+
+class Value:
+    def __init__(self, value=0):
+        self.value = value
+
+
+class CountingSerializer:
+    def __init__(self, serialized):
+        self._serialized = serialized
+        self.copies = 0
+        self.version = Value()
+
+    def snapshot(self):
+        self.copies += 1
+        return dict(self._serialized)
+
+
+class PerStepSerializer(CountingSerializer):
+    def __init__(self, serialized):
+        super().__init__(serialized)
+        self.requested_step_ids = []
+        self.requested_keys = []
+
+    def get_step_data(self, step_ids, keys=None):
+        self.requested_step_ids.extend(step_ids)
+        self.requested_keys.append(keys)
+        return {step_id: {key: value for key, value in self._serialized['step_data'][step_id].items()
+                          if keys is None or key in keys}
+                for step_id in step_ids}
+
+
+class CallbackManager:
+    def __init__(self, steps):
+        self.states = CountingMapping({step.id: 'Ready' for step in steps})
+        self.states_changes = CountingChanges([{step.id: 'Ready' for step in steps}])
+        self.transitions = CountingMapping({step.id: ['Start'] for step in steps})
+        self.context_serializer = CountingSerializer({'step_data': {step.id: {'io': [], 'output': ['foo']}
+                                                                    for step in steps}})
+        self.states_version = Value(1)
+        self.transitions_version = Value()
+        self.api_client_connection, _ = Pipe()
+
+    def change_states(self, states):
+        self.states._data.update(states)
+        self.states_changes.append(states)
+        self.states_version.value += 1
+
+
+def function():
+    pass
+
+
+class WorkflowAPIHandlerTests(unittest.TestCase):
+    def setUp(self):
+        self.steps = [Step(function, name='step_{}'.format(i), group=i % 2) for i in range(50)]
+        self.callback_manager = CallbackManager(self.steps)
+        self.handler = MethodAPIHandlerWrapper(WorkflowAPIHandler(self.steps, self.callback_manager, None))
+
+    def test_status_copies_the_workflow_once(self):
+        response = self.handler(APIRequest('status', (), {}))
+
+        self.assertEqual(len(response.return_value), 50)
+        self.assertEqual(response.return_value[self.steps[0].id][StatusField.OUTPUT], ['foo'])
+        self.assertEqual(response.return_value[self.steps[0].id][StatusField.STATE], 'Ready')
+        # The states are not copied, only their changes are read.
+        self.assertEqual(self.callback_manager.states.copies, 0)
+        self.assertEqual(self.callback_manager.states_changes.reads, 1)
+        self.assertEqual(self.callback_manager.transitions.copies, 1)
+        self.assertEqual(self.callback_manager.context_serializer.copies, 1)
+
+    def test_each_request_takes_a_new_snapshot(self):
+        self.handler(APIRequest('status', (), {'fields': [StatusField.STATE], 'group': 1}))
+        self.handler(APIRequest('status', (), {'fields': [StatusField.STATE], 'group': 0}))
+
+        # The states version is read for each request, the changes only when it changes.
+        self.assertEqual(self.callback_manager.states_changes.reads, 1)
+        self.callback_manager.change_states({self.steps[0].id: 'Running'})
+        status = self.handler(APIRequest('status', (), {'fields': [StatusField.STATE], 'group': 0})).return_value
+        self.assertEqual(status[self.steps[0].id][StatusField.STATE], 'Running')
+        self.assertEqual(self.callback_manager.states_changes.reads, 2)
+        self.assertEqual(self.callback_manager.states_changes[1:], [{self.steps[0].id: 'Running'}])
+        # The transitions are not needed for the state.
+        self.assertEqual(self.callback_manager.transitions.copies, 0)
+
+    def test_responses_are_cached_by_version(self):
+        request = APIRequest('status', (), {'fields': [StatusField.STATE, StatusField.OUTPUT]})
+        response = self.handler(request)
+        self.assertIs(self.handler(request).return_value, response.return_value)
+        self.assertEqual(self.callback_manager.context_serializer.copies, 1)
+
+        self.callback_manager.change_states({self.steps[0].id: 'Running'})
+        self.assertIsNot(self.handler(request).return_value, response.return_value)
+        self.assertEqual(self.callback_manager.context_serializer.copies, 2)
+
+        self.callback_manager.context_serializer.version.value += 1
+        self.handler(request)
+        self.assertEqual(self.callback_manager.context_serializer.copies, 3)
+
+    def test_unversioned_context_is_not_cached(self):
+        del self.callback_manager.context_serializer.version
+        request = APIRequest('status', (), {'fields': [StatusField.OUTPUT]})
+        self.handler(request)
+        self.handler(request)
+        self.assertEqual(self.callback_manager.context_serializer.copies, 2)
+
+        request = APIRequest('status', (), {'fields': [StatusField.STATE]})
+        response = self.handler(request)
+        self.assertIs(self.handler(request).return_value, response.return_value)
+
+    def test_if_changed_since(self):
+        response = self.handler(APIRequest('status', (), {'if_changed_since': 0, 'group': 0})).return_value
+        self.assertEqual(len(response['result']), 25)
+
+        response = self.handler(APIRequest('status', (), {'if_changed_since': response['version'], 'group': 0}))
+        self.assertEqual(response.return_value['result'], WorkflowAPIHandler.NOT_MODIFIED)
+
+        self.callback_manager.change_states({self.steps[0].id: 'Running'})
+        response = self.handler(APIRequest('status', (), {'if_changed_since': response.return_value['version'],
+                                                          'group': 0}))
+        self.assertEqual(len(response.return_value['result']), 25)
+
+        response = self.handler(APIRequest('list', (), {'if_changed_since': 0}))
+        self.assertEqual(len(response.return_value['result']), 50)
+        response = self.handler(APIRequest('list', (), {'if_changed_since': response.return_value['version']}))
+        self.assertEqual(response.return_value['result'], WorkflowAPIHandler.NOT_MODIFIED)
+
+
+    def test_status_reads_only_the_requested_data(self):
+        self.handler(APIRequest('status', (), {'fields': [StatusField.STATE]}))
+
+        self.assertEqual(self.callback_manager.transitions.copies, 0)
+        self.assertEqual(self.callback_manager.context_serializer.copies, 0)
+
+    def test_status_tail(self):
+        self.callback_manager.context_serializer._serialized['step_data'][self.steps[0].id]['output'] = [1, 2, 3]
+
+        status = self.handler(APIRequest('status', (), {'fields': [StatusField.OUTPUT], 'tail': 2})).return_value
+        self.assertEqual(status[self.steps[0].id][StatusField.OUTPUT], [2, 3])
+        self.assertEqual(status[self.steps[1].id][StatusField.OUTPUT], ['foo'])
+
+        status = self.handler(APIRequest('status', (), {'fields': [StatusField.OUTPUT], 'tail': 0})).return_value
+        self.assertEqual(status[self.steps[0].id][StatusField.OUTPUT], [])
+
+    def test_status_page(self):
+        serializer = PerStepSerializer(self.callback_manager.context_serializer._serialized)
+        self.callback_manager.context_serializer = serializer
+        step_ids = []
+        cursor = 0
+        while cursor is not None:
+            page = self.handler(APIRequest('status_page', (), {'cursor': cursor, 'limit': 10, 'group': 1})).return_value
+            self.assertLessEqual(len(page['steps']), 10)
+            step_ids.extend(page['steps'])
+            cursor = page['cursor']
+
+        self.assertEqual(step_ids, [step.id for step in self.steps[1::2]])
+        # Only the data of the steps in each page is read.
+        self.assertEqual(serializer.requested_step_ids, step_ids)
+        self.assertEqual(serializer.copies, 0)
+
+    def test_status_reads_only_the_requested_fields(self):
+        serializer = PerStepSerializer(self.callback_manager.context_serializer._serialized)
+        self.callback_manager.context_serializer = serializer
+        status = self.handler(APIRequest('status', (), {'fields': [StatusField.RETURN_VALUE, StatusField.EXCEPTION],
+                                                        'n': self.steps[0].id})).return_value
+        self.assertEqual(status[self.steps[0].id][StatusField.RETURN_VALUE], None)
+        self.assertEqual(sorted(serializer.requested_keys[0]), ['exception', 'return_value'])
+
+        self.handler(APIRequest('status', (), {'fields': [StatusField.STATE]}))
+        self.assertEqual(len(serializer.requested_keys), 1)
+        self.assertEqual(serializer.copies, 0)
+
+    def test_state_filter_follows_state_changes(self):
+        request = APIRequest('status', (), {'fields': [StatusField.STATE], 'states': ['Running'], 'group': 0})
+        self.assertEqual(self.handler(request).return_value, {})
+
+        self.callback_manager.change_states({self.steps[2].id: 'Running', self.steps[3].id: 'Running'})
+        self.assertEqual(list(self.handler(request).return_value), [self.steps[2].id])
+
+    def test_actions_follow_transition_changes(self):
+        request = APIRequest('status', (), {'fields': [StatusField.ACTIONS], 'n': self.steps[0].id})
+        self.assertEqual(self.handler(request).return_value[self.steps[0].id][StatusField.ACTIONS], ['Start'])
+
+        # The transitions are recorded after the states, so they may change without the states version changing.
+        self.callback_manager.transitions._data[self.steps[0].id] = ['Pause']
+        self.callback_manager.transitions_version.value += 1
+        self.assertEqual(self.handler(request).return_value[self.steps[0].id][StatusField.ACTIONS], ['Pause'])
+
+    def test_cache_statistics(self):
+        step_data = self.callback_manager.context_serializer._serialized['step_data']
+        step_data[self.steps[0].id]['cache'] = 'hit'
+        step_data[self.steps[1].id]['cache'] = 'miss'
+        step_data[self.steps[2].id]['cache'] = 'hit'
+
+        statistics = self.handler(APIRequest('cache_statistics', (), {})).return_value
+        self.assertEqual((statistics['hits'], statistics['misses']), (2, 1))
+
+        statistics = self.handler(APIRequest('cache_statistics', (), {'group': 0})).return_value
+        self.assertEqual(statistics, {'hits': 2, 'misses': 0, 'steps': {self.steps[0].id: 'hit',
+                                                                          self.steps[2].id: 'hit'}})
+
+    def test_resource_summary(self):
+        step_data = self.callback_manager.context_serializer._serialized['step_data']
+        step_data[self.steps[0].id]['resource_usage'] = {'wall_time': 3.0, 'user_time': 1.0, 'system_time': 0.5}
+        step_data[self.steps[1].id]['resource_usage'] = {'wall_time': 1.0, 'user_time': 2.0, 'system_time': 0.0,
+                                                         'children_user_time': 1.0, 'children_system_time': 0.0}
+        step_data[self.steps[2].id]['resource_usage'] = {'wall_time': 2.0}
+
+        summary = self.handler(APIRequest('resource_summary', (), {'limit': 2})).return_value
+        self.assertEqual((summary['steps'], summary['wall_time'], summary['cpu_time']), (3, 6.0, 4.5))
+        self.assertEqual([(step['n'], step['cpu_time']) for step in summary['top_steps']],
+                         [(self.steps[1].id, 3.0), (self.steps[0].id, 1.5)])
+
+        summary = self.handler(APIRequest('resource_summary', (), {'sort_by': 'wall_time', 'group': 0})).return_value
+        self.assertEqual([step['n'] for step in summary['top_steps']], [self.steps[0].id, self.steps[2].id])
+
+        statuses = self.handler(APIRequest('status', (), {'fields': [StatusField.RESOURCE_USAGE]})).return_value
+        self.assertEqual(statuses[self.steps[2].id][StatusField.RESOURCE_USAGE], {'wall_time': 2.0})
+        self.assertIsNone(statuses[self.steps[3].id][StatusField.RESOURCE_USAGE])
+
+
+class RecordingClient:
+    def __init__(self):
+        self.timeouts = []
+
+    def __call__(self, request, timeout=None):
+        self.timeouts.append(timeout)
+
+
+class WorkflowAPIClientWrapperTests(unittest.TestCase):
+    def test_waiting_calls_wait_for_their_timeout(self):
+        client = RecordingClient()
+        api_client = WorkflowAPIClientWrapper(client, timeout=5)
+        api_client.status()
+        api_client.wait_for_change(3)
+        api_client.wait_for_change(3, 10)
+        api_client.wait_for_states(['Running'], timeout=20, name='foo')
+        api_client.wait_for_states(['Running'], name='foo')
+
+        self.assertEqual(client.timeouts, [5, 5 + DEFAULT_WAIT_TIMEOUT, 15, 25, 5 + DEFAULT_WAIT_TIMEOUT])
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_least_recently_used_item_is_evicted(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+
+class TagIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.steps = [Step(function, name='step_{}'.format(i), group=i % 3, hosts=['host_{}'.format(i % 2)])
+                      for i in range(30)]
+        self.tag_index = TagIndex(self.steps)
+
+    def test_find_matches_filter_steps_by_tags(self):
+        for tags in [{}, {'group': 1}, {'group': 1, 'name': 'step_4'}, {'group': 1, 'name': 'step_5'},
+                     {'hosts': ['host_0']}, {'group': 2, 'hosts': ['host_1']}, {'foo': 'bar'}, {'group': {}}]:
+            self.assertEqual(self.tag_index.find(tags), list(filter_steps_by_tags(self.steps, tags)))
+
+    def test_find_positions(self):
+        self.assertEqual(self.tag_index.find_positions({'group': 0, 'hosts': ['host_1']}), [3, 9, 15, 21, 27])
+
+
+class WorkflowEventPublisherTests(unittest.TestCase):
+    def test_concurrent_first_waits_are_woken_up(self):
+        steps = [Step(function, name='step')]
+        callback_manager = CallbackManager(steps)
+        publisher = WorkflowEventPublisher(steps, callback_manager, interval=0.01)
+        barrier = threading.Barrier(10)
+        results = []
+
+        def make_slow_lock():
+            # Widens the window in which concurrent first waits could start the publisher more than once.
+            sleep(0.05)
+            return threading.Lock()
+
+        def wait():
+            barrier.wait()
+            results.append(publisher.wait(lambda states, version: states[steps[0].id] == 'Running', 5)[0])
+
+        threads_before = threading.active_count()
+        threads = [threading.Thread(target=wait) for _ in range(10)]
+        with mock.patch('autotrail.workflow.default_workflow.api.Lock', make_slow_lock):
+            for thread in threads:
+                thread.start()
+            sleep(0.2)
+            barrier_time = monotonic()
+            callback_manager.change_states({steps[0].id: 'Running'})
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, [True] * 10)
+        self.assertLess(monotonic() - barrier_time, 4)
+        # Only one watcher thread is started.
+        self.assertEqual(threading.active_count(), threads_before + 1)
+
+
+class StateIndexTests(unittest.TestCase):
+    def test_index_is_updated_with_the_changes(self):
+        changes = CountingChanges([{0: 'Ready', 1: 'Ready', 2: 'Running'}])
+        state_index = StateIndex(changes)
+        state_index.update(1)
+        self.assertEqual(state_index.find(['Ready']), {0, 1})
+
+        changes.extend([{0: 'Running'}, {0: 'Paused', 2: 'Succeeded'}, {0: 'Running'}])
+        state_index.update(3)
+        self.assertEqual(state_index.find(['Paused']), {0})
+        self.assertEqual(state_index.find(['Ready']), {1})
+        self.assertEqual(state_index.find(['Running', 'Succeeded']), {2})
+        self.assertEqual(state_index.find(['Failed']), set())
+        self.assertEqual(state_index.get_state(0), 'Paused')
+
+        # Only the changes after the last update are read.
+        changes.reads = 0
+        state_index.update(3)
+        state_index.update(4)
+        self.assertEqual(changes.reads, 1)
+        self.assertEqual(state_index.find(['Running']), {0})
+        self.assertEqual(state_index.find(['Paused']), set())
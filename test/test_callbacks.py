@@ -0,0 +1,183 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+
+
+"""
+import unittest
+
+from multiprocessing import Pipe
+from time import sleep, time
+
+from autotrail.core.api.callbacks import (AdaptiveDelayCallback, BackgroundObserverCallback, ChainActionCallbacks,
+                                          InjectedActionCallback, ObserverCallback, StatesCallback,
+                                          TransitionsCallback)
+from autotrail.core.state_machine import state_machine_evaluator
+
+
+class RecordingCallback:
+    def __init__(self, delay=0, actions=None):
+        self.delay = delay
+        self.actions = actions
+        self.calls = []
+
+    def __call__(self, states, transitions):
+        sleep(self.delay)
+        self.calls.append(dict(states))
+        return self.actions
+
+
+class AdaptiveDelayCallbackTests(unittest.TestCase):
+    def _timed_call(self, callback, states, actions=None):
+        start = time()
+        callback(states, {}, actions)
+        return time() - start
+
+    def test_no_delay_when_active(self):
+        callback = AdaptiveDelayCallback(max_delay=1, min_delay=0.5)
+        self.assertLess(self._timed_call(callback, {'a': 'Ready'}), 0.1)
+        self.assertLess(self._timed_call(callback, {'a': 'Waiting'}), 0.1)
+        self.assertLess(self._timed_call(callback, {'a': 'Waiting'}, actions={'a': 'Run'}), 0.1)
+
+    def test_backoff_when_idle(self):
+        callback = AdaptiveDelayCallback(max_delay=0.2, min_delay=0.05, backoff=2)
+        states = {'a': 'Running'}
+        callback(states, {})
+
+        delays = [self._timed_call(callback, states) for _ in range(4)]
+
+        self.assertAlmostEqual(delays[0], 0.05, delta=0.04)
+        self.assertAlmostEqual(delays[1], 0.1, delta=0.04)
+        self.assertAlmostEqual(delays[2], 0.2, delta=0.04)
+        self.assertAlmostEqual(delays[3], 0.2, delta=0.04)
+
+        # Activity resets the delay.
+        self.assertLess(self._timed_call(callback, {'a': 'Successful'}), 0.04)
+        self.assertAlmostEqual(self._timed_call(callback, {'a': 'Successful'}), 0.05, delta=0.04)
+
+    def test_connection_ends_idle_delay(self):
+        reader, writer = Pipe(duplex=False)
+        callback = AdaptiveDelayCallback(max_delay=5, min_delay=5, connections=[reader])
+        states = {'a': 'Running'}
+        callback(states, {})
+
+        writer.send('Wake up')
+        self.assertLess(self._timed_call(callback, states), 1)
+
+
+class InjectedActionCallbackTests(unittest.TestCase):
+    def test_actions_reader_wakes_up_on_injected_actions(self):
+        callback = InjectedActionCallback()
+        self.assertFalse(callback.actions_reader.poll())
+
+        callback.actions_writer.send({'a': 'Pause'})
+        self.assertTrue(callback.actions_reader.poll(1))
+        self.assertEqual(callback({'a': 'Running'}, {'a': {'Pause': 'Paused'}}), {'a': 'Pause'})
+
+
+class ObserverCallbackTests(unittest.TestCase):
+    def test_concurrent_observers(self):
+        observer_1 = RecordingCallback(delay=0.3, actions={'a': 'Ignored'})
+        observer_2 = RecordingCallback(delay=0.3)
+        action_callback = RecordingCallback(delay=0.3, actions={'a': 'Run'})
+        chain = ChainActionCallbacks([ObserverCallback(observer_1), ObserverCallback(observer_2), action_callback],
+                                     concurrent_observers=True)
+
+        start = time()
+        actions = chain({'a': 'Waiting'}, {'a': {'Run': 'Running'}})
+
+        self.assertLess(time() - start, 0.6)
+        self.assertEqual(actions, {'a': 'Run'})
+        self.assertEqual(observer_1.calls, [{'a': 'Waiting'}])
+        self.assertEqual(observer_2.calls, [{'a': 'Waiting'}])
+
+    def test_concurrent_observer_exception_is_raised(self):
+        def failing_observer(states, transitions):
+            raise ValueError('Observer failed.')
+
+        chain = ChainActionCallbacks([ObserverCallback(failing_observer)], concurrent_observers=True)
+        with self.assertRaises(ValueError):
+            chain({'a': 'Waiting'}, {'a': {'Run': 'Running'}})
+
+    def test_background_observer_latest_snapshot_wins(self):
+        observer = RecordingCallback(delay=0.2)
+        callback = BackgroundObserverCallback(observer)
+        transitions = {'a': {'Succeed': 'Successful'}}
+
+        start = time()
+        for i in range(5):
+            callback({'a': i}, transitions)
+        self.assertLess(time() - start, 0.2)
+
+        # Closing waits for the pending snapshot to be recorded and stops the background thread.
+        callback({'a': 'Successful'}, {'a': {}})
+        callback.close()
+        self.assertEqual(observer.calls[-1], {'a': 'Successful'})
+        self.assertLess(len(observer.calls), 6)
+        self.assertFalse(callback._thread.is_alive())
+
+        # Calls made after closing are recorded synchronously.
+        callback({'a': 'Closed'}, {'a': {}})
+        self.assertEqual(observer.calls[-1], {'a': 'Closed'})
+
+    def test_close_shuts_down_the_observers(self):
+        observer = RecordingCallback(delay=0.2)
+        background_observer = BackgroundObserverCallback(RecordingCallback(delay=0.2))
+        chain = ChainActionCallbacks([ObserverCallback(observer), background_observer], concurrent_observers=True)
+        chain({'a': 'Waiting'}, {'a': {'Run': 'Running'}})
+        executor = chain._executor
+
+        chain.close()
+
+        self.assertIsNone(chain._executor)
+        with self.assertRaises(RuntimeError):
+            executor.submit(observer, {}, {})
+        self.assertFalse(background_observer._thread.is_alive())
+        self.assertEqual(background_observer._callback.calls, [{'a': 'Waiting'}])
+
+    def test_evaluator_closes_the_callback(self):
+        observer = RecordingCallback(delay=0.1)
+        callback = BackgroundObserverCallback(observer)
+        definitions = {'a': ('Ready', {'Ready': {'Run': ('Done', [{}])}})}
+
+        state_machine_evaluator(definitions, ChainActionCallbacks([callback, lambda states, transitions: {'a': 'Run'}]))
+
+        self.assertEqual(observer.calls[-1], {'a': 'Done'})
+        self.assertFalse(callback._thread.is_alive())
+
+
+class StatesCallbackTests(unittest.TestCase):
+    def test_version_changes_only_with_states(self):
+        callback = StatesCallback()
+        self.assertEqual(callback.version.value, 0)
+
+        callback({'a': 'Ready', 'b': 'Ready'}, {})
+        callback({'a': 'Ready', 'b': 'Ready'}, {})
+        self.assertEqual(callback.version.value, 1)
+
+        callback({'a': 'Running', 'b': 'Ready'}, {})
+        self.assertEqual(callback.version.value, 2)
+        self.assertEqual(dict(callback.states), {'a': 'Running', 'b': 'Ready'})
+        self.assertEqual(list(callback.changes), [{'a': 'Ready', 'b': 'Ready'}, {'a': 'Running'}])
+
+
+class TransitionsCallbackTests(unittest.TestCase):
+    def test_version_changes_only_with_transitions(self):
+        callback = TransitionsCallback()
+        callback({}, {'a': ['Start'], 'b': []})
+        callback({'a': 'Running'}, {'a': ['Start'], 'b': []})
+        self.assertEqual(callback.version.value, 1)
+
+        callback({}, {'a': ['Pause'], 'b': []})
+        self.assertEqual(callback.version.value, 2)
+        self.assertEqual(dict(callback.transitions), {'a': ['Pause'], 'b': []})
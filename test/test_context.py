@@ -0,0 +1,201 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+
+
+"""
+import unittest
+
+from multiprocessing import Pipe
+from tempfile import TemporaryDirectory
+from time import time
+
+from autotrail.workflow.helpers.context import (ContextSerializer, IncrementalContextSerializer, make_context,
+                                                make_step_data_signature, read_step_messages, serialize_step_data,
+                                                step_data_signatures_match)
+
+
+class SerializeStepDataTests(unittest.TestCase):
+    def test_serialize_step_data(self):
+        context = make_context()
+        output_reader, output_writer = Pipe(duplex=False)
+        io_connection, step_io_connection = Pipe(duplex=True)
+        context['step_data'][0] = {'ro_connection': output_reader, 'return_value': 'foo'}
+        context['step_data'][1] = {'rw_connection': io_connection, 'exception': 'bar'}
+        output_writer.send('Output message.')
+        step_io_connection.send('Instruction.')
+
+        self.assertEqual(serialize_step_data(context), {
+            0: {'return_value': 'foo', 'exception': None, 'io': [], 'output': ['Output message.']},
+            1: {'return_value': None, 'exception': 'bar', 'io': ['Instruction.'], 'output': []},
+        })
+
+        output_writer.send('Another output message.')
+        self.assertEqual(serialize_step_data(context)[0]['output'], ['Output message.', 'Another output message.'])
+
+    def test_idle_connections_do_not_block(self):
+        context = make_context()
+        writers = []
+        for step_id in range(500):
+            reader, writer = Pipe(duplex=False)
+            writers.append(writer)
+            context['step_data'][step_id] = {'ro_connection': reader}
+        writers[42].send('Output message.')
+
+        start = time()
+        serialized_step_data = serialize_step_data(context)
+
+        self.assertLess(time() - start, 1)
+        self.assertEqual(serialized_step_data[42]['output'], ['Output message.'])
+        self.assertEqual(serialized_step_data[43]['output'], [])
+
+    def test_bounded_buffer_and_spill(self):
+        context = make_context()
+        output_reader, output_writer = Pipe(duplex=False)
+        context['step_data'][0] = {'ro_connection': output_reader}
+        for i in range(5):
+            output_writer.send('Line {}'.format(i))
+
+        with TemporaryDirectory() as run_directory:
+            serialized_step_data = serialize_step_data(context, buffer_size=2, run_directory=run_directory)[0]
+            output_writer.send({'Line': 5})
+            serialized_step_data = serialize_step_data(context, buffer_size=2, run_directory=run_directory)[0]
+
+            self.assertEqual(serialized_step_data['output'], ['Line 4', {'Line': 5}])
+            self.assertEqual(serialized_step_data['output_count'], 6)
+            self.assertEqual(serialized_step_data['io'], [])
+            self.assertEqual(serialized_step_data['io_count'], 0)
+
+            messages, offset = read_step_messages(serialized_step_data['output_file'], limit=4)
+            self.assertEqual(messages, ['Line 0', 'Line 1', 'Line 2', 'Line 3'])
+            messages, offset = read_step_messages(serialized_step_data['output_file'], offset=offset)
+            self.assertEqual(messages, ['Line 4', {'Line': 5}])
+            self.assertEqual(read_step_messages(serialized_step_data['output_file'], offset=offset), ([], offset))
+
+            # A new run in the same directory replaces the messages of the previous one.
+            context['step_data'][0] = {'ro_connection': output_reader}
+            output_writer.send('New line')
+            serialized_step_data = serialize_step_data(context, buffer_size=2, run_directory=run_directory)[0]
+            self.assertEqual(read_step_messages(serialized_step_data['output_file']), (['New line'], 11))
+
+
+class RecordingDict(dict):
+    def __init__(self, data):
+        super().__init__(data)
+        self.read_keys = []
+
+    def get(self, key, default=None):
+        self.read_keys.append(key)
+        return super().get(key, default)
+
+
+class ContextSerializerTests(unittest.TestCase):
+    def test_only_the_requested_keys_are_read(self):
+        context = make_context()
+        output_reader, output_writer = Pipe(duplex=False)
+        context['step_data'][0] = {'ro_connection': output_reader, 'return_value': 'foo', 'timeout': 'Timed out.'}
+        context['step_data'][1] = {}
+        serializer = ContextSerializer(context)
+        output_writer.send('Output message.')
+        serializer()
+
+        self.assertEqual(serializer.snapshot(), {'step_data': serialize_step_data(context)})
+        serializer.serialized = RecordingDict(serializer.serialized.copy())
+        self.assertEqual(serializer.get_step_data([0], keys=['return_value']), {0: {'return_value': 'foo'}})
+        self.assertEqual(serializer.serialized.read_keys, ['return_value'])
+        self.assertEqual(serializer.get_step_data([0, 1, 2])[0]['output'], ['Output message.'])
+        self.assertEqual(sorted(serializer.get_step_data([0, 1, 2])), [0, 1])
+
+        # Keys removed from the step data are removed from the published data too.
+        serializer = ContextSerializer(context)
+        serializer()
+        del context['step_data'][0]['timeout']
+        serializer()
+        self.assertNotIn('timeout', serializer.get_step_data([0])[0])
+
+
+class IncrementalContextSerializerTests(unittest.TestCase):
+    def test_only_changes_are_published(self):
+        context = make_context()
+        output_reader, output_writer = Pipe(duplex=False)
+        context['step_data'][0] = {'ro_connection': output_reader}
+        context['step_data'][1] = {}
+        serializer = IncrementalContextSerializer(context)
+
+        serializer()
+        self.assertEqual(serializer.version.value, 1)
+        self.assertEqual(serializer.snapshot(), {'step_data': {
+            0: {'return_value': None, 'exception': None, 'io': [], 'output': [], 'version': 1},
+            1: {'return_value': None, 'exception': None, 'io': [], 'output': [], 'version': 1},
+        }})
+
+        # Nothing changed.
+        serializer()
+        self.assertEqual(serializer.version.value, 1)
+        self.assertEqual(serializer.changes(since_version=1), {'version': 1, 'step_data': {}})
+
+        output_writer.send('Output message.')
+        serializer()
+        self.assertEqual(serializer.changes(since_version=1), {'version': 2, 'step_data': {
+            0: {'return_value': None, 'exception': None, 'io': [], 'output': ['Output message.'], 'version': 2},
+        }})
+
+        context['step_data'][1]['return_value'] = 'foo'
+        serializer()
+        self.assertEqual(serializer.changes(since_version=2), {'version': 3, 'step_data': {
+            1: {'return_value': 'foo', 'exception': None, 'io': [], 'output': [], 'version': 3},
+        }})
+        self.assertEqual(sorted(serializer.changes(since_version=0)['step_data']), [0, 1])
+
+        self.assertEqual(serializer.get_step_data([1, 2]), {
+            1: {'return_value': 'foo', 'exception': None, 'io': [], 'output': [], 'version': 3}})
+        self.assertEqual(sorted(serializer.get_step_data([0, 1])), [0, 1])
+
+    def test_changes_are_published_when_ids_are_reused(self):
+        context = make_context()
+        context['step_data'][0] = {'return_value': [1]}
+        serializer = IncrementalContextSerializer(context)
+        serializer()
+
+        # A new value that may be allocated in place of the freed one (i.e., with the same id).
+        context['step_data'][0]['return_value'] = None
+        context['step_data'][0]['return_value'] = [2]
+        serializer()
+        self.assertEqual(serializer.version.value, 2)
+        self.assertEqual(serializer.get_step_data([0])[0]['return_value'], [2])
+
+        # Equal values aren't published again.
+        context['step_data'][0]['return_value'] = [2]
+        serializer()
+        self.assertEqual(serializer.version.value, 2)
+
+    def test_signatures(self):
+        signature = make_step_data_signature({'return_value': 1, 'exception': None, 'io': [], 'output': []})
+        self.assertTrue(step_data_signatures_match(signature, signature))
+        self.assertFalse(step_data_signatures_match(signature, None))
+        self.assertFalse(step_data_signatures_match(signature, make_step_data_signature(
+            {'return_value': 1.0, 'exception': None, 'io': [], 'output': []})))
+        self.assertFalse(step_data_signatures_match(signature, make_step_data_signature(
+            {'return_value': 1, 'exception': None, 'io': ['foo'], 'output': []})))
+
+    def test_changes_with_bounded_buffer(self):
+        context = make_context()
+        output_reader, output_writer = Pipe(duplex=False)
+        context['step_data'][0] = {'ro_connection': output_reader}
+        serializer = IncrementalContextSerializer(context, buffer_size=1)
+
+        for i in range(3):
+            output_writer.send('Line {}'.format(i))
+            serializer()
+            self.assertEqual(serializer.version.value, i + 1)
+            self.assertEqual(serializer.changes(since_version=i)['step_data'][0]['output'], ['Line {}'.format(i)])
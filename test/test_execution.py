@@ -0,0 +1,430 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+
+"""
+import asyncio
+import gc
+import os
+import pickle
+import signal
+import subprocess
+import sys
+import unittest
+import weakref
+
+from multiprocessing import get_start_method
+
+from threading import Lock
+from time import sleep, time
+
+from autotrail.core.api.callbacks import ObserverMode
+from autotrail.workflow.default_workflow.api import StatusField, make_api_client
+from autotrail.workflow.default_workflow.management import WorkflowManager
+from autotrail.workflow.default_workflow.state_machine import State
+from autotrail.workflow.helpers.context import make_context, make_context_serializer
+from autotrail.workflow.helpers.execution import (WORKER_POOL, AsyncioExecutor, ExceptionSafeSubProcessFunction,
+                                                  ExecutionMode, FunctionRegistry, ProcessExecutor, SubProcessExecution,
+                                                  ThreadExecutor, UsageScope, WorkerPool, cancelled, freeze_gc_on_fork,
+                                                  make_runner, set_start_method)
+from autotrail.workflow.helpers.step import Step, make_contextless_step, make_simple_preprocessor
+
+
+def get_pid(*args, **kwargs):
+    return os.getpid()
+
+
+def get_freeze_count():
+    return gc.get_freeze_count()
+
+
+def fail():
+    raise ValueError('Failed.')
+
+
+def sleep_forever():
+    sleep(60)
+
+
+def ignore_termination():
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sleep(60)
+
+
+def wait_until_cancelled(timeout):
+    for _ in range(int(timeout / 0.01)):
+        if cancelled():
+            return 'cancelled'
+        sleep(0.01)
+    return 'timed out'
+
+
+async def get_pid_later(delay):
+    await asyncio.sleep(delay)
+    return os.getpid()
+
+
+def burn_cpu(with_child=False):
+    if with_child:
+        subprocess.run([sys.executable, '-c', 'sum(range(10 ** 7))'], check=True)
+    return sum(range(10 ** 7))
+
+
+async def fail_later():
+    await asyncio.sleep(0)
+    raise ValueError('Failed.')
+
+
+def run_workflow(socket_file, **kwargs):
+    """Run a workflow of two steps and return the states and return values of the steps."""
+    try:
+        os.remove(socket_file)
+    except OSError:
+        pass
+    first_step, second_step = make_contextless_step(get_pid), make_contextless_step(get_pid)
+    context = make_context()
+    workflow_manager = WorkflowManager([(first_step, second_step)], [], context, make_context_serializer(context),
+                                       socket_file, workflow_delay=0.05, adaptive_delay=True, **kwargs)
+    client = make_api_client(socket_file, timeout=10)
+    workflow_manager.start()
+    try:
+        for _ in range(300):
+            if os.path.exists(socket_file):
+                break
+            sleep(0.1)
+        client.start(dry_run=False)
+        client.wait_for_states([State.SUCCEEDED, State.FAILED, State.ERROR], timeout=30)
+        status = client.status(fields=[StatusField.STATE, StatusField.RETURN_VALUE])
+        client.shutdown(dry_run=False)
+    finally:
+        workflow_manager.terminate()
+        workflow_manager.cleanup()
+    return [(step_status[StatusField.STATE], step_status[StatusField.RETURN_VALUE])
+            for _, step_status in sorted(status.items())]
+
+
+def run(function, executor, *args, **kwargs):
+    step = ExceptionSafeSubProcessFunction(function, executor=executor)
+    step.start(*args, **kwargs)
+    step.join()
+    return step.get_result()
+
+
+class WorkerPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.pool = WorkerPool(size=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_workers_are_reused(self):
+        steps = [ExceptionSafeSubProcessFunction(get_pid, executor=self.pool) for _ in range(10)]
+        for step in steps:
+            step.start()
+        for step in steps:
+            step.join()
+
+        pids = {step.get_result()[0] for step in steps}
+        self.assertLessEqual(len(pids), 2)
+        self.assertNotIn(os.getpid(), pids)
+        self.assertIsInstance(run(fail, self.pool)[1], ValueError)
+
+    def test_unpicklable_functions_and_arguments(self):
+        registered_function = lambda: 'registered'
+        self.assertEqual(run(registered_function, self.pool), ('registered', None))
+
+        # Functions that are neither registered before the workers are forked nor picklable need a new worker.
+        unregistered_function = lambda: 'unregistered'
+        execution = self.pool.submit(unregistered_function, (), {})
+        execution.join()
+        self.assertEqual(execution.get_result(), ('unregistered', None))
+
+        # Unpicklable arguments need a new process.
+        self.assertIsInstance(self.pool.submit(get_pid, (Lock(),), {}), SubProcessExecution)
+
+    def test_terminate_replaces_the_worker(self):
+        step = ExceptionSafeSubProcessFunction(sleep_forever, executor=self.pool)
+        step.start()
+        sleep(0.5)
+        self.assertTrue(step.is_alive())
+        pid = run(get_pid, self.pool)[0]
+
+        step.terminate()
+        self.assertFalse(step.is_alive())
+        self.assertIsNone(step.get_result())
+        self.assertIn(pid, [run(get_pid, self.pool)[0] for _ in range(2)])
+
+    def test_pid(self):
+        for executor in [self.pool, ProcessExecutor()]:
+            step = ExceptionSafeSubProcessFunction(get_pid, executor=executor)
+            self.assertIsNone(step.pid)
+            step.start()
+            pid = step.pid
+            step.join()
+            self.assertEqual(step.get_result(), (pid, None))
+
+    def test_terminate_does_not_wait_for_workers_ignoring_it(self):
+        step = ExceptionSafeSubProcessFunction(ignore_termination, executor=self.pool)
+        step.start()
+        sleep(0.5)
+
+        start_time = time()
+        step.terminate()
+        self.assertLess(time() - start_time, 1)
+        self.assertTrue(step.is_alive())
+        self.assertEqual(run(get_pid, self.pool)[1], None)
+
+        step.kill()
+        step.join()
+        self.assertFalse(step.is_alive())
+        self.assertIsNone(step.get_result())
+
+    def test_registered_functions_are_released(self):
+        asyncio_executor = AsyncioExecutor()
+        try:
+            for executor in [self.pool, asyncio_executor]:
+                def function():
+                    return 'result'
+
+                step = ExceptionSafeSubProcessFunction(function, executor=executor)
+                step.start()
+                step.join()
+                self.assertEqual(step.get_result(), ('result', None))
+
+                reference = weakref.ref(function)
+                del function, step
+                gc.collect()
+                self.assertIsNone(reference())
+        finally:
+            asyncio_executor.close()
+
+    def test_max_tasks_per_worker(self):
+        pool = WorkerPool(size=1, max_tasks_per_worker=1)
+        try:
+            self.assertNotEqual(run(get_pid, pool), run(get_pid, pool))
+        finally:
+            pool.close()
+
+
+class FunctionRegistryTests(unittest.TestCase):
+    def test_released_functions_are_forgotten(self):
+        registry = FunctionRegistry()
+        registered_function = lambda: 'registered'
+        registry.register(registered_function)
+        registry.register(registered_function)
+        self.assertEqual(registry.get_functions(), [registered_function])
+        self.assertEqual(registry.get_reference(registered_function, 1), 0)
+
+        del registered_function
+        gc.collect()
+        self.assertEqual(registry.get_functions(), [None])
+
+        # A new function doesn't get the index of the released one, even if it has the same id.
+        new_function = lambda: 'new'
+        self.assertIsNone(registry.get_reference(new_function, 1))
+        registry.register(new_function)
+        self.assertEqual(registry.get_reference(new_function, 2), 1)
+        self.assertIsNone(registry.get_reference(new_function, 1))
+
+
+class ThreadExecutorTests(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadExecutor(size=2)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def test_functions_run_in_the_calling_process(self):
+        self.assertEqual(run(get_pid, self.executor), (os.getpid(), None))
+        self.assertIsInstance(run(fail, self.executor)[1], ValueError)
+        self.assertEqual(run(wait_until_cancelled, self.executor, 0.1), ('timed out', None))
+        self.assertFalse(cancelled())
+
+    def test_terminate_is_cooperative(self):
+        executions = [self.executor.submit(wait_until_cancelled, (5,), {}) for _ in range(2)]
+        queued_execution = self.executor.submit(get_pid, (), {})
+        self.assertTrue(all(execution.is_alive() for execution in executions + [queued_execution]))
+
+        for execution in [queued_execution] + executions:
+            execution.terminate()
+            execution.join()
+            self.assertFalse(execution.is_alive())
+            self.assertIsNone(execution.get_result())
+
+
+class AsyncioExecutorTests(unittest.TestCase):
+    def setUp(self):
+        self.executor = AsyncioExecutor()
+        for function in [get_pid_later, fail_later]:
+            self.executor.register(function)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def test_coroutines_run_concurrently_in_one_process(self):
+        start = time()
+        executions = [self.executor.submit(get_pid_later, (0.5,), {}) for _ in range(100)]
+        for execution in executions:
+            execution.join()
+
+        self.assertLess(time() - start, 5)
+        pids = {execution.get_result()[0] for execution in executions}
+        self.assertEqual(len(pids), 1)
+        self.assertNotIn(os.getpid(), pids)
+        self.assertIsInstance(run(fail_later, self.executor)[1], ValueError)
+
+    def test_terminate_cancels_the_task(self):
+        execution = self.executor.submit(get_pid_later, (60,), {})
+        self.assertTrue(execution.is_alive())
+
+        execution.terminate()
+        self.assertFalse(execution.is_alive())
+        self.assertIsNone(execution.get_result())
+        self.assertIsNotNone(run(get_pid_later, self.executor, 0)[0])
+
+    def test_functions_unknown_to_the_event_loop_run_in_a_new_process(self):
+        run(get_pid_later, self.executor, 0)
+
+        async def unregistered_function():
+            return 'unregistered'
+
+        execution = self.executor.submit(unregistered_function, (), {})
+        self.assertIsInstance(execution, SubProcessExecution)
+        execution.join()
+        self.assertEqual(execution.get_result(), ('unregistered', None))
+
+
+class ExecutionModeTests(unittest.TestCase):
+    def test_execution_tag(self):
+        step = Step(get_pid, execution=ExecutionMode.POOL)
+        step.start()
+        step.join()
+        self.assertNotEqual(step.get_result()[0], os.getpid())
+
+        with self.assertRaises(ValueError):
+            Step(get_pid, execution='foo')
+
+    def test_coroutine_functions_use_the_event_loop(self):
+        step = Step(get_pid_later)
+        step.start(0)
+        step.join()
+        self.assertNotEqual(step.get_result()[0], os.getpid())
+
+
+class ResourceUsageTests(unittest.TestCase):
+    def measure(self, function, executor, *args):
+        step = ExceptionSafeSubProcessFunction(function, executor=executor)
+        step.start(*args)
+        step.join()
+        self.assertIsNone(step.get_result()[1])
+        return step.get_resource_usage()
+
+    def test_usage_of_a_process_includes_its_children(self):
+        resource_usage = self.measure(burn_cpu, None, True)
+        self.assertGreater(resource_usage['user_time'], 0)
+        self.assertGreater(resource_usage['children_user_time'], 0)
+        self.assertGreater(resource_usage['max_rss'], 0)
+        self.assertGreaterEqual(resource_usage['wall_time'], resource_usage['user_time'])
+        self.assertIn('block_output', resource_usage)
+
+    def test_usage_depends_on_the_executor(self):
+        pool, thread_executor, asyncio_executor = WorkerPool(size=1), ThreadExecutor(size=1), AsyncioExecutor()
+        try:
+            self.assertGreater(self.measure(burn_cpu, pool)['user_time'], 0)
+
+            resource_usage = self.measure(burn_cpu, thread_executor)
+            self.assertGreater(resource_usage['user_time'], 0)
+            self.assertNotIn('children_user_time', resource_usage)
+
+            resource_usage = self.measure(get_pid_later, asyncio_executor, 0.2)
+            self.assertEqual(list(resource_usage), ['wall_time'])
+            self.assertGreaterEqual(resource_usage['wall_time'], 0.2)
+        finally:
+            for executor in [pool, thread_executor, asyncio_executor]:
+                executor.close()
+
+    def test_runners_are_released_once_unused(self):
+        def function():
+            pass
+
+        runner = make_runner(function, None, UsageScope.PROCESS)
+        self.assertIs(make_runner(function, None, UsageScope.PROCESS), runner)
+        self.assertIsNot(make_runner(function, None, UsageScope.THREAD), runner)
+
+        reference = weakref.ref(function)
+        del function, runner
+        gc.collect()
+        self.assertIsNone(reference())
+
+    def test_no_usage_for_terminated_runs(self):
+        step = ExceptionSafeSubProcessFunction(sleep_forever)
+        step.start()
+        step.terminate()
+        self.assertIsNone(step.get_resource_usage())
+
+
+class StartMethodTests(unittest.TestCase):
+    def setUp(self):
+        self.start_method = get_start_method()
+
+    def tearDown(self):
+        set_start_method(self.start_method)
+
+    def test_steps_and_executors_can_be_pickled(self):
+        step = pickle.loads(pickle.dumps(make_contextless_step(get_pid, execution=ExecutionMode.POOL)))
+        self.assertEqual(step.tags['execution'], ExecutionMode.POOL)
+        self.assertEqual(pickle.loads(pickle.dumps(make_simple_preprocessor(42)))(step, None), ((42,), {}))
+
+        self.assertIs(pickle.loads(pickle.dumps(WORKER_POOL)), WORKER_POOL)
+        pool = pickle.loads(pickle.dumps(WorkerPool(size=3)))
+        self.assertIsNot(pool, WORKER_POOL)
+        self.assertEqual(pool._size, 3)
+
+    def test_forkserver(self):
+        set_start_method('forkserver', preload_modules=['autotrail.workflow.helpers.execution'])
+        pool = WorkerPool(size=1)
+        try:
+            return_value, exception = run(get_pid, pool)
+            self.assertIsNone(exception)
+            self.assertNotEqual(return_value, os.getpid())
+            self.assertEqual(run(get_pid, pool), (return_value, None))
+            self.assertIsInstance(run(fail, pool)[1], ValueError)
+        finally:
+            pool.close()
+
+        return_value, exception = run(get_pid, ProcessExecutor())
+        self.assertIsNone(exception)
+        self.assertNotEqual(return_value, os.getpid())
+
+    def test_workflow_with_every_observer_mode(self):
+        for start_method in ['spawn', 'forkserver']:
+            set_start_method(start_method)
+            for observer_mode in [ObserverMode.SERIAL, ObserverMode.CONCURRENT, ObserverMode.BACKGROUND]:
+                with self.subTest(start_method=start_method, observer_mode=observer_mode):
+                    statuses = run_workflow('/tmp/test_start_method.socket', observer_mode=observer_mode)
+                    self.assertEqual([state for state, _ in statuses], [State.SUCCEEDED, State.SUCCEEDED])
+                    self.assertNotIn(os.getpid(), [return_value for _, return_value in statuses])
+
+
+class FreezeGCTests(unittest.TestCase):
+    def tearDown(self):
+        freeze_gc_on_fork(False)
+
+    def test_inherited_objects_are_frozen_only_in_the_forked_process(self):
+        self.assertEqual(run(get_freeze_count, ProcessExecutor()), (0, None))
+
+        freeze_gc_on_fork()
+        return_value, exception = run(get_freeze_count, ProcessExecutor())
+        self.assertIsNone(exception)
+        self.assertGreater(return_value, 0)
+        self.assertEqual(gc.get_freeze_count(), 0)
@@ -0,0 +1,495 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+
+
+"""
+import os
+import socket
+import unittest
+
+from multiprocessing import AuthenticationError, Pipe, Process
+from multiprocessing.connection import Client
+from threading import Thread, Timer
+from time import sleep, time
+
+from autotrail.core.api.management import (APIBatchRequest, APIHandlerResponse, APIRequest, APIResponse, CompactCodec,
+                                           DeferredResponse, MethodAPIClientWrapper, PickleCodec,
+                                           MethodAPIHandlerWrapper, PooledSocketClient, SocketClient, SocketServer,
+                                           Subscription, SubscriptionClient,
+                                           collate_relay_values, detect_codec, read_ready_messages)
+
+
+SOCKET_FILE = '/tmp/test_management.socket'
+
+
+class Handler:
+    def echo(self, value):
+        return APIHandlerResponse(value)
+
+    def slow_echo(self, value, delay):
+        sleep(delay)
+        return APIHandlerResponse(value)
+
+    def fail(self):
+        raise ValueError('Failed.')
+
+    def shutdown(self):
+        return APIHandlerResponse(True, relay_value=SocketServer.SHUTDOWN)
+
+    def deferred_echo(self, value, delay):
+        return APIHandlerResponse(None, relay_value=DeferredResponse(self.slow_echo, value, delay))
+
+    def subscribe(self, events, size):
+        subscription = Subscription(size)
+        subscription.put(events)
+        Timer(0.5, subscription.put, args=(['late'],)).start()
+        return APIHandlerResponse(size, relay_value=subscription)
+
+
+def remove_file(file_name):
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
+
+
+def get_free_tcp_address():
+    with socket.socket() as tcp_socket:
+        tcp_socket.bind(('127.0.0.1', 0))
+        return tcp_socket.getsockname()
+
+
+def start_server(address=SOCKET_FILE, **kwargs):
+    server = SocketServer(address, MethodAPIHandlerWrapper(Handler()), **kwargs)
+    process = Process(target=server)
+    process.start()
+    sleep(0.5)
+    return process
+
+
+class ReadReadyMessagesTests(unittest.TestCase):
+    def test_only_ready_connections_are_read(self):
+        pipes = [Pipe(duplex=False) for _ in range(3)]
+        pipes[0][1].send('foo')
+        pipes[0][1].send(False)
+        pipes[2][1].send('bar')
+
+        messages = read_ready_messages([reader for reader, _ in pipes])
+
+        self.assertEqual(messages, {pipes[0][0]: ['foo', False], pipes[2][0]: ['bar']})
+        self.assertEqual(read_ready_messages([reader for reader, _ in pipes]), {})
+
+    def test_closed_connection(self):
+        reader, writer = Pipe(duplex=False)
+        writer.send('foo')
+        writer.close()
+
+        self.assertEqual(read_ready_messages([reader]), {reader: ['foo']})
+        self.assertEqual(read_ready_messages([reader]), {})
+
+    def test_no_connections(self):
+        self.assertEqual(read_ready_messages([]), {})
+
+
+class SocketServerTests(unittest.TestCase):
+    def setUp(self):
+        remove_file(SOCKET_FILE)
+        self.server_process = start_server(delay=1)
+
+    def tearDown(self):
+        self.server_process.terminate()
+        remove_file(SOCKET_FILE)
+
+    def test_many_requests_per_connection(self):
+        connection = Client(SOCKET_FILE, family='AF_UNIX')
+        start = time()
+        for i in range(20):
+            connection.send(APIRequest('echo', (i,), {}))
+            self.assertEqual(connection.recv().return_value, i)
+        self.assertLess(time() - start, 1)
+
+        connection.send(APIRequest('fail', (), {}))
+        self.assertIsInstance(connection.recv().exception, ValueError)
+        connection.close()
+
+    def test_concurrent_clients(self):
+        results = {}
+
+        def call(i):
+            results[i] = MethodAPIClientWrapper(SocketClient(SOCKET_FILE), timeout=5).echo(i)
+
+        # A client that has connected but not sent a request doesn't block the others.
+        idle_connection = Client(SOCKET_FILE, family='AF_UNIX')
+        threads = [Thread(target=call, args=(i,)) for i in range(10)]
+        start = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLess(time() - start, 1)
+        self.assertEqual(results, {i: i for i in range(10)})
+        idle_connection.close()
+
+    def test_deferred_response_does_not_block_other_requests(self):
+        results = {}
+
+        def call():
+            results['deferred'] = MethodAPIClientWrapper(SocketClient(SOCKET_FILE), timeout=5).deferred_echo('foo', 1)
+
+        thread = Thread(target=call)
+        thread.start()
+        sleep(0.2)
+        start = time()
+        self.assertEqual(MethodAPIClientWrapper(SocketClient(SOCKET_FILE), timeout=5).echo('bar'), 'bar')
+        self.assertLess(time() - start, 0.5)
+        thread.join()
+        self.assertEqual(results, {'deferred': 'foo'})
+
+    def test_shutdown(self):
+        client = MethodAPIClientWrapper(SocketClient(SOCKET_FILE), timeout=5)
+        self.assertTrue(client.shutdown())
+        self.server_process.join(5)
+        self.assertFalse(self.server_process.is_alive())
+
+
+class PooledSocketClientTests(unittest.TestCase):
+    def setUp(self):
+        remove_file(SOCKET_FILE)
+        self.server_process = start_server(delay=1)
+        self.socket_client = PooledSocketClient(SOCKET_FILE, pool_size=2)
+        self.client = MethodAPIClientWrapper(self.socket_client, timeout=5)
+
+    def tearDown(self):
+        self.socket_client.close()
+        self.server_process.terminate()
+        remove_file(SOCKET_FILE)
+
+    def test_connection_is_reused(self):
+        for i in range(20):
+            self.assertEqual(self.client.echo(i), i)
+        self.assertEqual(len(self.socket_client._idle_connections), 1)
+
+        with self.assertRaises(ValueError):
+            self.client.fail()
+        self.assertEqual(len(self.socket_client._idle_connections), 1)
+
+    def test_concurrent_use(self):
+        results = {}
+
+        def call(i):
+            results[i] = self.client.slow_echo(i, 0.1)
+
+        threads = [Thread(target=call, args=(i,)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {i: i for i in range(6)})
+        self.assertLessEqual(len(self.socket_client._idle_connections), 2)
+
+    def test_reconnect_after_server_restart(self):
+        self.assertEqual(self.client.echo('foo'), 'foo')
+        self.server_process.terminate()
+        self.server_process.join()
+        remove_file(SOCKET_FILE)
+        self.server_process = start_server(delay=1)
+
+        self.assertEqual(self.client.echo('bar'), 'bar')
+
+    def test_timed_out_connection_is_discarded(self):
+        self.assertIsNone(self.socket_client(APIRequest('slow_echo', ('foo', 0.5), {}), timeout=0.1))
+        self.assertEqual(self.socket_client._idle_connections, [])
+        self.assertEqual(self.client.echo('bar'), 'bar')
+
+
+class FlakyConnection:
+    """A connection whose sends fail or whose response arrives just after the client stops waiting for it."""
+    def __init__(self, send_fails):
+        self.send_fails = send_fails
+        self.polls = [False, False, True]
+        self.closed = False
+
+    def send(self, message):
+        if self.send_fails:
+            raise BrokenPipeError()
+
+    def poll(self, timeout=0):
+        return self.polls.pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+class PooledSocketClientRetryTests(unittest.TestCase):
+    def setUp(self):
+        self.socket_client = PooledSocketClient(SOCKET_FILE)
+        self.connections = []
+        self.socket_client._connect = self.connect
+
+    def connect(self):
+        self.connections.append(FlakyConnection(False))
+        return self.connections[-1]
+
+    def test_failed_sends_are_retried(self):
+        self.socket_client._idle_connections = [FlakyConnection(True)]
+        self.socket_client(APIRequest('echo', ('foo',), {}))
+        self.assertEqual(len(self.connections), 1)
+
+    def test_late_responses_are_not_retried(self):
+        connection = FlakyConnection(False)
+        self.socket_client._idle_connections = [connection]
+        self.assertIsNone(self.socket_client(APIRequest('echo', ('foo',), {})))
+        self.assertEqual(self.connections, [])
+        self.assertTrue(connection.closed)
+
+
+class SnapshotHandler:
+    def __init__(self):
+        self.value = 0
+        self.snapshot = None
+
+    def __enter__(self):
+        self.snapshot = self.value
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.snapshot = None
+
+    def increment(self):
+        self.value += 1
+        return APIHandlerResponse(self.value, relay_value={'increment': self.value})
+
+    def get(self):
+        return APIHandlerResponse(self.value if self.snapshot is None else self.snapshot)
+
+
+class BatchTests(unittest.TestCase):
+    def setUp(self):
+        remove_file(SOCKET_FILE)
+        self.server_process = start_server(delay=1)
+        self.client = MethodAPIClientWrapper(SocketClient(SOCKET_FILE), timeout=5)
+
+    def tearDown(self):
+        self.server_process.terminate()
+        remove_file(SOCKET_FILE)
+
+    def test_batch(self):
+        batch = self.client.batch()
+        self.assertEqual(batch.echo('foo'), 0)
+        self.assertEqual(batch.fail(), 1)
+        self.assertEqual(batch.echo(value='bar'), 2)
+
+        responses = batch.send()
+
+        self.assertEqual([response.return_value for response in responses], ['foo', None, 'bar'])
+        self.assertIsInstance(responses[1].exception, ValueError)
+        self.assertEqual(batch.send(), [])
+
+    def test_batch_with_deferred_response(self):
+        batch = self.client.batch()
+        batch.deferred_echo('foo', 0.1)
+        batch.echo('bar')
+
+        self.assertEqual([response.return_value for response in batch.send()], ['foo', 'bar'])
+
+    def test_batch_stop_on_error(self):
+        batch = self.client.batch(stop_on_error=True)
+        batch.echo('foo')
+        batch.fail()
+        batch.echo('bar')
+
+        responses = batch.send()
+
+        self.assertEqual(len(responses), 2)
+        self.assertEqual(responses[0].return_value, 'foo')
+        self.assertIsInstance(responses[1].exception, ValueError)
+
+    def test_batch_is_served_in_a_single_handler_context(self):
+        handler = MethodAPIHandlerWrapper(SnapshotHandler())
+        batch_request = APIBatchRequest([APIRequest('get', (), {}), APIRequest('increment', (), {}),
+                                         APIRequest('increment', (), {}), APIRequest('get', (), {})])
+
+        response = handler(batch_request)
+
+        self.assertEqual([api_response.return_value for api_response in response.return_value], [0, 1, 2, 0])
+        self.assertEqual(response.relay_value, {'increment': 2})
+        self.assertEqual(handler(APIRequest('get', (), {})).return_value, 2)
+
+    def test_collate_relay_values(self):
+        self.assertIsNone(collate_relay_values([None, None]))
+        self.assertEqual(collate_relay_values([{'a': 1}, None, {'b': 2}, {'a': 3}]), {'a': 3, 'b': 2})
+        self.assertEqual(collate_relay_values([{'a': 1}, SocketServer.SHUTDOWN, None]), SocketServer.SHUTDOWN)
+
+    def test_shutdown_takes_precedence_over_other_relay_values(self):
+        subscription = Subscription(2)
+        self.assertEqual(collate_relay_values([SocketServer.SHUTDOWN, subscription]), SocketServer.SHUTDOWN)
+        self.assertEqual(collate_relay_values([{'a': 1}, SocketServer.SHUTDOWN, {'b': 2}]), SocketServer.SHUTDOWN)
+
+    def test_dict_relay_values_are_merged_around_other_relay_values(self):
+        subscription = Subscription(2)
+        with self.assertLogs('autotrail.core.api.management', level='WARNING'):
+            self.assertIs(collate_relay_values([{'a': 1}, subscription, {'b': 2}]), subscription)
+        self.assertEqual(collate_relay_values(iter([None, {'a': 1}, {'a': 2, 'b': 3}, None])), {'a': 2, 'b': 3})
+
+
+class SubscriptionTests(unittest.TestCase):
+    def test_overflow(self):
+        subscription = Subscription(2)
+        self.assertTrue(subscription.put(['foo', 'bar', 'baz', 'qux']))
+
+        self.assertEqual(subscription.get(0), ['foo', 'bar', {'type': Subscription.OVERFLOW, 'dropped': 2}])
+        self.assertEqual(subscription.get(0), [])
+
+    def test_close(self):
+        subscription = Subscription()
+        subscription.close()
+
+        self.assertFalse(subscription.put(['foo']))
+        self.assertEqual(subscription.get(), [])
+
+    def test_streaming(self):
+        remove_file(SOCKET_FILE)
+        server_process = start_server(delay=1)
+        try:
+            subscription_client = SubscriptionClient(SOCKET_FILE,
+                                                     APIRequest('subscribe', (['foo', 'bar', 'baz'], 2), {}))
+            self.assertEqual(subscription_client.return_value, 2)
+
+            events = []
+            while len(events) < 4:
+                events.extend(subscription_client.get(5))
+            self.assertEqual(events, ['foo', 'bar', {'type': Subscription.OVERFLOW, 'dropped': 1}, 'late'])
+
+            # Other clients are served while the subscription is streaming.
+            self.assertEqual(MethodAPIClientWrapper(SocketClient(SOCKET_FILE), timeout=5).echo('foo'), 'foo')
+            subscription_client.close()
+            self.assertIsNone(subscription_client.get(0))
+        finally:
+            server_process.terminate()
+            remove_file(SOCKET_FILE)
+
+
+class TCPTests(unittest.TestCase):
+    def setUp(self):
+        self.address = get_free_tcp_address()
+        self.server_process = start_server(address=self.address, authkey=b'secret')
+
+    def tearDown(self):
+        self.server_process.terminate()
+
+    def test_authenticated_clients(self):
+        self.assertEqual(MethodAPIClientWrapper(SocketClient(self.address, authkey=b'secret'), timeout=5).echo('foo'),
+                         'foo')
+
+        socket_client = PooledSocketClient(self.address, authkey=b'secret')
+        self.assertEqual([MethodAPIClientWrapper(socket_client, timeout=5).echo(i) for i in range(5)], list(range(5)))
+        socket_client.close()
+
+        subscription_client = SubscriptionClient(self.address, APIRequest('subscribe', (['foo'], 2), {}),
+                                                 authkey=b'secret')
+        self.assertEqual(subscription_client.get(5), ['foo'])
+        subscription_client.close()
+
+    def test_unauthenticated_clients(self):
+        with self.assertRaises(AuthenticationError):
+            SocketClient(self.address, authkey=b'wrong')(APIRequest('echo', ('foo',), {}))
+
+        # The server continues to serve other clients.
+        self.assertEqual(MethodAPIClientWrapper(SocketClient(self.address, authkey=b'secret'), timeout=5).echo('foo'),
+                         'foo')
+
+    def test_shutdown(self):
+        self.assertTrue(MethodAPIClientWrapper(SocketClient(self.address, authkey=b'secret'), timeout=5).shutdown())
+        self.server_process.join(5)
+        self.assertFalse(self.server_process.is_alive())
+
+    def test_authkey_is_required(self):
+        with self.assertRaises(ValueError):
+            SocketServer(self.address, MethodAPIHandlerWrapper(Handler()))
+
+
+class CodecTests(unittest.TestCase):
+    def setUp(self):
+        self.message = APIResponse({
+            0: {'Name': 'foo', 'Tags': {'n': 0, 'name': 'foo'}, 'Output': ['bar', 'baz'], 'Exception': None},
+            1: {'Name': 'bar', 'Tags': {'n': 1, 'name': 'bar'}, 'Output': [], 'Exception': ValueError('qux')},
+            2: {'Name': 'baz', 'Tags': {'n': 2, 'name': 'baz', 'group': 'a'}, 'Output': [{}], 'Exception': None},
+        })
+        self.others = [[{'a': 1}, {'a': 2}, {'b': 3}], ({'a': 1}, {'a': (2, [3])}), {'a': {}, 'b': {}}, 'foo', None,
+                       APIRequest('status', (), {'fields': ['Name'], 'n': 1})]
+
+    def assertMessageEqual(self, message, expected_message):
+        self.assertEqual(repr(message), repr(expected_message))
+
+    def test_round_trip(self):
+        for codec in [PickleCodec(), CompactCodec(), CompactCodec(compress=True, min_compress_size=0)]:
+            for message in [self.message] + self.others:
+                self.assertMessageEqual(codec.decode(codec.encode(message)), message)
+
+    def test_compact_codec_is_smaller(self):
+        message = APIResponse({step_id: {'Name': 'foo', 'State': 'Ready', 'Return value': None}
+                               for step_id in range(100)})
+        pickled_size = len(PickleCodec().encode(message))
+
+        self.assertLess(len(CompactCodec().encode(message)), pickled_size)
+        self.assertLess(len(CompactCodec(compress=True, min_compress_size=0).encode(message)), pickled_size / 5)
+
+    def test_detect_codec(self):
+        self.assertIsInstance(detect_codec(PickleCodec().encode('foo')), PickleCodec)
+        self.assertFalse(detect_codec(CompactCodec().encode('foo')).compress)
+        self.assertTrue(detect_codec(CompactCodec(compress=True).encode('foo')).compress)
+        self.assertIsNone(detect_codec(PickleCodec().encode('foo'), codecs=[CompactCodec]))
+
+    def test_server_replies_in_kind(self):
+        remove_file(SOCKET_FILE)
+        server_process = start_server(delay=1)
+        try:
+            for codec in [None, CompactCodec(), CompactCodec(compress=True, min_compress_size=0)]:
+                self.assertEqual(MethodAPIClientWrapper(SocketClient(SOCKET_FILE, codec=codec), timeout=5).echo(
+                    self.message.return_value)[2]['Tags'], {'n': 2, 'name': 'baz', 'group': 'a'})
+
+                socket_client = PooledSocketClient(SOCKET_FILE, codec=codec)
+                self.assertEqual(MethodAPIClientWrapper(socket_client, timeout=5).echo([{'a': 1}, {'a': 2}]),
+                                 [{'a': 1}, {'a': 2}])
+                socket_client.close()
+
+                subscription_client = SubscriptionClient(
+                    SOCKET_FILE, APIRequest('subscribe', ([{'a': 1}, {'a': 2}], 2), {}), codec=codec)
+                self.assertEqual(subscription_client.get(5), [{'a': 1}, {'a': 2}])
+                subscription_client.close()
+        finally:
+            server_process.terminate()
+            remove_file(SOCKET_FILE)
+
+    def test_undecodable_requests_get_an_error(self):
+        remove_file(SOCKET_FILE)
+        server_process = start_server(delay=1)
+        try:
+            for data in [b'garbage', PickleCodec().encode(APIRequest('echo', ('foo',), {}))[:-5],
+                         CompactCodec(compress=True, min_compress_size=0).encode('foo')[:-5]]:
+                connection = Client(SOCKET_FILE)
+                connection.send_bytes(data)
+                self.assertTrue(connection.poll(5))
+                response_data = connection.recv_bytes()
+                response = detect_codec(response_data).decode(response_data)
+                self.assertIsInstance(response.exception, ValueError)
+                connection.close()
+
+            # The server keeps serving other connections.
+            self.assertEqual(MethodAPIClientWrapper(SocketClient(SOCKET_FILE), timeout=5).echo('bar'), 'bar')
+        finally:
+            server_process.terminate()
+            remove_file(SOCKET_FILE)
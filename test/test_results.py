@@ -0,0 +1,202 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+
+"""
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import unittest
+
+from autotrail.workflow.default_workflow.state_machine import AutomaticActions
+from autotrail.workflow.helpers.context import make_context, serialize_step_data
+from autotrail.workflow.helpers.execution import ExceptionSafeSubProcessFunction, ThreadExecutor
+from autotrail.workflow.helpers.results import (CacheResult, LargeResult, LargeResultStore, StepResultCache,
+                                                discard_replaced_result, load_result)
+from autotrail.workflow.helpers.step import (ChainPreProcessors, ContextWrapper, Step, make_simple_preprocessor, output,
+                                             output_preprocessor)
+
+
+def make_large_value():
+    return bytearray(b'x' * 2048)
+
+
+def get_pid(value):
+    return os.getpid(), value
+
+
+class FinishedStep:
+    def __init__(self, step_id, return_value):
+        self.id = step_id
+        self.tags = {}
+        self.return_value = return_value
+
+    def get_result(self):
+        return self.return_value, None
+
+
+def run(step, context):
+    step.start(context)
+    step.join()
+    return step.get_result()
+
+
+class LargeResultStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = LargeResultStore(self.directory, threshold=1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_only_large_values_are_stored(self):
+        self.assertEqual(self.store.put('small'), 'small')
+        self.assertEqual(os.listdir(self.directory), [])
+
+        value = {'data': b'y' * 1024, 'array': make_large_value()}
+        handle = self.store.put(value)
+        self.assertIsInstance(handle, LargeResult)
+        self.assertGreaterEqual(handle.size, 3072)
+        self.assertEqual(pickle.loads(pickle.dumps(handle)).load(), value)
+        self.assertEqual(load_result(handle), value)
+        self.assertEqual(load_result('small'), 'small')
+
+        handle.delete()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_the_process_running_the_function_stores_the_value(self):
+        function = ExceptionSafeSubProcessFunction(make_large_value, result_store=self.store)
+        function.start()
+        function.join()
+        handle, exception = function.get_result()
+        self.assertIsNone(exception)
+        self.assertIsInstance(handle, LargeResult)
+        self.assertEqual(handle.load(), make_large_value())
+
+        function = ExceptionSafeSubProcessFunction(make_large_value, executor=ThreadExecutor(),
+                                                   result_store=self.store)
+        function.start()
+        function.join()
+        self.assertEqual(function.get_result(), (make_large_value(), None))
+
+    def test_replaced_values_are_deleted(self):
+        context = make_context()
+        first_handle, second_handle = self.store.put(make_large_value()), self.store.put(make_large_value())
+        AutomaticActions.check_step(FinishedStep(0, first_handle), context)
+        AutomaticActions.check_step(FinishedStep(0, first_handle), context)
+        self.assertTrue(os.path.exists(first_handle.file_name))
+
+        # A rerun of the step replaces its return value.
+        AutomaticActions.check_step(FinishedStep(0, second_handle), context)
+        self.assertFalse(os.path.exists(first_handle.file_name))
+        self.assertEqual(context['step_data'][0]['return_value'].load(), make_large_value())
+
+        discard_replaced_result(second_handle, 'small')
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_clear(self):
+        handles = [self.store.put(make_large_value()) for _ in range(3)]
+        with open(os.path.join(self.directory, 'other.txt'), 'w') as other_file:
+            other_file.write('other')
+
+        self.store.clear()
+        self.assertEqual(os.listdir(self.directory), ['other.txt'])
+        self.assertFalse(any(os.path.exists(handle.file_name) for handle in handles))
+
+
+class StepResultCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_least_recently_used_values_are_evicted(self):
+        cache = StepResultCache(self.directory, max_size=3000)
+        keys = [cache.make_key(get_pid, (n,)) for n in range(4)]
+        self.assertEqual(len(set(keys)), 4)
+
+        for key in keys[:3]:
+            cache.put(key, b'x' * 900)
+        self.assertEqual(cache.get(keys[0]), (CacheResult.HIT, b'x' * 900))
+        cache.put(keys[3], b'x' * 900)
+
+        cache = StepResultCache(self.directory, max_size=3000)
+        self.assertEqual([cache.get(key)[0] for key in keys],
+                         [CacheResult.HIT, CacheResult.MISS, CacheResult.HIT, CacheResult.HIT])
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_context_wrapper_skips_cached_runs(self):
+        cache = StepResultCache(self.directory)
+        context = make_context(region='a')
+
+        def make_step(value):
+            return ContextWrapper(Step(get_pid), pre_processor=make_simple_preprocessor(value), cache=cache,
+                                  cache_context_keys=['region'])
+
+        step = make_step(1)
+        (pid, _), exception = run(step, context)
+        self.assertIsNone(exception)
+        self.assertEqual(context['step_data'][step.id]['cache'], CacheResult.MISS)
+
+        step = make_step(1)
+        self.assertEqual(run(step, context), ((pid, 1), None))
+        self.assertEqual(serialize_step_data(context)[step.id]['cache'], CacheResult.HIT)
+
+        self.assertNotEqual(run(make_step(2), context)[0][0], pid)
+        context['region'] = 'b'
+        self.assertNotEqual(run(make_step(1), context)[0][0], pid)
+
+    def test_keys_follow_the_function_code_and_captured_values(self):
+        cache = StepResultCache(self.directory)
+
+        def make_adder(amount):
+            def add(value):
+                return value + amount
+            return add
+
+        def make_lambda(amount):
+            return lambda value: value + amount
+
+        self.assertEqual(cache.make_key(make_adder(1), (1,)), cache.make_key(make_adder(1), (1,)))
+        self.assertNotEqual(cache.make_key(make_adder(1), (1,)), cache.make_key(make_adder(2), (1,)))
+        self.assertNotEqual(cache.make_key(lambda value: value + 1, (1,)),
+                            cache.make_key(lambda value: value + 2, (1,)))
+        self.assertNotEqual(cache.make_key(lambda value: [value + 1 for _ in range(1)], (1,)),
+                            cache.make_key(lambda value: [value + 2 for _ in range(1)], (1,)))
+        self.assertNotEqual(cache.make_key(make_lambda(1), (1,)), cache.make_key(make_lambda(2), (1,)))
+
+    def test_functions_capturing_unpicklable_values_are_not_cached(self):
+        cache = StepResultCache(self.directory)
+        lock = threading.Lock()
+
+        def locked(value):
+            with lock:
+                return value
+
+        self.assertIsNone(cache.make_key(locked, (1,)))
+
+    def test_steps_passed_connections_are_not_cached(self):
+        cache = StepResultCache(self.directory)
+        context = make_context()
+        step = ContextWrapper(Step(output), pre_processor=ChainPreProcessors([
+            output_preprocessor, make_simple_preprocessor('Hello')]), cache=cache)
+
+        for _ in range(2):
+            self.assertEqual(run(step, context), (None, None))
+            self.assertEqual(serialize_step_data(context)[step.id]['output'][-1], 'Hello')
+        self.assertEqual(len(serialize_step_data(context)[step.id]['output']), 2)
+        self.assertNotIn('cache', context['step_data'][step.id])
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
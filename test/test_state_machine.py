@@ -0,0 +1,114 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+
+"""
+import signal
+import unittest
+
+from time import monotonic, sleep, time
+
+from autotrail.workflow.default_workflow.state_machine import AutomaticActions, StepDeadlines, StepTimedOut
+from autotrail.workflow.helpers.context import make_context
+from autotrail.workflow.helpers.execution import ExecutionMode
+from autotrail.workflow.helpers.step import make_contextless_step
+
+
+def sleep_a_while():
+    sleep(30)
+
+
+def ignore_termination():
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sleep(30)
+
+
+def quick():
+    return 'done'
+
+
+def check_until_done(step, context, timeout=10):
+    for _ in range(int(timeout / 0.05)):
+        outcome = AutomaticActions.check_step(step, context)
+        if outcome != 'running':
+            return outcome
+        sleep(0.05)
+
+
+class StepDeadlinesTests(unittest.TestCase):
+    def test_only_current_deadlines_expire(self):
+        deadlines = StepDeadlines()
+        deadlines.set(1, 10)
+        deadlines.set(2, 20)
+        deadlines.set(3, 5)
+        deadlines.set(1, 30)
+        deadlines.remove(3)
+
+        deadlines.update(now=25)
+        self.assertEqual(deadlines.expired, {2})
+
+        deadlines.update(now=35)
+        self.assertEqual(deadlines.expired, {1, 2})
+
+        deadlines.set(2, 40)
+        self.assertEqual(deadlines.expired, {1})
+
+    def test_deadlines_are_monotonic(self):
+        deadlines = StepDeadlines()
+        deadlines.set(1, monotonic() + 60)
+        deadlines.update()
+        self.assertEqual(deadlines.expired, set())
+
+
+class TimeoutTests(unittest.TestCase):
+    def test_timed_out_step_is_terminated(self):
+        context = make_context()
+        step = make_contextless_step(sleep_a_while, timeout=0.2)
+        AutomaticActions.start(step, context)
+
+        start_time = time()
+        self.assertEqual(check_until_done(step, context), 'tempfail')
+        self.assertLess(time() - start_time, 5)
+        self.assertIsInstance(context['step_data'][step.id]['exception'], StepTimedOut)
+        self.assertTrue(context['step_data'][step.id]['timeout'].startswith('Terminated'))
+        self.assertFalse(step.is_alive())
+
+    def test_step_ignoring_termination_is_killed_after_the_grace_period(self):
+        for execution_mode in [ExecutionMode.PROCESS, ExecutionMode.POOL]:
+            context = make_context()
+            step = make_contextless_step(ignore_termination, timeout=0.5, timeout_grace_period=0.2,
+                                         execution=execution_mode)
+            AutomaticActions.start(step, context)
+
+            self.assertEqual(check_until_done(step, context), 'tempfail')
+            self.assertTrue(context['step_data'][step.id]['timeout'].startswith('Killed'))
+            step.join()
+
+    def test_steps_finishing_in_time_are_not_affected(self):
+        context = make_context()
+        step = make_contextless_step(quick, timeout=5)
+        AutomaticActions.start(step, context)
+
+        self.assertEqual(check_until_done(step, context), 'success')
+        self.assertNotIn('timeout', context['step_data'][step.id])
+        self.assertEqual(context['step_deadlines'].expired, set())
+        self.assertGreaterEqual(context['step_data'][step.id]['resource_usage']['wall_time'], 0)
+
+    def test_timed_out_steps_have_no_resource_usage(self):
+        context = make_context()
+        step = make_contextless_step(sleep_a_while, timeout=0.2)
+        context['step_data'][step.id] = {'resource_usage': {'wall_time': 1.0}}
+        AutomaticActions.start(step, context)
+
+        self.assertEqual(check_until_done(step, context), 'tempfail')
+        self.assertNotIn('resource_usage', context['step_data'][step.id])